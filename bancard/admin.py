@@ -1,5 +1,71 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
 from django.contrib import admin
-from .models import Card, Transaction, Reversion
+from django.contrib.admin import helpers
+from django.db import connection
+from django.db.models import Avg, Count, Max
+from django.http import Http404, HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from . import operations
+from .models import AdminJob, Card, Transaction, Reversion, OutboxEntry, GatewayCall
+
+logger = logging.getLogger(__name__)
+
+
+def _refresh_statuses(tx_ids: List[int], progress) -> Dict[str, int]:
+    responses = operations.refresh_transaction_statuses(tx_ids, progress=progress)
+    summary = dict.fromkeys(dict(Transaction.STATUS_CHOICES), 0)
+    for response in responses.values():
+        summary[response.status] += 1
+    return summary
+
+
+def _reverse(tx_ids: List[int], progress) -> Dict[str, int]:
+    # The operator confirmed after seeing the estimate.
+    result = operations.reverse_bulk(tx_ids, progress=progress, allow_overrun=True)
+    return {
+        "reversed": len(result.reversed),
+        "failed": len(result.failed),
+        "queued": len(result.queued),
+        "ineligible": len(result.ineligible),
+    }
+
+
+def _run_job(job_id, func: Callable, tx_ids: List[int]) -> None:
+    """Runs `func` on `tx_ids`, keeping its progress and result in its
+    `AdminJob`. Updates of a job deleted meanwhile are dropped.
+    """
+    jobs = AdminJob.objects.filter(pk=job_id)
+    job_thread = threading.current_thread()
+    reported_at = 0.0
+
+    def progress(done: int, total: int) -> None:
+        nonlocal reported_at
+        # Don't write to the database more than a few times per second.
+        if done == total or time.monotonic() - reported_at > 0.5:
+            reported_at = time.monotonic()
+            jobs.update(done=done)
+            if threading.current_thread() is not job_thread:
+                # Worker threads don't close their connections on exit.
+                connection.close()
+
+    try:
+        try:
+            update = {"status": AdminJob.DONE, "result": func(tx_ids, progress)}
+        except Exception as e:
+            logger.exception("Admin job %s failed.", job_id)
+            update = {"status": AdminJob.FAILED, "error": str(e)[:250]}
+        jobs.update(done=len(tx_ids), **update)
+    finally:
+        connection.close()
 
 
 @admin.register(Card)
@@ -41,6 +107,69 @@ class TransactionAdmin(admin.ModelAdmin):
     list_filter = ("status",)
     search_fields = ("user", "tx_description", "authorization_code")
     ordering = ("-created_at",)
+    actions = ("refresh_status", "reverse_transactions")
+
+    def get_urls(self):
+        return [
+            path(
+                "jobs/<uuid:job_id>/",
+                self.admin_site.admin_view(self.job_view),
+                name="bancard_transaction_job",
+            )
+        ] + super().get_urls()
+
+    def start_job(self, request, name: str, func: Callable, queryset):
+        """Runs `func` on the selected transactions in a background thread
+        and redirects to a page following its progress.
+        """
+        tx_ids = list(queryset.values_list("id", flat=True))
+        job = AdminJob.objects.create(name=str(name), total=len(tx_ids))
+        threading.Thread(
+            target=_run_job, args=(job.pk, func, tx_ids), name="bancard-admin-job"
+        ).start()
+        return HttpResponseRedirect(
+            reverse(f"{self.admin_site.name}:bancard_transaction_job", args=[job.pk])
+        )
+
+    @admin.action(description=_("Refresh status from vPOS"), permissions=["change"])
+    def refresh_status(self, request, queryset):
+        return self.start_job(request, _("Refresh status"), _refresh_statuses, queryset)
+
+    @admin.action(description=_("Reverse transactions"), permissions=["change"])
+    def reverse_transactions(self, request, queryset):
+        """Asks for confirmation first, like the delete action, showing how
+        long the rollbacks are expected to take.
+        """
+        if request.POST.get("post"):
+            return self.start_job(request, _("Reverse"), _reverse, queryset)
+        estimate = operations.estimate_reverse_bulk(
+            queryset.values_list("id", flat=True)
+        )
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": _("Reverse transactions"),
+            "queryset": queryset.order_by("-created_at"),
+            "estimate": estimate,
+            "action_checkbox_name": helpers.ACTION_CHECKBOX_NAME,
+            "media": self.media,
+        }
+        return TemplateResponse(
+            request, "admin/bancard/transaction/reverse_confirmation.html", context
+        )
+
+    def job_view(self, request, job_id):
+        job = AdminJob.objects.filter(pk=job_id).first()
+        if job is None:
+            raise Http404(_("Job not found."))
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": job.name,
+            "job": job,
+            "percent": job.percent,
+        }
+        return TemplateResponse(request, "admin/bancard/transaction/job.html", context)
 
 
 class TransactionInline(admin.TabularInline):
@@ -65,3 +194,114 @@ class ReversionAdmin(admin.ModelAdmin):
     list_display = ("id", "transaction", "status", "response_description")
     search_fields = ("transaction__id", "transaction__authorization_code")
     readonly_fields = ("status", "transaction", "response_description", "raw_response")
+
+
+@admin.register(OutboxEntry)
+class OutboxEntryAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "operation",
+        "transaction",
+        "status",
+        "attempts",
+        "next_attempt_at",
+    )
+    list_filter = ("operation", "status")
+    search_fields = ("transaction__id",)
+    readonly_fields = (
+        "operation",
+        "status",
+        "transaction",
+        "reversion",
+        "attempts",
+        "next_attempt_at",
+        "last_error",
+        "created_at",
+        "updated_at",
+    )
+    ordering = ("-created_at",)
+
+
+@admin.register(GatewayCall)
+class GatewayCallAdmin(admin.ModelAdmin):
+    list_display = (
+        "created_at",
+        "method",
+        "path",
+        "status_code",
+        "duration",
+        "tx_id",
+        "error",
+    )
+    list_filter = ("endpoint", "status_code", "method")
+    search_fields = ("=tx_id",)
+    readonly_fields = (
+        "method",
+        "path",
+        "endpoint",
+        "status_code",
+        "duration",
+        "tx_id",
+        "request_data",
+        "error",
+        "created_at",
+    )
+    date_hierarchy = "created_at"
+    ordering = ("-created_at",)
+    # Latency percentiles per endpoint, computed over the filtered calls.
+    percentiles = (50, 95, 99)
+    # Unless a date is picked, only recent calls are summarized.
+    latency_window = timedelta(days=1)
+    # Percentiles are computed over the latest calls of each endpoint.
+    latency_sample_size = 10000
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_latency_stats(self, queryset, since: Optional[datetime] = None):
+        """Returns count, mean, max. and percentile durations per endpoint.
+
+        Percentiles take one query per endpoint, over its latest
+        `latency_sample_size` calls (the `bancard_call_latency_idx` index).
+
+        :param since: only summarize calls made since then.
+        """
+        queryset = queryset.order_by()
+        if since:
+            queryset = queryset.filter(created_at__gte=since)
+        stats = []
+        for row in (
+            queryset.values("endpoint")
+            .annotate(count=Count("id"), mean=Avg("duration"), max=Max("duration"))
+            .order_by("endpoint")
+        ):
+            durations = sorted(
+                queryset.filter(endpoint=row["endpoint"])
+                .order_by("-created_at")
+                .values_list("duration", flat=True)[: self.latency_sample_size]
+            )
+            row["percentiles"] = [
+                durations[min(len(durations) - 1, len(durations) * p // 100)]
+                for p in self.percentiles
+            ]
+            stats.append(row)
+        return stats
+
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        changelist = getattr(response, "context_data", {}).get("cl")
+        if changelist:
+            since = None
+            if not any(
+                key.startswith(f"{self.date_hierarchy}__") for key in request.GET
+            ):
+                since = timezone.now() - self.latency_window
+            response.context_data["latency_stats"] = self.get_latency_stats(
+                changelist.queryset, since
+            )
+            response.context_data["latency_since"] = since
+            response.context_data["percentiles"] = self.percentiles
+        return response
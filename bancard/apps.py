@@ -1,7 +1,42 @@
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class BancardConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "bancard"
     verbose_name = "Bancard"
+
+    def ready(self):
+        from .notifiers import publish_transaction_update
+        from .signals import transaction_updated
+
+        transaction_updated.connect(
+            publish_transaction_update, dispatch_uid="bancard_notifier"
+        )
+        if getattr(settings, "BANCARD_PROFILING", None):
+            from django.db.backends.signals import connection_created
+
+            from .profiling import install_query_timer
+
+            connection_created.connect(
+                install_query_timer, dispatch_uid="bancard_profiling"
+            )
+        if getattr(settings, "BANCARD_AUDIT", {}).get("FLUSH") == "request":
+            from django.core.signals import request_finished
+
+            from .gateway import bancard
+
+            request_finished.connect(
+                bancard.audit_log.flush_on_request_finished,
+                dispatch_uid="bancard_audit",
+            )
+        if getattr(settings, "BANCARD_WARMUP", None):
+            from .gateway import gateways
+
+            for gateway in gateways.all():
+                threading.Thread(
+                    target=gateway.warm_up, name="bancard-warmup", daemon=True
+                ).start()
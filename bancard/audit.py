@@ -0,0 +1,158 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import GatewayCall
+
+logger = logging.getLogger(__name__)
+
+# Request fields replaced by `REDACTED` in audit records.
+REDACTED_FIELDS = (
+    "public_key",
+    "token",
+    "alias_token",
+    "user_cell_phone",
+    "user_mail",
+)
+REDACTED = "[redacted]"
+
+
+def redact(data: Any, fields) -> Any:
+    """Returns a copy of `data` with the values of `fields` replaced, at any depth."""
+    if isinstance(data, dict):
+        return {
+            key: REDACTED if key in fields else redact(value, fields)
+            for key, value in data.items()
+        }
+    if isinstance(data, list):
+        return [redact(value, fields) for value in data]
+    return data
+
+
+class AuditLog:
+    """Records vPOS requests as `GatewayCall` rows without writing to the
+    database on the request path.
+
+    Calls are kept in a bounded in-memory buffer and written with
+    `bulk_create`, by a background thread or when a request finishes.
+    Configured with the `BANCARD_AUDIT` setting::
+
+        BANCARD_AUDIT = {
+            "BUFFER_SIZE": 1000,  # max. calls kept in memory
+            "DROP": "oldest",  # or "newest": which calls to drop when full
+            "FLUSH": "thread",  # or "request": write at the end of each request
+            "FLUSH_INTERVAL": 1,  # seconds between writes of the thread
+            "REDACT": ["description"],  # fields redacted besides REDACTED_FIELDS
+        }
+
+    Dropped calls are counted in the `audit.dropped` metric. Calls are not
+    recorded if the setting is missing.
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.enabled = bool(config)
+        self.buffer_size = config.get("BUFFER_SIZE", 1000)
+        self.drop_newest = config.get("DROP", "oldest") == "newest"
+        self.flush_on_request = config.get("FLUSH", "thread") == "request"
+        self.flush_interval = config.get("FLUSH_INTERVAL", 1)
+        self.redacted_fields = set(REDACTED_FIELDS) | set(config.get("REDACT", ()))
+        self.buffer: deque = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def record(
+        self,
+        method: str,
+        path: str,
+        endpoint: str,
+        data: dict,
+        status_code: Optional[int],
+        duration: float,
+        error: str = "",
+    ) -> None:
+        """Adds a call to the buffer, dropping one if it is full."""
+        if not self.enabled:
+            return
+        operation = data.get("operation") or {}
+        call = {
+            "method": method,
+            "path": path,
+            "endpoint": endpoint,
+            "status_code": status_code,
+            "duration": duration,
+            "tx_id": operation.get("shop_process_id"),
+            "request_data": data,
+            "error": error[:250],
+            "created_at": timezone.now(),
+        }
+        with self._lock:
+            if len(self.buffer) >= self.buffer_size:
+                metrics.increment("audit.dropped")
+                if self.drop_newest:
+                    return
+                self.buffer.popleft()
+            self.buffer.append(call)
+            if len(self.buffer) >= self.buffer_size // 2:
+                self._wake.set()
+        if not self.flush_on_request:
+            self._ensure_thread()
+
+    def flush(self) -> int:
+        """Writes buffered calls to the database.
+
+        :returns: number of calls written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                calls, self.buffer = list(self.buffer), deque()
+            if not calls:
+                return 0
+            rows = []
+            for call in calls:
+                # Redacted here to keep it out of the request path as well.
+                call["request_data"] = redact(
+                    call["request_data"], self.redacted_fields
+                )
+                rows.append(GatewayCall(**call))
+            try:
+                GatewayCall.objects.bulk_create(rows)
+            except Exception:
+                metrics.increment("audit.dropped", len(rows))
+                logger.exception("Could not write %s gateway calls.", len(rows))
+                return 0
+            metrics.increment("audit.written", len(rows))
+            return len(rows)
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="bancard-audit", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            started = time.monotonic()
+            self.flush()
+            close_old_connections()
+            metrics.observe("audit.flush_seconds", time.monotonic() - started)
+
+    def flush_on_request_finished(self, **kwargs) -> None:
+        """`request_finished` receiver used with `"FLUSH": "request"`."""
+        self.flush()
@@ -0,0 +1,66 @@
+"""Time budgets for operations calling vPOS.
+
+Operations decorated with `with_timeout` accept a `timeout` keyword argument
+with the seconds the whole call may take. The deadline is kept in a context
+variable, so every vPOS request made on its behalf, including those sent from
+worker threads started with `run_concurrently`, uses the time left as its
+timeout. Nested deadlines never extend an enclosing one::
+
+    with deadline(2.5):  # e.g. what is left of the upstream request SLA
+        response = operations.charge_card(..., timeout=5)  # still 2.5s max.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# `time.monotonic()` value at which the current deadline expires.
+_expires_at: ContextVar[Optional[float]] = ContextVar("bancard_deadline", default=None)
+
+
+def remaining() -> Optional[float]:
+    """Returns the seconds left before the current deadline, or `None` if
+    there is none.
+    """
+    expires_at = _expires_at.get()
+    if expires_at is None:
+        return None
+    return max(0.0, expires_at - time.monotonic())
+
+
+@contextmanager
+def deadline(timeout: Optional[float]) -> Iterator[None]:
+    """Limits vPOS requests made inside the block to `timeout` seconds in total.
+
+    :param timeout: seconds the block may take. No limit if `None`, other than
+    an enclosing deadline.
+    """
+    if timeout is None:
+        yield
+        return
+    expires_at = time.monotonic() + timeout
+    current = _expires_at.get()
+    if current is not None:
+        expires_at = min(expires_at, current)
+    token = _expires_at.set(expires_at)
+    try:
+        yield
+    finally:
+        _expires_at.reset(token)
+
+
+def with_timeout(func: Callable[..., T]) -> Callable[..., T]:
+    """Adds a `timeout` keyword argument to `func`, running it inside
+    `deadline(timeout)`.
+    """
+
+    @wraps(func)
+    def wrapper(*args, timeout: Optional[float] = None, **kwargs) -> T:
+        with deadline(timeout):
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,19 @@
+class TransientGatewayError(Exception):
+    """vPOS could not be reached or is temporarily unable to answer
+    (connection errors, timeouts, throttling and 5xx responses).
+
+    The outcome of the request is unknown, so callers must not treat it as a
+    rejection. Operations that change state record it in the outbox instead.
+    """
+
+
+class RateLimited(TransientGatewayError):
+    """The request was not sent because the vPOS rate limit was reached."""
+
+
+class DeadlineExceeded(Exception):
+    """The time budget of an operation ran out before a vPOS request was sent.
+
+    Unlike `TransientGatewayError`, nothing reached vPOS, so there is no
+    outcome to confirm later. See `bancard.deadlines`.
+    """
@@ -1,34 +1,259 @@
 import hashlib
+import hmac
+import threading
+import time
+from contextlib import nullcontext
+from functools import partial
 from urllib.parse import urlencode, urlparse, parse_qsl, urlunparse
 from decimal import Decimal
 from typing import Optional, List, Dict, Any, Tuple
 
 import requests
 from django.conf import settings
-from .models import Transaction
+from django.core.exceptions import ImproperlyConfigured
+
+from . import deadlines, profiling
+from .audit import AuditLog
+from .exceptions import TransientGatewayError, RateLimited, DeadlineExceeded
+from .hedging import Hedger
+from .lanes import Lane, current_lane
+from .metrics import metrics
+from .models import Transaction, DEFAULT_MERCHANT
+from .ratelimit import RateLimiter
+from .transports import get_transport
+
+# HTTP status codes meaning vPOS is temporarily unable to process a request.
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
 
 
 class BancardGateway:
-    def __init__(self) -> None:
-        self.is_test_mode: bool = settings.BANCARD_TEST_MODE
-        if self.is_test_mode:
+    """Client of the vPOS API for one merchant (Bancard commerce).
+
+    :param merchant: name of the merchant.
+    :param config: merchant settings, see `GatewayRegistry`. Defaults to the
+    `BANCARD_*` settings.
+    :param audit_log: audit log shared with other gateways. A new one is
+    created if not set.
+    """
+
+    def __init__(
+        self,
+        merchant: str = DEFAULT_MERCHANT,
+        config: Optional[Dict[str, Any]] = None,
+        audit_log: Optional[AuditLog] = None,
+    ) -> None:
+        config = config or {}
+        self.merchant = merchant
+        self.is_test_mode: bool = config.get("TEST_MODE", settings.BANCARD_TEST_MODE)
+        if config:
+            self.pub_key: str = config["PUBLIC_KEY"]
+            self.priv_key: str = config["PRIVATE_KEY"]
+        elif self.is_test_mode:
             self.pub_key: str = settings.BANCARD_TEST_PUBLIC_KEY
             self.priv_key: str = settings.BANCARD_TEST_PRIVATE_KEY
-            self.base_url = "https://vpos.infonet.com.py:8888/vpos/api/0.3"
         else:
             self.pub_key: str = settings.BANCARD_PUBLIC_KEY
             self.priv_key: str = settings.BANCARD_PRIVATE_KEY
+        if self.is_test_mode:
+            self.base_url = "https://vpos.infonet.com.py:8888/vpos/api/0.3"
+        else:
             self.base_url = "https://vpos.infonet.com.py/vpos/api/0.3"
+        # Keeps rate limit buckets of merchants apart in shared caches.
+        self.namespace = "vpos" if merchant == DEFAULT_MERCHANT else f"vpos:{merchant}"
+        self.rate_limiter = RateLimiter(
+            config.get("RATE_LIMIT", getattr(settings, "BANCARD_RATE_LIMIT", {})),
+            namespace=self.namespace,
+        )
+        self.hedger = Hedger(getattr(settings, "BANCARD_HEDGING", {}))
+        self.audit_log = audit_log or AuditLog(getattr(settings, "BANCARD_AUDIT", {}))
+        self.transport = get_transport(
+            self, config.get("TRANSPORT", getattr(settings, "BANCARD_TRANSPORT", {}))
+        )
+        self.lanes = {
+            name: Lane(self, name, config)
+            for name, config in getattr(settings, "BANCARD_LANES", {}).items()
+        }
+        # Workers warming up connections aren't ready until they finish.
+        self.is_ready = not getattr(settings, "BANCARD_WARMUP", None)
+        self.last_error: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+
+    def _record_error(self, endpoint: str, error: str) -> None:
+        metrics.increment(f"gateway.{endpoint}.errors")
+        with self._lock:
+            self.last_error = {"endpoint": endpoint, "error": error, "at": time.time()}
+
+    def get_latency(self, endpoint: str, p: float) -> Optional[float]:
+        """Returns the `p` (0-100) percentile of recent response times of
+        `endpoint`, in seconds, or `None` if it wasn't requested yet.
+
+        :param endpoint: vPOS API path, with numeric segments as `{id}`.
+        """
+        return metrics.percentile(f"gateway.{endpoint}.seconds", p)
+
+    def has_time_for(self, *endpoints: str) -> bool:
+        """Returns whether the current deadline leaves enough time for one
+        request to each of `endpoints`, going by their median response times.
+        Always `True` without a deadline.
+        """
+        left = deadlines.remaining()
+        if left is None:
+            return True
+        return left > sum(self.get_latency(e, 50) or 0.0 for e in endpoints)
+
+    def check_deadline(self, *endpoints: str) -> None:
+        """Raises `DeadlineExceeded` unless the current deadline leaves time for
+        requests to `endpoints`, see `has_time_for`.
+        """
+        if not self.has_time_for(*endpoints):
+            metrics.increment("gateway.deadline_exceeded")
+            raise DeadlineExceeded(
+                f"No time left for {', '.join(endpoints)}."
+                if endpoints
+                else "Deadline exceeded."
+            )
+
+    def warm_up(
+        self, connections: Optional[int] = None, timeout: Optional[float] = None
+    ) -> None:
+        """Opens transport connections ahead of the first request, so it
+        doesn't pay for DNS, TCP and TLS setup, then marks the gateway ready.
+
+        :param connections: number of connections to open. Defaults to
+        `BANCARD_WARMUP["CONNECTIONS"]` or 1.
+        :param timeout: max. seconds to wait for each connection.
+        """
+        config = getattr(settings, "BANCARD_WARMUP", None) or {}
+        transports = [self.transport] + [
+            lane.transport for lane in self.lanes.values() if lane.transport
+        ]
+        try:
+            for transport in transports:
+                transport.warm_up(
+                    connections or config.get("CONNECTIONS", 1),
+                    timeout or config.get("TIMEOUT", 5),
+                )
+        except requests.RequestException as e:
+            self._record_error("warm_up", str(e))
+        finally:
+            self.is_ready = True
+
+    def probe(self, timeout: float = 2.0) -> Optional[float]:
+        """Checks that vPOS can be reached without calling any operation.
+
+        :returns: seconds the check took, or `None` if vPOS can't be reached.
+        """
+        start = time.perf_counter()
+        try:
+            self.transport.probe(timeout)
+        except requests.RequestException as e:
+            self._record_error("probe", str(e))
+            return
+        return time.perf_counter() - start
+
+    def get_health(self) -> Dict[str, Any]:
+        """Returns readiness, the last error and recent response time
+        percentiles and error counts per vPOS endpoint.
+        """
+        snapshot = metrics.snapshot("gateway.")
+        endpoints = {}
+        for name, summary in snapshot["histograms"].items():
+            endpoint = name[len("gateway.") : -len(".seconds")]
+            endpoints[endpoint] = {
+                key: summary[key] for key in ("count", "p50", "p95", "p99")
+            }
+        for name, count in snapshot["counters"].items():
+            if not name.endswith(".errors"):
+                continue
+            endpoint = name[len("gateway.") : -len(".errors")]
+            endpoints.setdefault(endpoint, {"count": 0})["errors"] = count
+        return {
+            "ready": self.is_ready,
+            "last_error": self.last_error,
+            "endpoints": endpoints,
+            "hedge_rates": self.hedger.get_metrics()["hedge_rates"],
+            "lanes": {
+                name: {
+                    "in_flight": lane.in_flight,
+                    "max_concurrency": lane.max_concurrency,
+                }
+                for name, lane in self.lanes.items()
+            },
+        }
+
+    def _acquire(self, rate_limiter: RateLimiter, path: str) -> None:
+        timeout = deadlines.remaining()
+        if timeout is not None:
+            timeout = min(timeout, rate_limiter.timeout)
+        if not rate_limiter.acquire(path, timeout=timeout):
+            raise RateLimited(f"Rate limit for {path} exceeded.")
+
+    def _send(self, method: str, path: str, data: dict, endpoint: str, transport):
+        # Spent in the rate limiter or waiting for a hedged request.
+        timeout = deadlines.remaining()
+        if timeout == 0:
+            metrics.increment("gateway.deadline_exceeded")
+            raise DeadlineExceeded(f"No time left for {path}.")
+        start = time.perf_counter()
+        status_code, error = None, ""
+        try:
+            res = transport.send(method, path, data, timeout)
+            status_code = res.status_code
+        except requests.RequestException as e:
+            error = str(e)
+            if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                self._record_error(endpoint, error)
+                raise TransientGatewayError(error) from e
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            profiling.record_request(endpoint, seconds)
+            self.audit_log.record(
+                method, path, endpoint, data, status_code, seconds, error
+            )
+        metrics.observe(f"gateway.{endpoint}.seconds", seconds)
+        return res
 
     def perform_request(self, path: str, data: dict, method: str = "POST") -> dict:
-        if method == "POST":
-            res = requests.post(f"{self.base_url}{path}", json=data)
-        elif method == "DELETE":
-            res = requests.delete(f"{self.base_url}{path}", json=data)
-        else:
+        """Sends a request to vPOS.
+
+        Within a deadline (see `bancard.deadlines`), the time left is used as
+        the request timeout and caps the rate limiter wait. The request goes
+        through the current lane (see `bancard.lanes`), if configured.
+
+        :raises RateLimited: if the request would exceed the configured rate limit.
+        :raises TransientGatewayError: if vPOS could not be reached or answered
+        with a temporary error.
+        :raises DeadlineExceeded: if the deadline expired before sending.
+        :raises requests.RequestException: for any other request error.
+        """
+        if deadlines.remaining() == 0:
+            metrics.increment("gateway.deadline_exceeded")
+            raise DeadlineExceeded(f"No time left for {path}.")
+        if method not in ("POST", "DELETE"):
             raise NotImplementedError("Method not implemented.")
+        lane = self.lanes.get(current_lane())
+        endpoint = self.rate_limiter.get_endpoint(path)
+        transport = lane.transport if lane and lane.transport else self.transport
+        send = partial(self._send, method, path, data, endpoint, transport)
+        # Rate tokens are taken once a slot is held, so requests that time out
+        # waiting for a slot don't use up the rate budget.
+        with lane.slot(deadlines.remaining()) if lane else nullcontext():
+            if lane:
+                self._acquire(lane.rate_limiter, path)
+            self._acquire(self.rate_limiter, path)
+            if self.hedger.applies(method, endpoint):
+                res = self.hedger.send(
+                    endpoint, send, partial(self.rate_limiter.acquire, path, False)
+                )
+            else:
+                res = send()
         if res.status_code in (200, 201, 202, 204):
             return res.json()
+        elif res.status_code in TRANSIENT_STATUS_CODES:
+            error = f"vPOS answered {res.status_code} on {path}."
+            self._record_error(endpoint, error)
+            raise TransientGatewayError(error)
         else:
             res.raise_for_status()
 
@@ -69,7 +294,7 @@ class BancardGateway:
             res = self.perform_request("/cards/new", data)
             if res.get("status") == "success":
                 return res.get("process_id")
-        except requests.RequestException:
+        except (requests.RequestException, TransientGatewayError):
             # TODO better error handling
             pass
 
@@ -101,7 +326,7 @@ class BancardGateway:
                         }
                     )
                 return card_list
-        except requests.RequestException:
+        except (requests.RequestException, TransientGatewayError):
             # TODO Better error handling
             pass
 
@@ -138,7 +363,7 @@ class BancardGateway:
             res = self.perform_request(f"/users/{user_id}/cards", data, method="DELETE")
             if res.get("status") == "success":
                 return True
-        except requests.RequestException:
+        except (requests.RequestException, TransientGatewayError):
             # TODO Better error handling
             return False
 
@@ -189,27 +414,33 @@ class BancardGateway:
         description: str,
         installments: Optional[int] = None,
         additional_data: Optional[str] = None,
+        card_token: Optional[str] = None,
     ) -> Optional[Dict[str, Any]]:
         """Attempts to capture a payment.
 
+        Sets the operation token on `tx`; saving it is left to the caller.
+
         :param user_id: ID of user making payment.
         :param card_id: ID of card to be used for payment.
-        :param tx_id: ID of current transaction.
+        :param tx: current transaction.
         :param amount: amount to capture.
         :param description: capture description that will be shown to user.
         :param installments: no. of installments for payment (only for credit).
         :param additional_data: additional data to be sent (reserved for future use).
+        :param card_token: alias token of the card, if already known. Saves a
+        card lookup in vPOS.
+        :raises TransientGatewayError: if the charge outcome is unknown.
         """
-        card = self.get_user_card(user_id, card_id)
-        if not card:
-            return
-        card_token = card["token"]
+        if not card_token:
+            card = self.get_user_card(user_id, card_id)
+            if not card:
+                return
+            card_token = card["token"]
         amount_str = "{:.2f}".format(amount)
         token = hashlib.md5(
             f"{self.priv_key}{tx.id}charge{amount_str}PYG{card_token}".encode()
         ).hexdigest()
         tx.token = token
-        tx.save()
         data = {
             "public_key": self.pub_key,
             "operation": {
@@ -290,13 +521,14 @@ class BancardGateway:
             res = self.perform_request("/single_buy", data)
             if res.get("status") == "success":
                 return res.get("process_id")
-        except requests.RequestException:
+        except (requests.RequestException, TransientGatewayError):
             pass
 
     def get_single_buy_confirmation(self, tx_id: int) -> Optional[Dict[str, Any]]:
         """Gets transaction status.
 
         :param tx_id: ID of transaction to confirm.
+        :raises TransientGatewayError: if vPOS could not be reached.
         """
         token = hashlib.md5(
             f"{self.priv_key}{tx_id}get_confirmation".encode()
@@ -319,6 +551,7 @@ class BancardGateway:
 
         :param tx_id: ID of transaction on which rollback will be performed.
         :returns: Boolean indicating rollback status and vPOS response.
+        :raises TransientGatewayError: if the rollback outcome is unknown.
         """
         token = hashlib.md5(f"{self.priv_key}{tx_id}rollback0.00".encode()).hexdigest()
         data = {
@@ -342,19 +575,104 @@ class BancardGateway:
             return
         except Transaction.DoesNotExist:
             return
-        if tx.card and tx.token != data.get("operation").get("token"):
-            return
-        else:
-            amount = data.get("operation").get("amount")
-            currency = data.get("operation").get("currency")
-            string = f"{self.priv_key}{shop_process_id}confirm{amount}{currency}"
-            token = hashlib.md5(string.encode()).hexdigest()
-            if not hasattr(tx, "card") and token != data.get("operation").get("token"):
+        return self.verify_callback(data, tx)
+
+    def has_confirmation_token(self, data: dict) -> bool:
+        """Checks the token of a single buy confirmation, without any DB access.
+
+        :param data: data sent by Bancard.
+        """
+        operation = data["operation"]
+        string = (
+            f"{self.priv_key}{operation['shop_process_id']}confirm"
+            f"{operation.get('amount')}{operation.get('currency')}"
+        )
+        token = hashlib.md5(string.encode()).hexdigest()
+        return hmac.compare_digest(token, str(operation.get("token")))
+
+    def verify_callback(self, data: dict, tx: Transaction):
+        """Checks that callback data was sent by vPOS for `tx` and returns the
+        processed transaction response.
+
+        Card charges must carry the token sent with the charge, single buys a
+        confirmation token signed with the private key.
+
+        :param data: data sent by Bancard.
+        :param tx: transaction the callback refers to.
+        """
+        if tx.card_id:
+            if not hmac.compare_digest(
+                str(tx.token), str(data["operation"].get("token"))
+            ):
                 return
+        elif not self.has_confirmation_token(data):
+            return
         return self._process_transaction_response(data)
 
 
+class GatewayRegistry:
+    """Gateways of every merchant, created on first use.
+
+    The default merchant uses the `BANCARD_*` settings. Other merchants are
+    configured with the `BANCARD_MERCHANTS` setting::
+
+        BANCARD_MERCHANTS = {
+            "store-2": {
+                "PUBLIC_KEY": "...",
+                "PRIVATE_KEY": "...",
+                "TEST_MODE": False,  # defaults to BANCARD_TEST_MODE
+                # default to BANCARD_TRANSPORT and BANCARD_RATE_LIMIT
+                "TRANSPORT": {"OPTIONS": {"pool_size": 5}},
+                "RATE_LIMIT": {"ENDPOINTS": {"*": {"rate": 10}}},
+            },
+        }
+
+    Each merchant gets its own connection pool, rate limit buckets and lanes.
+    """
+
+    def __init__(self, default: BancardGateway) -> None:
+        self.default = default
+        self._gateways = {DEFAULT_MERCHANT: default}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_merchants() -> List[str]:
+        return [DEFAULT_MERCHANT] + [
+            merchant
+            for merchant in getattr(settings, "BANCARD_MERCHANTS", {})
+            if merchant != DEFAULT_MERCHANT
+        ]
+
+    def get(self, merchant: Optional[str] = None) -> BancardGateway:
+        """Returns the gateway of `merchant`, or the default one.
+
+        :raises ImproperlyConfigured: if the merchant isn't configured.
+        """
+        merchant = merchant or DEFAULT_MERCHANT
+        gateway = self._gateways.get(merchant)
+        if gateway:
+            return gateway
+        config = getattr(settings, "BANCARD_MERCHANTS", {}).get(merchant)
+        if not config:
+            raise ImproperlyConfigured(f"Unknown Bancard merchant: {merchant}.")
+        with self._lock:
+            if merchant not in self._gateways:
+                self._gateways[merchant] = BancardGateway(
+                    merchant, config, self.default.audit_log
+                )
+            return self._gateways[merchant]
+
+    def all(self) -> List[BancardGateway]:
+        return [self.get(merchant) for merchant in self.get_merchants()]
+
+
 bancard = BancardGateway()
+gateways = GatewayRegistry(bancard)
+
+
+def get_gateway(merchant: Optional[str] = None) -> BancardGateway:
+    """Returns the gateway of `merchant`, see `GatewayRegistry.get`."""
+    return gateways.get(merchant)
 
 
-__all__ = ["bancard"]
+__all__ = ["bancard", "gateways", "get_gateway"]
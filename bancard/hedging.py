@@ -0,0 +1,181 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+
+from .metrics import metrics
+
+T = TypeVar("T")
+
+# vPOS endpoints that only read data, so sending a request twice is harmless.
+IDEMPOTENT_ENDPOINTS = ("/users/{id}/cards", "/single_buy/confirmations")
+
+
+class Hedger:
+    """Sends a second copy of slow requests to idempotent vPOS endpoints and
+    uses whichever answers first.
+
+    Configured with the `BANCARD_HEDGING` setting::
+
+        BANCARD_HEDGING = {
+            "ENDPOINTS": ["/users/{id}/cards", "/single_buy/confirmations"],
+            "PERCENTILE": 95,  # hedge after this percentile of response times
+            "MIN_SAMPLES": 20,  # responses observed before hedging starts
+            "BUDGET": 5,  # max. percentage of requests hedged
+            "MAX_WORKERS": 16,
+        }
+
+    Only POST requests to endpoints in `IDEMPOTENT_ENDPOINTS` are hedged.
+    Requests are not hedged if the setting is missing.
+
+    Once hedging starts, each request is sent from a thread of its own, so
+    the caller can return whichever answer comes first. Only hedges go
+    through the shared executor, and `MAX_WORKERS` caps them alone.
+
+    The budget works like a token bucket: every request adds `BUDGET` / 100
+    tokens, up to 10, and every hedge takes one.
+    """
+
+    def __init__(self, config: Dict[str, Any], namespace: str = "gateway") -> None:
+        self.namespace = namespace
+        self.endpoints = (
+            set(config.get("ENDPOINTS", IDEMPOTENT_ENDPOINTS))
+            & set(IDEMPOTENT_ENDPOINTS)
+            if config
+            else set()
+        )
+        self.percentile = config.get("PERCENTILE", 95)
+        self.min_samples = config.get("MIN_SAMPLES", 20)
+        self.budget_ratio = config.get("BUDGET", 5) / 100
+        self.max_workers = config.get("MAX_WORKERS", 16)
+        self.budget = 0.0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._delays: Dict[str, Tuple[float, Optional[float]]] = {}
+
+    def applies(self, method: str, endpoint: str) -> bool:
+        return method == "POST" and endpoint in self.endpoints
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="bancard-hedging"
+                )
+            return self._executor
+
+    def get_delay(self, endpoint: str) -> Optional[float]:
+        """Returns seconds to wait before hedging, or `None` while there are
+        too few observed responses. Recomputed at most once per second.
+        """
+        now = time.monotonic()
+        computed_at, delay = self._delays.get(endpoint, (0.0, None))
+        if now - computed_at < 1:
+            return delay
+        name = f"{self.namespace}.{endpoint}.seconds"
+        delay = None
+        if metrics.count(name) >= self.min_samples:
+            delay = metrics.percentile(name, self.percentile)
+        self._delays[endpoint] = (now, delay)
+        return delay
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self.budget < 1:
+                return False
+            self.budget -= 1
+            return True
+
+    def _submit(self, func: Callable[[], T]) -> "Future[T]":
+        return self.executor.submit(contextvars.copy_context().run, func)
+
+    @staticmethod
+    def _start(func: Callable[[], T]) -> "Future[T]":
+        """Calls `func` in a new thread, without waiting for an executor
+        worker, so the hedging delay starts when the request is sent.
+        """
+        future: "Future[T]" = Future()
+        context = contextvars.copy_context()
+
+        def run() -> None:
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(context.run(func))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="bancard-request", daemon=True).start()
+        return future
+
+    def send(
+        self, endpoint: str, func: Callable[[], T], admit: Callable[[], bool]
+    ) -> T:
+        """Calls `func`, calling it a second time if it takes longer than the
+        hedging delay, and returns the first successful result.
+
+        :param endpoint: vPOS endpoint the request goes to.
+        :param func: sends the request.
+        :param admit: returns whether an extra request may be sent, e.g.
+        checking rate limits.
+        :raises: the exception of the last failed call if both fail.
+        """
+        prefix = f"hedging.{endpoint}"
+        with self._lock:
+            self.budget = min(10.0, self.budget + self.budget_ratio)
+        metrics.increment(f"{prefix}.requests")
+        delay = self.get_delay(endpoint)
+        if delay is None:
+            return func()
+        primary = self._start(func)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        if not self._take_budget():
+            metrics.increment(f"{prefix}.over_budget")
+            return primary.result()
+        if not admit():
+            return primary.result()
+        metrics.increment(f"{prefix}.hedged")
+        hedge = self._submit(func)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    self._record_win(prefix, primary)
+                return result
+        raise error
+
+    @staticmethod
+    def _record_win(prefix: str, primary: Future) -> None:
+        metrics.increment(f"{prefix}.hedge_wins")
+        won_at = time.perf_counter()
+        # How much longer the caller would have waited for the first request.
+        primary.add_done_callback(
+            lambda _: metrics.observe(
+                f"{prefix}.saved_seconds", time.perf_counter() - won_at
+            )
+        )
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Returns hedging counters and savings per endpoint, with the share of
+        requests that were hedged.
+        """
+        snapshot = metrics.snapshot("hedging.")
+        snapshot["hedge_rates"] = {
+            name[: -len(".requests")]: snapshot["counters"].get(
+                name[: -len(".requests")] + ".hedged", 0
+            )
+            / requests
+            for name, requests in snapshot["counters"].items()
+            if name.endswith(".requests") and requests
+        }
+        return snapshot
@@ -1,13 +1,30 @@
 from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
-from typing import Optional
+from typing import Optional, List
 
 
-@dataclass
-class BancardCard:
+class _Slotted:
+    """Pickling support for frozen dataclasses that declare `__slots__`
+    (not provided by the standard library before Python 3.10).
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+
+@dataclass(frozen=True)
+class BancardCard(_Slotted):
     """Represents a Credit/Debit card registered using Bancard vPOS."""
 
+    __slots__ = ("id", "last4", "exp_year", "exp_month", "brand", "type", "is_default")
+
     id: int
     last4: str
     exp_year: int
@@ -17,20 +34,32 @@ class BancardCard:
     is_default: bool
 
 
-@dataclass
-class PrivateChargeResponse:
+@dataclass(frozen=True)
+class PrivateChargeResponse(_Slotted):
     """Holds information sent from Bancard vPOS that should not be shown
     to the customer.
     """
 
+    __slots__ = ("authorization_code", "risk_index")
+
     authorization_code: str
     risk_index: str
 
 
-@dataclass
-class ChargeResponse:
+@dataclass(frozen=True)
+class ChargeResponse(_Slotted):
     """Holds information about the ongoing transaction."""
 
+    __slots__ = (
+        "payment_id",
+        "tx_id",
+        "amount",
+        "status",
+        "response_description",
+        "tx_datetime",
+        "private_data",
+    )
+
     payment_id: Optional[int]
     tx_id: int
     amount: Decimal
@@ -38,3 +67,66 @@ class ChargeResponse:
     response_description: Optional[str]
     tx_datetime: datetime
     private_data: Optional[PrivateChargeResponse]
+
+
+@dataclass(frozen=True)
+class BulkReversionResult(_Slotted):
+    """Outcome of a bulk reverse operation. All lists hold transaction IDs."""
+
+    __slots__ = (
+        "reversed",
+        "failed",
+        "queued",
+        "ineligible",
+        "estimated_seconds",
+        "seconds_to_deadline",
+        "elapsed_seconds",
+    )
+
+    reversed: List[int]
+    failed: List[int]
+    queued: List[int]
+    ineligible: List[int]
+    estimated_seconds: float
+    seconds_to_deadline: float
+    elapsed_seconds: float
+
+
+@dataclass(frozen=True)
+class BulkReversionEstimate(_Slotted):
+    """What a bulk reverse operation would do, computed before sending any
+    rollback. All lists hold transaction IDs.
+    """
+
+    __slots__ = (
+        "eligible",
+        "expired",
+        "ineligible",
+        "estimated_seconds",
+        "seconds_to_deadline",
+    )
+
+    eligible: List[int]
+    expired: List[int]
+    ineligible: List[int]
+    estimated_seconds: float
+    seconds_to_deadline: float
+
+    @property
+    def exceeds_deadline(self) -> bool:
+        """Whether the rollbacks are expected to take longer than the time
+        left to send them.
+        """
+        return self.estimated_seconds > self.seconds_to_deadline
+
+
+@dataclass(frozen=True)
+class TransactionPage(_Slotted):
+    """A page of transactions, newest first. Pass `next_cursor` to get the
+    following page; it is `None` on the last one.
+    """
+
+    __slots__ = ("items", "next_cursor")
+
+    items: List[ChargeResponse]
+    next_cursor: Optional[str]
@@ -0,0 +1,288 @@
+"""Batch maintenance jobs, meant to be run periodically from management
+commands or task queues. Their vPOS requests go through the `low` priority
+lane unless the caller picked one, see `bancard.lanes`.
+"""
+
+import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef
+from django.utils import timezone
+
+from .exceptions import TransientGatewayError
+from .gateway import get_gateway
+from .lanes import LOW, default_lane
+from .models import Card, OutboxEntry, Transaction
+from .operations import UPDATE_FIELDS, _make_charge_response, _update_transaction
+from .signals import send_transaction_updated
+from .utils import run_concurrently
+
+# Card fields mirrored from vPOS.
+CARD_METADATA_FIELDS = ("last4", "exp_year", "exp_month", "brand", "type")
+
+
+def reassign_default_cards(user_ids: Iterable[int]) -> int:
+    """Makes the newest active, not expired card the default card of users
+    that have none, for each merchant they have cards with.
+
+    :param user_ids: IDs of users to check.
+    :returns: number of default cards set.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return 0
+    with_default = set(
+        Card.objects.filter(user_id__in=user_ids, is_default=True).values_list(
+            "user_id", "merchant"
+        )
+    )
+    card_ids = [
+        last_id
+        for user_id, merchant, last_id in Card.objects.filter(
+            user_id__in=user_ids, is_active=True
+        )
+        .exclude(pk__in=Card.objects.expired())
+        .values("user_id", "merchant")
+        .annotate(last_id=Max("id"))
+        .values_list("user_id", "merchant", "last_id")
+        if (user_id, merchant) not in with_default
+    ]
+    if not card_ids:
+        return 0
+    return Card.objects.filter(id__in=card_ids).update(
+        is_default=True, updated_at=timezone.now()
+    )
+
+
+def deactivate_expired_cards(
+    batch_size: int = 500, today: Optional[datetime.date] = None
+) -> int:
+    """Deactivates active cards whose expiration date has passed, in batches,
+    and reassigns default cards of their users.
+
+    :param batch_size: number of cards updated per query.
+    :param today: date to check expiration against. Defaults to today.
+    :returns: number of deactivated cards.
+    """
+    expired = Card.objects.filter(is_active=True).expired(today).order_by("id")
+    total = 0
+    while True:
+        batch = list(expired.values_list("id", "user_id", "is_default")[:batch_size])
+        if not batch:
+            return total
+        with transaction.atomic():
+            Card.objects.filter(id__in=[card_id for card_id, _, _ in batch]).update(
+                is_active=False, is_default=False, updated_at=timezone.now()
+            )
+            reassign_default_cards(
+                user_id for _, user_id, is_default in batch if is_default
+            )
+        total += len(batch)
+
+
+@default_lane(LOW)
+def sync_cards(
+    user_ids: Optional[Iterable[int]] = None,
+    batch_size: int = 100,
+    max_concurrency: int = 8,
+    placeholder_ttl: datetime.timedelta = datetime.timedelta(days=1),
+) -> Dict[str, int]:
+    """Synchronizes local cards with the cards registered in vPOS.
+
+    Users are processed in batches and their vPOS cards fetched concurrently,
+    from every merchant they have cards with.
+    Card metadata is updated, cards missing in vPOS are deactivated and
+    unconfirmed placeholders older than `placeholder_ttl` are deleted. Users
+    whose cards could not be fetched, e.g. from merchants removed from the
+    settings, are left untouched. Placeholders found
+    in vPOS are left to `operations.confirm_card_registration`, which looks
+    them up by being inactive.
+
+    :param user_ids: IDs of users to synchronize. Defaults to all users with cards.
+    :param batch_size: number of users processed at once.
+    :param max_concurrency: max. number of simultaneous vPOS requests.
+    :param placeholder_ttl: age after which unconfirmed cards missing in vPOS
+    are deleted.
+    :returns: counts of processed users, users that couldn't be fetched and
+    updated, deactivated and deleted cards.
+    """
+    users = (
+        Card.objects.filter(user__isnull=False)
+        .values_list("user_id", flat=True)
+        .distinct()
+        .order_by("user_id")
+    )
+    if user_ids is not None:
+        users = users.filter(user_id__in=list(user_ids))
+    stats = dict.fromkeys(
+        ("users", "failed_users", "updated", "deactivated", "deleted"), 0
+    )
+    last_user_id = None
+    while True:
+        batch = users.filter(user_id__gt=last_user_id) if last_user_id else users
+        batch = list(batch[:batch_size])
+        if not batch:
+            return stats
+        last_user_id = batch[-1]
+        cards = list(Card.objects.filter(user_id__in=batch))
+        keys = sorted({(card.user_id, card.merchant) for card in cards})
+        remote = dict(
+            zip(
+                keys,
+                run_concurrently(_get_user_cards, keys, max_concurrency),
+            )
+        )
+        now = timezone.now()
+        updated, deleted = [], []
+        for card in cards:
+            remote_cards = remote[card.user_id, card.merchant]
+            if remote_cards is None:
+                continue
+            remote_card = next((c for c in remote_cards if c["id"] == card.id), None)
+            if remote_card:
+                if not card.is_active and not card.exp_year:
+                    # Registered in vPOS, confirmation may be in progress.
+                    continue
+                if any(
+                    getattr(card, field) != remote_card[field]
+                    for field in CARD_METADATA_FIELDS
+                ):
+                    for field in CARD_METADATA_FIELDS:
+                        setattr(card, field, remote_card[field])
+                    card.updated_at = now
+                    updated.append(card)
+                    stats["updated"] += 1
+            elif card.is_active:
+                card.is_active = False
+                card.is_default = False
+                card.updated_at = now
+                updated.append(card)
+                stats["deactivated"] += 1
+            elif not card.exp_year and card.created_at < now - placeholder_ttl:
+                # Placeholders never confirmed. Confirmed cards are only
+                # deactivated, transactions still refer to them.
+                deleted.append(card.id)
+        with transaction.atomic():
+            Card.objects.bulk_update(
+                updated,
+                CARD_METADATA_FIELDS + ("is_active", "is_default", "updated_at"),
+            )
+            stats["deleted"] += (
+                Card.objects.filter(id__in=deleted).delete()[1].get(Card._meta.label, 0)
+            )
+            reassign_default_cards(card.user_id for card in updated)
+        stats["users"] += len(batch)
+        stats["failed_users"] += len(
+            {user_id for (user_id, _), cards in remote.items() if cards is None}
+        )
+
+
+def _get_user_cards(key: Tuple[int, str]) -> Optional[List[Dict[str, Any]]]:
+    user_id, merchant = key
+    try:
+        return get_gateway(merchant).get_user_cards(user_id)
+    except ImproperlyConfigured:
+        # The merchant was removed from the settings.
+        return None
+
+
+def _get_confirmation(tx: Transaction) -> Optional[dict]:
+    try:
+        return get_gateway(tx.merchant).get_single_buy_confirmation(tx.id)
+    except (TransientGatewayError, ImproperlyConfigured):
+        return None
+
+
+@default_lane(LOW)
+def expire_pending_transactions(
+    max_concurrency: int = 8, now: Optional[datetime.datetime] = None
+) -> Dict[str, int]:
+    """Marks transactions pending for longer than the configured TTL as
+    expired, typically checkouts abandoned after `init_single_buy`.
+
+    Configured with the `BANCARD_PENDING_EXPIRY` setting::
+
+        BANCARD_PENDING_EXPIRY = {
+            "TTL": 86400,  # seconds a transaction may stay pending
+            "VERIFY_WINDOW": 3600,  # seconds after the TTL during which vPOS is asked
+            "BATCH_SIZE": 500,  # rows per UPDATE
+        }
+
+    Transactions that expired less than `VERIFY_WINDOW` seconds ago are
+    confirmed with vPOS first, so payments whose callback got lost are
+    recorded instead of expired; those vPOS can't answer for are left pending
+    until the next run. Older ones are expired without asking vPOS, so the job
+    should run more often than `VERIFY_WINDOW`. Transactions with pending
+    outbox entries are left to the outbox worker.
+
+    :param max_concurrency: max. number of simultaneous vPOS requests.
+    :param now: current time. Defaults to now.
+    :returns: counts of expired, confirmed (updated from vPOS) and skipped
+    transactions.
+    """
+    config = getattr(settings, "BANCARD_PENDING_EXPIRY", {})
+    batch_size = config.get("BATCH_SIZE", 500)
+    now = now or timezone.now()
+    cutoff = now - datetime.timedelta(seconds=config.get("TTL", 86400))
+    verify_after = cutoff - datetime.timedelta(
+        seconds=config.get("VERIFY_WINDOW", 3600)
+    )
+    stale = (
+        Transaction.objects.filter(status=Transaction.PENDING, created_at__lt=cutoff)
+        .exclude(
+            Exists(
+                OutboxEntry.objects.filter(
+                    transaction=OuterRef("pk"), status=OutboxEntry.PENDING
+                )
+            )
+        )
+        .order_by("id")
+    )
+    stats = dict.fromkeys(("expired", "confirmed", "skipped"), 0)
+
+    def expire(tx_ids) -> None:
+        # Callbacks may have resolved some of them in the meantime.
+        stats["expired"] += Transaction.objects.filter(
+            id__in=tx_ids, status=Transaction.PENDING
+        ).update(status=Transaction.EXPIRED, updated_at=timezone.now())
+
+    while True:
+        batch = list(
+            stale.filter(created_at__lt=verify_after).values_list("id", flat=True)[
+                :batch_size
+            ]
+        )
+        if not batch:
+            break
+        expire(batch)
+
+    last_id = 0
+    while True:
+        batch = list(
+            stale.filter(created_at__gte=verify_after, id__gt=last_id).defer(
+                "raw_response"
+            )[:batch_size]
+        )
+        if not batch:
+            return stats
+        last_id = batch[-1].id
+        responses = run_concurrently(_get_confirmation, batch, max_concurrency)
+        unconfirmed = []
+        for tx, gw_response in zip(batch, responses):
+            if gw_response is None:
+                stats["skipped"] += 1
+            elif gw_response.get("tx_id") is None:
+                # vPOS has no confirmation, the buy was never completed.
+                unconfirmed.append(tx.id)
+            else:
+                _update_transaction(tx, gw_response)
+                tx.save(update_fields=UPDATE_FIELDS)
+                stats["confirmed"] += 1
+                send_transaction_updated(
+                    sender=expire_pending_transactions,
+                    response=_make_charge_response(tx),
+                )
+        expire(unconfirmed)
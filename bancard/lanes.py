@@ -0,0 +1,131 @@
+"""Priority lanes separating interactive and batch vPOS traffic.
+
+Requests go through the lane of the context they are sent from. Operations
+default to the `high` lane and batch jobs to the `low` lane; callers can pick
+one explicitly, e.g. for an urgent refund run::
+
+    with lane(HIGH):
+        operations.reverse_bulk(tx_ids)
+
+Lanes are configured with the `BANCARD_LANES` setting, see `Lane`. Lanes
+that are not configured are not limited.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+from .exceptions import RateLimited
+from .metrics import metrics
+from .models import DEFAULT_MERCHANT
+from .ratelimit import RateLimiter
+from .transports import get_transport
+
+HIGH = "high"
+LOW = "low"
+
+_current: ContextVar[Optional[str]] = ContextVar("bancard_lane", default=None)
+
+
+def current_lane() -> str:
+    """Returns the name of the lane requests are currently sent through."""
+    return _current.get() or HIGH
+
+
+@contextmanager
+def lane(name: str) -> Iterator[None]:
+    """Sends vPOS requests made inside the block through lane `name`.
+    Also usable as a decorator.
+    """
+    token = _current.set(name)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def default_lane(name: str) -> Iterator[None]:
+    """Like `lane`, unless the caller already picked a lane."""
+    if _current.get() is not None:
+        yield
+        return
+    with lane(name):
+        yield
+
+
+class Lane:
+    """Concurrency limit, rate budget and optionally a transport of its own
+    for the requests sent through a lane::
+
+        BANCARD_LANES = {
+            "high": {"MAX_CONCURRENCY": 20},
+            "low": {
+                "MAX_CONCURRENCY": 4,
+                "TIMEOUT": 30,  # max. seconds a request waits for a free slot
+                # checked before BANCARD_RATE_LIMIT, same format
+                "RATE_LIMIT": {"ENDPOINTS": {"*": {"rate": 5}}},
+                # same format as BANCARD_TRANSPORT, e.g. a smaller pool
+                "TRANSPORT": {"OPTIONS": {"pool_size": 4}},
+            },
+        }
+
+    The low lane can't use more than its own budget, so whatever is left of
+    the `BANCARD_RATE_LIMIT` buckets and the gateway connection pool is
+    reserved for the high lane. Requests that can't get a slot in time raise
+    `RateLimited`. Metrics are named `lanes.<name>.*`, or
+    `lanes.<merchant>.<name>.*` for merchants other than the default one.
+    """
+
+    def __init__(self, gateway, name: str, config: Dict[str, Any]) -> None:
+        self.name = name
+        self.metrics_prefix = (
+            f"lanes.{name}"
+            if gateway.merchant == DEFAULT_MERCHANT
+            else f"lanes.{gateway.merchant}.{name}"
+        )
+        self.max_concurrency = config.get("MAX_CONCURRENCY")
+        self.timeout = config.get("TIMEOUT", 5)
+        self.rate_limiter = RateLimiter(
+            config.get("RATE_LIMIT", {}), namespace=f"{gateway.namespace}:{name}"
+        )
+        self.transport = (
+            get_transport(gateway, config["TRANSPORT"])
+            if "TRANSPORT" in config
+            else None
+        )
+        self.in_flight = 0
+        self._semaphore = (
+            threading.BoundedSemaphore(self.max_concurrency)
+            if self.max_concurrency
+            else None
+        )
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, timeout: Optional[float] = None) -> Iterator[None]:
+        """Holds one of the lane's concurrent request slots.
+
+        :param timeout: max. seconds to wait. Defaults to the configured timeout.
+        :raises RateLimited: if no slot became free in time.
+        """
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        if self._semaphore:
+            start = time.perf_counter()
+            if not self._semaphore.acquire(timeout=timeout):
+                metrics.increment(f"{self.metrics_prefix}.rejected")
+                raise RateLimited(f"No free slot in lane {self.name}.")
+            metrics.observe(
+                f"{self.metrics_prefix}.wait_seconds", time.perf_counter() - start
+            )
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            if self._semaphore:
+                self._semaphore.release()
@@ -0,0 +1,238 @@
+import statistics
+import threading
+import time
+import tracemalloc
+from decimal import Decimal
+from typing import Callable, Dict, Any, List
+
+import requests
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.db import transaction
+from django.urls import reverse
+
+from bancard import operations
+from bancard.gateway import bancard
+from bancard.interface import BancardCard
+from bancard.models import Card, Transaction
+from bancard.transports import FakeTransport
+from bancard.utils import run_concurrently
+
+from .bancard_loadtest import QuietRequestHandler
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(func: Callable[[], Any], iterations: int) -> Dict[str, float]:
+    """Runs `func` `iterations` times and returns latency and allocation stats."""
+    func()  # warm up
+    timings: List[float] = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    blocks = sum(
+        stat.count for stat in tracemalloc.take_snapshot().statistics("filename")
+    )
+    tracemalloc.stop()
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings),
+        "p99_ms": timings[int(len(timings) * 0.99) - 1],
+        "peak_kb": peak / 1024,
+        "live_blocks": blocks,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks bancard read paths and callback handling on synthetic data. "
+        "Read path data is created inside a transaction that is rolled back at "
+        "the end; callback data is deleted at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "scenario",
+            choices=["cards", "status", "callbacks"],
+            help="Read path or callback view to benchmark.",
+        )
+        parser.add_argument("--size", type=int, default=300)
+        parser.add_argument("--iterations", type=int, default=50)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=50,
+            help="Simultaneous callbacks in the callbacks scenario.",
+        )
+        parser.add_argument(
+            "--url",
+            help="Callback URL of an already running WSGI server. Defaults to "
+            "an in-process server.",
+        )
+        parser.add_argument(
+            "--async-url",
+            help="Async callback URL of a running ASGI server, e.g. uvicorn. "
+            "async_callback_view is skipped otherwise.",
+        )
+        parser.add_argument(
+            "--user-id",
+            type=int,
+            help="Existing user to attach synthetic data to. A user is created "
+            "otherwise.",
+        )
+
+    def handle(self, *args, **options):
+        if options["scenario"] == "callbacks":
+            # Concurrent requests use their own connections and must see the data.
+            self.bench_callbacks(**options)
+            return
+        try:
+            with transaction.atomic():
+                getattr(self, f"bench_{options['scenario']}")(**options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def get_user_id(self, user_id=None) -> int:
+        if user_id:
+            return user_id
+        user_model = get_user_model()
+        user = user_model._default_manager.create(
+            **{user_model.USERNAME_FIELD: "bancard-benchmark"}
+        )
+        return user.pk
+
+    def report(self, name: str, results: Dict[str, float]) -> None:
+        self.stdout.write(
+            "{:<28} p50={p50_ms:8.3f}ms p99={p99_ms:8.3f}ms "
+            "peak={peak_kb:9.1f}KiB blocks={live_blocks}".format(name, **results)
+        )
+
+    def bench_cards(self, size: int, iterations: int, user_id=None, **kwargs):
+        user_id = self.get_user_id(user_id)
+        Card.objects.bulk_create(
+            Card(
+                user_id=user_id,
+                last4=f"{i:04d}"[-4:],
+                exp_year=30,
+                exp_month=i % 12 + 1,
+                brand="Visa",
+                type="credit",
+                is_active=True,
+                is_default=i == 0,
+            )
+            for i in range(size)
+        )
+
+        def model_instances():
+            cards = Card.objects.filter(user__id=user_id, is_active=True)
+            return [BancardCard(**card.to_dict()) for card in cards]
+
+        self.stdout.write(f"get_cards() with {size} cards:")
+        self.report("model instances (baseline)", measure(model_instances, iterations))
+        self.report(
+            "values_list",
+            measure(lambda: operations.get_cards(user_id), iterations),
+        )
+
+    def bench_status(self, size: int, iterations: int, **kwargs):
+        raw_response = {
+            "operation": {
+                "response_description": "Transaccion aprobada",
+                "extended_response_description": "x" * 2000,
+                "security_information": {"customer_ip": "127.0.0.1"},
+            }
+        }
+        Transaction.objects.bulk_create(
+            Transaction(
+                amount=Decimal("1000.00"),
+                status=Transaction.SUCCESS,
+                raw_response=raw_response,
+            )
+            for _ in range(size)
+        )
+        tx_ids = list(Transaction.objects.values_list("id", flat=True)[:size])
+
+        def status_lookups():
+            for tx_id in tx_ids:
+                operations.get_transaction_status(None, tx_id)
+
+        def full_row_lookups():
+            for tx_id in tx_ids:
+                operations._make_charge_response(Transaction.objects.get(id=tx_id))
+
+        self.stdout.write(f"get_transaction_status() on {size} wide transactions:")
+        self.report(
+            "full row lookups (baseline)", measure(full_row_lookups, iterations)
+        )
+        self.report("get_transaction_status", measure(status_lookups, iterations))
+
+    def bench_callbacks(
+        self, size: int, concurrency: int, url=None, async_url=None, **kwargs
+    ):
+        fake = FakeTransport(bancard)
+        transactions = Transaction.objects.bulk_create(
+            Transaction(amount=Decimal("1000.00")) for _ in range(size * 2)
+        )
+        if transactions[0].pk is None:
+            transactions = Transaction.objects.order_by("-id")[: size * 2][::-1]
+        payloads = [fake.callback_payload(tx.id, "1000.00") for tx in transactions]
+        server = None
+        if not url:
+            server = ThreadedWSGIServer(("127.0.0.1", 0), QuietRequestHandler)
+            server.set_app(WSGIHandler())
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = "http://127.0.0.1:{}{}".format(
+                server.server_address[1], reverse("bancard_callback")
+            )
+        try:
+            self.stdout.write(
+                f"{size} callbacks with {concurrency} concurrent requests:"
+            )
+            self.report_throughput(
+                "callback_view (WSGI)", *self.post(url, payloads[:size], concurrency)
+            )
+            if async_url:
+                self.report_throughput(
+                    "async_callback_view (ASGI)",
+                    *self.post(async_url, payloads[size:], concurrency),
+                )
+            else:
+                self.stdout.write(
+                    "async_callback_view skipped, pass --async-url of an ASGI server."
+                )
+        finally:
+            if server:
+                server.shutdown()
+            Transaction.objects.filter(id__in=[tx.id for tx in transactions]).delete()
+
+    def post(self, url: str, payloads: List[dict], concurrency: int):
+        """Posts the payloads over HTTP from `concurrency` threads, each with
+        its own keep-alive session, and returns the elapsed time and statuses.
+        """
+        local = threading.local()
+
+        def post(payload: dict) -> int:
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            return local.session.post(url, json=payload).status_code
+
+        start = time.perf_counter()
+        statuses = run_concurrently(post, payloads, concurrency)
+        return time.perf_counter() - start, statuses
+
+    def report_throughput(self, name: str, elapsed: float, statuses: List[int]):
+        errors = sum(1 for status in statuses if status != 200)
+        self.stdout.write(
+            "{:<30} {:8.1f} req/s errors={:.2%}".format(
+                name, len(statuses) / elapsed, errors / len(statuses)
+            )
+        )
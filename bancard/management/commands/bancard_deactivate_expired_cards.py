@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from bancard.jobs import deactivate_expired_cards
+
+
+class Command(BaseCommand):
+    help = "Deactivates expired cards and reassigns default cards."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        deactivated = deactivate_expired_cards(options["batch_size"])
+        self.stdout.write(f"Deactivated {deactivated} expired cards.")
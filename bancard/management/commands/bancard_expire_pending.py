@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from bancard.jobs import expire_pending_transactions
+
+
+class Command(BaseCommand):
+    help = (
+        "Marks transactions pending for longer than BANCARD_PENDING_EXPIRY['TTL'] "
+        "as expired, confirming recently expired ones with vPOS first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-concurrency", type=int, default=8)
+
+    def handle(self, *args, **options):
+        stats = expire_pending_transactions(options["max_concurrency"])
+        self.stdout.write(
+            "{expired} expired, {confirmed} confirmed by vPOS, {skipped} left "
+            "pending.".format(**stats)
+        )
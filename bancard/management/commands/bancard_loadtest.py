@@ -0,0 +1,283 @@
+import itertools
+import queue
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, List
+
+import requests
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection, connections, OperationalError
+from django.db.backends.signals import connection_created
+from django.urls import reverse
+
+from bancard import operations
+from bancard.gateway import bancard
+from bancard.metrics import Histogram
+from bancard.models import Card, Transaction
+from bancard.transports import FakeTransport
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class DatabaseMonitor:
+    """Times every query run on connections opened during the load test and
+    counts the ones failing on locks.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.seconds = 0.0
+        self.lock_errors = 0
+        self.lock_waits = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as e:
+            if re.search("lock|deadlock", str(e), re.IGNORECASE):
+                with self.lock:
+                    self.lock_errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.queries += 1
+                self.seconds += time.perf_counter() - start
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def sample_lock_waits(self, stop: threading.Event) -> None:
+        """Samples sessions waiting on locks (PostgreSQL only)."""
+        if connection.vendor != "postgresql":
+            return
+        with connections["default"].cursor() as cursor:
+            while not stop.wait(0.1):
+                cursor.execute(
+                    "SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'"
+                )
+                self.lock_waits = max(self.lock_waits, cursor.fetchone()[0])
+        connections["default"].close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives signed vPOS callbacks against callback_view and charge_card/"
+        "get_transaction_status calls with N concurrent clients, with vPOS "
+        "replaced by an in-memory fake. Reports throughput, latency, error "
+        "rates and DB lock contention. Data created is deleted at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=10)
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument(
+            "--mix",
+            default="callback=60,charge=20,status=20",
+            help="Relative weights of each kind of traffic.",
+        )
+        parser.add_argument(
+            "--duplicates",
+            type=float,
+            default=0.0,
+            help="Fraction of callbacks redelivered a second time.",
+        )
+        parser.add_argument(
+            "--url",
+            help="Callback URL of an already running server. Defaults to an "
+            "in-process server.",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Seconds each fake vPOS request takes.",
+        )
+        parser.add_argument(
+            "--user-id",
+            type=int,
+            help="Existing user to attach synthetic data to. A user is created "
+            "otherwise, and deleted at the end unless --keep is given.",
+        )
+        parser.add_argument("--keep", action="store_true", help="Keep created data.")
+
+    def handle(self, *args, **options):
+        weights = {}
+        for part in options["mix"].split(","):
+            name, _, weight = part.partition("=")
+            if name not in ("callback", "charge", "status"):
+                raise CommandError(f"Unknown traffic kind: {name}.")
+            weights[name] = float(weight)
+        schedule = self.make_schedule(weights, options["requests"])
+        user_model = get_user_model()
+        created = False
+        if options["user_id"]:
+            user = user_model._default_manager.get(pk=options["user_id"])
+        else:
+            user, created = user_model._default_manager.get_or_create(
+                **{user_model.USERNAME_FIELD: "bancard-loadtest"}
+            )
+        card = Card.objects.create(
+            user=user, is_active=True, last4="0000", exp_year=99, exp_month=12
+        )
+        server = None
+        monitor = DatabaseMonitor()
+        connection_created.connect(monitor.install)
+        original_transport = bancard.transport
+        bancard.transport = FakeTransport(bancard, latency=options["latency"])
+        bancard.transport.register_card(user.pk, card.pk)
+        try:
+            url = options["url"]
+            if not url:
+                server = ThreadedWSGIServer(("127.0.0.1", 0), QuietRequestHandler)
+                server.set_app(WSGIHandler())
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                url = "http://127.0.0.1:{}{}".format(
+                    server.server_address[1], reverse("bancard_callback")
+                )
+            callbacks = self.create_pending_transactions(
+                user, schedule.count("callback")
+            )
+            self.run(options, schedule, url, user, card, callbacks, monitor)
+        finally:
+            bancard.transport = original_transport
+            connection_created.disconnect(monitor.install)
+            if server:
+                server.shutdown()
+            if not options["keep"]:
+                Transaction.objects.filter(user=user).delete()
+                Card.objects.filter(user=user).delete()
+                if created:
+                    user.delete()
+
+    @staticmethod
+    def make_schedule(weights: Dict[str, float], requests: int) -> List[str]:
+        """Returns the kind of each request, in random order, with each kind's
+        share of `requests` given by its relative weight.
+        """
+        total = sum(weights.values())
+        if total <= 0:
+            raise CommandError("At least one traffic weight must be positive.")
+        schedule = [
+            kind
+            for kind, weight in weights.items()
+            for _ in range(round(requests * weight / total))
+        ]
+        random.shuffle(schedule)
+        return schedule[:requests]
+
+    def create_pending_transactions(self, user, count: int) -> "queue.Queue[dict]":
+        """Creates pending transactions and their signed callback payloads."""
+        payloads = queue.Queue()
+        if not count:
+            return payloads
+        transactions = Transaction.objects.bulk_create(
+            Transaction(user=user, amount=Decimal("10000.00")) for _ in range(count)
+        )
+        if transactions[0].pk is None:
+            transactions = Transaction.objects.filter(
+                user=user, status=Transaction.PENDING, card=None
+            )
+        for tx in transactions:
+            payloads.put(bancard.transport.callback_payload(tx.id, "10000.00"))
+        return payloads
+
+    def run(self, options, schedule, url, user, card, callbacks, monitor):
+        counter = itertools.count()
+        lock = threading.Lock()
+        latencies: Dict[str, Histogram] = defaultdict(
+            lambda: Histogram(window=len(schedule))
+        )
+        errors: Dict[str, int] = defaultdict(int)
+        charged: List[int] = []
+        stop_sampling = threading.Event()
+
+        def client():
+            session = requests.Session()
+            while True:
+                index = next(counter)
+                if index >= len(schedule):
+                    break
+                kind = schedule[index]
+                start = time.perf_counter()
+                try:
+                    ok = getattr(self, f"do_{kind}")(
+                        session, url, user, card, callbacks, charged, options
+                    )
+                except Exception:
+                    ok = False
+                with lock:
+                    latencies[kind].observe((time.perf_counter() - start) * 1000)
+                    if not ok:
+                        errors[kind] += 1
+            connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(options["clients"])]
+        threading.Thread(
+            target=monitor.sample_lock_waits, args=(stop_sampling,), daemon=True
+        ).start()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stop_sampling.set()
+
+        total = sum(histogram.count for histogram in latencies.values())
+        self.stdout.write(
+            f"{total} operations with {options['clients']} clients in "
+            f"{elapsed:.2f}s: {total / elapsed:.1f} ops/s"
+        )
+        for kind, histogram in sorted(latencies.items()):
+            self.stdout.write(
+                "{:<9} n={:<6} {:7.1f} ops/s  p50={:8.2f}ms  p99={:8.2f}ms  "
+                "errors={:.2%}".format(
+                    kind,
+                    histogram.count,
+                    histogram.count / elapsed,
+                    histogram.percentile(50),
+                    histogram.percentile(99),
+                    errors[kind] / histogram.count,
+                )
+            )
+        self.stdout.write(
+            f"DB: {monitor.queries} queries, {monitor.seconds:.2f}s in queries, "
+            f"{monitor.lock_errors} lock errors, "
+            f"max. {monitor.lock_waits} sessions waiting on locks"
+        )
+
+    def do_callback(self, session, url, user, card, callbacks, charged, options):
+        try:
+            payload = callbacks.get_nowait()
+        except queue.Empty:
+            return False
+        res = session.post(url, json=payload)
+        if random.random() < options["duplicates"]:
+            callbacks.put(payload)
+        return res.status_code == 200
+
+    def do_charge(self, session, url, user, card, callbacks, charged, options):
+        response = operations.charge_card(
+            user.pk, card.pk, None, Decimal("10000.00"), "Load test"
+        )
+        if response:
+            charged.append(response.tx_id)
+        return bool(response) and response.status == Transaction.SUCCESS
+
+    def do_status(self, session, url, user, card, callbacks, charged, options):
+        if not charged:
+            return True
+        response = operations.get_transaction_status(None, random.choice(charged))
+        return bool(response)
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bancard.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = "Retries gateway operations that failed transiently."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep processing the outbox instead of exiting after one batch.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to sleep between batches when the outbox is empty.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_outbox(options["batch_size"])
+            if options["verbosity"] > 1 or not options["loop"]:
+                self.stdout.write(f"Processed {processed} outbox entries.")
+            if not options["loop"]:
+                return
+            if processed < options["batch_size"]:
+                time.sleep(options["interval"])
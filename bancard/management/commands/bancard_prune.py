@@ -0,0 +1,41 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bancard.models import AdminJob, ProcessedCallback, GatewayCall
+
+
+class Command(BaseCommand):
+    help = "Deletes bookkeeping records older than their retention period."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--callbacks-days",
+            type=int,
+            default=30,
+            help="Days to keep processed callback fingerprints.",
+        )
+        parser.add_argument(
+            "--gateway-calls-days",
+            type=int,
+            default=90,
+            help="Days to keep the gateway call audit log.",
+        )
+        parser.add_argument(
+            "--admin-jobs-days",
+            type=int,
+            default=7,
+            help="Days to keep the progress and results of admin actions.",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["callbacks_days"])
+        deleted, _ = ProcessedCallback.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(f"Deleted {deleted} processed callbacks.")
+        cutoff = timezone.now() - timedelta(days=options["gateway_calls_days"])
+        deleted, _ = GatewayCall.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(f"Deleted {deleted} gateway calls.")
+        cutoff = timezone.now() - timedelta(days=options["admin_jobs_days"])
+        deleted, _ = AdminJob.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(f"Deleted {deleted} admin jobs.")
@@ -0,0 +1,35 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from bancard.jobs import sync_cards
+
+
+class Command(BaseCommand):
+    help = (
+        "Synchronizes local cards with vPOS: updates card metadata, deactivates "
+        "cards missing in vPOS and deletes stale unconfirmed cards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", dest="user_ids")
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--max-concurrency", type=int, default=8)
+        parser.add_argument(
+            "--placeholder-ttl",
+            type=float,
+            default=24,
+            help="Hours after which unconfirmed cards missing in vPOS are deleted.",
+        )
+
+    def handle(self, *args, **options):
+        stats = sync_cards(
+            options["user_ids"],
+            options["batch_size"],
+            options["max_concurrency"],
+            datetime.timedelta(hours=options["placeholder_ttl"]),
+        )
+        self.stdout.write(
+            "Synchronized {users} users ({failed_users} failed): {updated} "
+            "updated, {deactivated} deactivated, {deleted} deleted.".format(**stats)
+        )
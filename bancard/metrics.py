@@ -0,0 +1,97 @@
+import threading
+from collections import deque
+from typing import Dict, Optional, Any
+
+
+class Histogram:
+    """Keeps count and sum of all observed values plus a bounded window of
+    the most recent ones to compute percentiles.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Returns the `p` (0-100) percentile of recent values."""
+        if not self.samples:
+            return
+        samples = sorted(self.samples)
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class MetricsRegistry:
+    """Thread-safe, in-process counters and histograms.
+
+    Values are per process: aggregate them with your monitoring system if
+    the project runs several workers.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def count(self, name: str) -> int:
+        """Returns the number of values observed by a histogram."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            return histogram.count if histogram else 0
+
+    def percentile(self, name: str, p: float) -> Optional[float]:
+        with self._lock:
+            histogram = self.histograms.get(name)
+            return histogram.percentile(p) if histogram else None
+
+    def snapshot(self, prefix: str = "") -> Dict[str, Any]:
+        """Returns current values of metrics whose name starts with `prefix`."""
+        with self._lock:
+            return {
+                "counters": {
+                    name: value
+                    for name, value in self.counters.items()
+                    if name.startswith(prefix)
+                },
+                "histograms": {
+                    name: histogram.summary()
+                    for name, histogram in self.histograms.items()
+                    if name.startswith(prefix)
+                },
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0003_outboxentry"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProcessedCallback",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "fingerprint",
+                    models.CharField(
+                        editable=False,
+                        max_length=64,
+                        unique=True,
+                        verbose_name="Fingerprint",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        auto_now_add=True, db_index=True, verbose_name="Created at"
+                    ),
+                ),
+                (
+                    "transaction",
+                    models.ForeignKey(
+                        editable=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="bancard.transaction",
+                        verbose_name="Transaction",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Processed callback",
+                "verbose_name_plural": "Processed callbacks",
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0004_processedcallback"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                fields=["exp_year", "exp_month"], name="bancard_card_expiry_idx"
+            ),
+        ),
+    ]
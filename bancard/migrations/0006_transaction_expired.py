@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0005_card_expiry_index"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="transaction",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Gateway response pending"),
+                    ("success", "Success"),
+                    ("fail", "Fail"),
+                    ("reversed", "Reversed"),
+                    ("expired", "Expired"),
+                ],
+                db_index=True,
+                default="pending",
+                editable=False,
+                max_length=20,
+                verbose_name="Status",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                condition=models.Q(("status", "pending")),
+                fields=["payment", "-id"],
+                name="bancard_tx_pending_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                condition=models.Q(("status", "pending")),
+                fields=["created_at"],
+                name="bancard_tx_pending_age_idx",
+            ),
+        ),
+    ]
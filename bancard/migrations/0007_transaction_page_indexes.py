@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0006_transaction_expired"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["user", "-created_at", "-id"], name="bancard_tx_user_page_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["payment", "-created_at", "-id"],
+                name="bancard_tx_payment_page_idx",
+            ),
+        ),
+    ]
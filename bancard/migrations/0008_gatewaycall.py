@@ -0,0 +1,101 @@
+# Generated by Django 4.2.30 on 2026-10-19 04:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0007_transaction_page_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GatewayCall",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "method",
+                    models.CharField(
+                        editable=False, max_length=10, verbose_name="Method"
+                    ),
+                ),
+                (
+                    "path",
+                    models.CharField(
+                        editable=False, max_length=200, verbose_name="Path"
+                    ),
+                ),
+                (
+                    "endpoint",
+                    models.CharField(
+                        db_index=True,
+                        editable=False,
+                        max_length=100,
+                        verbose_name="Endpoint",
+                    ),
+                ),
+                (
+                    "status_code",
+                    models.PositiveSmallIntegerField(
+                        editable=False, null=True, verbose_name="Status code"
+                    ),
+                ),
+                (
+                    "duration",
+                    models.FloatField(
+                        editable=False, verbose_name="Duration (seconds)"
+                    ),
+                ),
+                (
+                    "tx_id",
+                    models.BigIntegerField(
+                        db_index=True,
+                        editable=False,
+                        null=True,
+                        verbose_name="Transaction ID",
+                    ),
+                ),
+                (
+                    "request_data",
+                    models.JSONField(
+                        default=dict,
+                        editable=False,
+                        verbose_name="Request data (redacted)",
+                    ),
+                ),
+                (
+                    "error",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        editable=False,
+                        max_length=250,
+                        verbose_name="Error",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        editable=False,
+                        verbose_name="Created at",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Gateway call",
+                "verbose_name_plural": "Gateway calls",
+            },
+        ),
+    ]
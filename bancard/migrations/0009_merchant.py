@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-19 04:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0008_gatewaycall"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="card",
+            name="merchant",
+            field=models.CharField(
+                default="default",
+                editable=False,
+                max_length=50,
+                verbose_name="Merchant",
+            ),
+        ),
+        migrations.AddField(
+            model_name="transaction",
+            name="merchant",
+            field=models.CharField(
+                default="default",
+                editable=False,
+                max_length=50,
+                verbose_name="Merchant",
+            ),
+        ),
+    ]
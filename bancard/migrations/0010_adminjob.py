@@ -0,0 +1,86 @@
+# Generated by Django 4.2.30 on 2026-10-19 04:28
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0009_merchant"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AdminJob",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        editable=False, max_length=100, verbose_name="Name"
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("running", "Running"),
+                            ("done", "Done"),
+                            ("failed", "Failed"),
+                        ],
+                        default="running",
+                        editable=False,
+                        max_length=10,
+                        verbose_name="Status",
+                    ),
+                ),
+                (
+                    "total",
+                    models.PositiveIntegerField(editable=False, verbose_name="Total"),
+                ),
+                (
+                    "done",
+                    models.PositiveIntegerField(
+                        default=0, editable=False, verbose_name="Done"
+                    ),
+                ),
+                (
+                    "result",
+                    models.JSONField(editable=False, null=True, verbose_name="Result"),
+                ),
+                (
+                    "error",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        editable=False,
+                        max_length=250,
+                        verbose_name="Error",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        auto_now_add=True, db_index=True, verbose_name="Created at"
+                    ),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated at"),
+                ),
+            ],
+            options={
+                "verbose_name": "Admin job",
+                "verbose_name_plural": "Admin jobs",
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-19 04:45
+
+from django.db import migrations, models
+
+
+def delete_duplicate_entries(apps, schema_editor):
+    """Keeps the oldest of pending entries enqueued twice concurrently."""
+    OutboxEntry = apps.get_model("bancard", "OutboxEntry")
+    seen, duplicates = set(), []
+    for entry_id, *key in (
+        OutboxEntry.objects.filter(status="pending")
+        .order_by("id")
+        .values_list("id", "operation", "transaction_id", "reversion_id")
+    ):
+        if tuple(key) in seen:
+            duplicates.append(entry_id)
+        seen.add(tuple(key))
+    OutboxEntry.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0010_adminjob"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_entries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="outboxentry",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("reversion__isnull", True), ("status", "pending")),
+                fields=("operation", "transaction"),
+                name="bancard_outbox_pending_uniq",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="outboxentry",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status", "pending")),
+                fields=("operation", "reversion"),
+                name="bancard_outbox_pending_reversion_uniq",
+            ),
+        ),
+    ]
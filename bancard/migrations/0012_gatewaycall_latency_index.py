@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-19 04:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bancard", "0011_outbox_pending_uniq"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="gatewaycall",
+            index=models.Index(
+                fields=["endpoint", "-created_at"], name="bancard_call_latency_idx"
+            ),
+        ),
+    ]
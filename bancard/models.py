@@ -1,7 +1,50 @@
+import datetime
+import uuid
+from typing import Optional
+
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+# Merchant configured with the `BANCARD_*` settings, see `GatewayRegistry`.
+DEFAULT_MERCHANT = "default"
+
+
+def is_card_expired(
+    exp_year: int, exp_month: int, today: Optional[datetime.date] = None
+) -> bool:
+    """Checks whether a card expiration date has passed. Cards are valid
+    through their expiration month. vPOS reports two-digit years, four-digit
+    years are supported as well. Cards without expiration date (pending
+    registration) are not considered expired.
+    """
+    if not exp_year:
+        return False
+    today = today or timezone.now().date()
+    year = today.year % 100 if exp_year < 100 else today.year
+    return (exp_year, exp_month) < (year, today.month)
+
+
+class CardQuerySet(models.QuerySet):
+    def expired(self, today: Optional[datetime.date] = None):
+        """Cards whose expiration date has passed, see `is_card_expired`."""
+        today = today or timezone.now().date()
+        short_year = today.year % 100
+        return self.filter(
+            Q(exp_year__gt=0, exp_year__lt=100)
+            & (
+                Q(exp_year__lt=short_year)
+                | Q(exp_year=short_year, exp_month__lt=today.month)
+            )
+            | Q(exp_year__gte=100)
+            & (
+                Q(exp_year__lt=today.year)
+                | Q(exp_year=today.year, exp_month__lt=today.month)
+            )
+        )
+
 
 class Card(models.Model):
     last4 = models.CharField(
@@ -32,23 +75,37 @@ class Card(models.Model):
         _("Is active"), default=False, editable=False, db_index=True
     )
     is_default = models.BooleanField(_("Is default"), default=False, db_index=True)
+    merchant = models.CharField(
+        _("Merchant"), max_length=50, default=DEFAULT_MERCHANT, editable=False
+    )
     created_at = models.DateTimeField(_("Created at"), auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(_("Updated at"), auto_now=True)
 
+    objects = CardQuerySet.as_manager()
+
     class Meta:
         verbose_name = _("Card")
         verbose_name_plural = _("Cards")
+        indexes = [
+            models.Index(
+                fields=["exp_year", "exp_month"], name="bancard_card_expiry_idx"
+            )
+        ]
 
     def save(self, *args, **kwargs):
-        other_default = Card.objects.filter(user=self.user, is_default=True)
-        if self.pk:
-            other_default = other_default.exclude(pk=self.pk)
-        other_default = other_default.first()
-        if other_default:
-            other_default.is_default = False
-            other_default.save()
+        if self.is_default:
+            other_default = Card.objects.filter(
+                user_id=self.user_id, merchant=self.merchant, is_default=True
+            )
+            if self.pk:
+                other_default = other_default.exclude(pk=self.pk)
+            other_default.update(is_default=False, updated_at=timezone.now())
         super().save(*args, **kwargs)
 
+    @property
+    def is_expired(self) -> bool:
+        return is_card_expired(self.exp_year, self.exp_month)
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -66,11 +123,13 @@ class Transaction(models.Model):
     SUCCESS = "success"
     FAIL = "fail"
     REVERSED = "reversed"
+    EXPIRED = "expired"
     STATUS_CHOICES = (
         (PENDING, _("Gateway response pending")),
         (SUCCESS, _("Success")),
         (FAIL, _("Fail")),
         (REVERSED, _("Reversed")),
+        (EXPIRED, _("Expired")),
     )
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -125,12 +184,36 @@ class Transaction(models.Model):
     )
     raw_response = models.JSONField(_("Raw response"), editable=False, default=dict)
     token = models.CharField(max_length=100, editable=False, null=True)
+    merchant = models.CharField(
+        _("Merchant"), max_length=50, default=DEFAULT_MERCHANT, editable=False
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = _("Transaction")
         verbose_name_plural = _("Transactions")
+        indexes = [
+            # Only live pending rows, which stay few once abandoned ones expire.
+            models.Index(
+                fields=["payment", "-id"],
+                name="bancard_tx_pending_idx",
+                condition=Q(status="pending"),
+            ),
+            models.Index(
+                fields=["created_at"],
+                name="bancard_tx_pending_age_idx",
+                condition=Q(status="pending"),
+            ),
+            # Keyset pagination of `list_transactions`.
+            models.Index(
+                fields=["user", "-created_at", "-id"], name="bancard_tx_user_page_idx"
+            ),
+            models.Index(
+                fields=["payment", "-created_at", "-id"],
+                name="bancard_tx_payment_page_idx",
+            ),
+        ]
 
 
 class Reversion(models.Model):
@@ -164,3 +247,189 @@ class Reversion(models.Model):
 
     def __str__(self):
         return _("Reversion for transaction {}.").format(self.transaction_id)
+
+
+class OutboxEntry(models.Model):
+    """A gateway operation that failed transiently and must be retried."""
+
+    CONFIRMATION = "confirmation"
+    ROLLBACK = "rollback"
+    OPERATION_CHOICES = (
+        (CONFIRMATION, _("Transaction confirmation")),
+        (ROLLBACK, _("Rollback")),
+    )
+    PENDING = "pending"
+    DONE = "done"
+    FAIL = "fail"
+    STATUS_CHOICES = (
+        (PENDING, _("Pending")),
+        (DONE, _("Done")),
+        (FAIL, _("Fail")),
+    )
+    operation = models.CharField(
+        _("Operation"), max_length=20, choices=OPERATION_CHOICES, editable=False
+    )
+    status = models.CharField(
+        _("Status"),
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+        editable=False,
+    )
+    transaction = models.ForeignKey(
+        Transaction,
+        models.CASCADE,
+        "outbox_entries",
+        verbose_name=_("Transaction"),
+        editable=False,
+    )
+    reversion = models.ForeignKey(
+        Reversion,
+        models.CASCADE,
+        "outbox_entries",
+        null=True,
+        blank=True,
+        verbose_name=_("Reversion"),
+        editable=False,
+    )
+    attempts = models.PositiveSmallIntegerField(
+        _("Attempts"), default=0, editable=False
+    )
+    next_attempt_at = models.DateTimeField(_("Next attempt at"), editable=False)
+    last_error = models.CharField(
+        _("Last error"), max_length=250, default="", blank=True, editable=False
+    )
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+    updated_at = models.DateTimeField(_("Updated at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("Outbox entry")
+        verbose_name_plural = _("Outbox entries")
+        indexes = [
+            models.Index(
+                fields=["status", "next_attempt_at"], name="bancard_outbox_due_idx"
+            )
+        ]
+        # Operations are enqueued once while pending, see `outbox.enqueue`.
+        constraints = [
+            models.UniqueConstraint(
+                fields=["operation", "transaction"],
+                condition=Q(status="pending", reversion__isnull=True),
+                name="bancard_outbox_pending_uniq",
+            ),
+            models.UniqueConstraint(
+                fields=["operation", "reversion"],
+                condition=Q(status="pending"),
+                name="bancard_outbox_pending_reversion_uniq",
+            ),
+        ]
+
+    def __str__(self):
+        return _("{} for transaction {}.").format(
+            self.get_operation_display(), self.transaction_id
+        )
+
+
+class ProcessedCallback(models.Model):
+    """Fingerprint of a vPOS callback that was already processed, used to
+    acknowledge redeliveries without processing them again.
+    """
+
+    fingerprint = models.CharField(
+        _("Fingerprint"), max_length=64, unique=True, editable=False
+    )
+    transaction = models.ForeignKey(
+        Transaction,
+        models.CASCADE,
+        "+",
+        verbose_name=_("Transaction"),
+        editable=False,
+    )
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("Processed callback")
+        verbose_name_plural = _("Processed callbacks")
+
+
+class GatewayCall(models.Model):
+    """Audit record of a request sent to vPOS, written in batches by
+    `bancard.audit.AuditLog`. `tx_id` is not a foreign key, so records outlive
+    the transactions they refer to.
+    """
+
+    method = models.CharField(_("Method"), max_length=10, editable=False)
+    path = models.CharField(_("Path"), max_length=200, editable=False)
+    endpoint = models.CharField(
+        _("Endpoint"), max_length=100, editable=False, db_index=True
+    )
+    status_code = models.PositiveSmallIntegerField(
+        _("Status code"), null=True, editable=False
+    )
+    duration = models.FloatField(_("Duration (seconds)"), editable=False)
+    tx_id = models.BigIntegerField(
+        _("Transaction ID"), null=True, editable=False, db_index=True
+    )
+    request_data = models.JSONField(
+        _("Request data (redacted)"), editable=False, default=dict
+    )
+    error = models.CharField(
+        _("Error"), max_length=250, default="", blank=True, editable=False
+    )
+    created_at = models.DateTimeField(
+        _("Created at"), default=timezone.now, editable=False, db_index=True
+    )
+
+    class Meta:
+        verbose_name = _("Gateway call")
+        verbose_name_plural = _("Gateway calls")
+        indexes = [
+            # Latest calls of an endpoint, for the admin latency stats.
+            models.Index(
+                fields=["endpoint", "-created_at"], name="bancard_call_latency_idx"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.method} {self.path}"
+
+
+class AdminJob(models.Model):
+    """Progress and result of a bulk admin action running in the background,
+    kept in the database so any worker can show it.
+    """
+
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (RUNNING, _("Running")),
+        (DONE, _("Done")),
+        (FAILED, _("Failed")),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(_("Name"), max_length=100, editable=False)
+    status = models.CharField(
+        _("Status"),
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=RUNNING,
+        editable=False,
+    )
+    total = models.PositiveIntegerField(_("Total"), editable=False)
+    done = models.PositiveIntegerField(_("Done"), default=0, editable=False)
+    result = models.JSONField(_("Result"), null=True, editable=False)
+    error = models.CharField(
+        _("Error"), max_length=250, default="", blank=True, editable=False
+    )
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(_("Updated at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("Admin job")
+        verbose_name_plural = _("Admin jobs")
+
+    @property
+    def percent(self) -> int:
+        return int(100 * self.done / self.total) if self.total else 100
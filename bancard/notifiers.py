@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+from functools import lru_cache
+from typing import Optional, Dict, Any
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .interface import ChargeResponse
+
+
+def serialize_response(response: ChargeResponse) -> Dict[str, Any]:
+    """Returns the public (customer-safe) fields of a charge response as a
+    JSON serializable dict.
+
+    :param response: ChargeResponse instance.
+    """
+    return {
+        "payment_id": response.payment_id,
+        "tx_id": response.tx_id,
+        "amount": str(response.amount),
+        "status": response.status,
+        "response_description": response.response_description,
+        "tx_datetime": (
+            response.tx_datetime.isoformat() if response.tx_datetime else None
+        ),
+    }
+
+
+class BaseNotifier:
+    """Delivers transaction updates to the processes waiting for them.
+
+    Subclasses must implement `publish` and `get`. Waiting is done by polling
+    `get`, or `aget` when waiting asynchronously, which is cheap for local
+    backends; subclasses with a real push mechanism may override `wait` and
+    `await_update`.
+    """
+
+    poll_interval = 0.25
+
+    def publish(self, tx_id: int, data: Dict[str, Any]) -> None:
+        """Makes `data` available to waiters of transaction `tx_id`."""
+        raise NotImplementedError
+
+    def get(self, tx_id: int) -> Optional[Dict[str, Any]]:
+        """Returns the last published data for transaction `tx_id`, if any."""
+        raise NotImplementedError
+
+    async def aget(self, tx_id: int) -> Optional[Dict[str, Any]]:
+        """Async version of `get`. Runs `get` in a thread unless overridden."""
+        return await sync_to_async(self.get)(tx_id)
+
+    def wait(self, tx_id: int, timeout: float) -> Optional[Dict[str, Any]]:
+        """Blocks until transaction `tx_id` is updated or `timeout` seconds pass.
+
+        :param tx_id: ID of transaction to wait for.
+        :param timeout: max. number of seconds to wait.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            data = self.get(tx_id)
+            remaining = deadline - time.monotonic()
+            if data is not None or remaining <= 0:
+                return data
+            time.sleep(min(self.poll_interval, remaining))
+
+    async def await_update(
+        self, tx_id: int, timeout: float
+    ) -> Optional[Dict[str, Any]]:
+        """Async version of `wait` that does not hold a worker thread."""
+        deadline = time.monotonic() + timeout
+        while True:
+            data = await self.aget(tx_id)
+            remaining = deadline - time.monotonic()
+            if data is not None or remaining <= 0:
+                return data
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+
+class LocalNotifier(BaseNotifier):
+    """In-process notifier. Only useful when callbacks and waiters are served
+    by the same process (e.g. development server or a single ASGI worker).
+    """
+
+    def __init__(self, max_entries: int = 10000) -> None:
+        self.max_entries = max_entries
+        self._data: Dict[int, Dict[str, Any]] = {}
+        self._condition = threading.Condition()
+
+    def publish(self, tx_id: int, data: Dict[str, Any]) -> None:
+        with self._condition:
+            if len(self._data) >= self.max_entries:
+                self._data.pop(next(iter(self._data)))
+            self._data[tx_id] = data
+            self._condition.notify_all()
+
+    def get(self, tx_id: int) -> Optional[Dict[str, Any]]:
+        return self._data.get(tx_id)
+
+    async def aget(self, tx_id: int) -> Optional[Dict[str, Any]]:
+        return self.get(tx_id)
+
+    def wait(self, tx_id: int, timeout: float) -> Optional[Dict[str, Any]]:
+        with self._condition:
+            self._condition.wait_for(lambda: tx_id in self._data, timeout)
+            return self._data.get(tx_id)
+
+
+class CacheNotifier(BaseNotifier):
+    """Notifier backed by a Django cache. Shared across processes as long as
+    the configured cache is (Redis, Memcached, database cache...).
+    """
+
+    key_prefix = "bancard:tx-update:"
+
+    def __init__(self, alias: str = "default", ttl: int = 600) -> None:
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def publish(self, tx_id: int, data: Dict[str, Any]) -> None:
+        self.cache.set(f"{self.key_prefix}{tx_id}", data, self.ttl)
+
+    def get(self, tx_id: int) -> Optional[Dict[str, Any]]:
+        return self.cache.get(f"{self.key_prefix}{tx_id}")
+
+    async def aget(self, tx_id: int) -> Optional[Dict[str, Any]]:
+        return await self.cache.aget(f"{self.key_prefix}{tx_id}")
+
+
+@lru_cache(maxsize=None)
+def get_notifier() -> BaseNotifier:
+    """Returns the notifier configured in `BANCARD_NOTIFIER` settings."""
+    config = getattr(settings, "BANCARD_NOTIFIER", {})
+    backend = config.get("BACKEND", "bancard.notifiers.CacheNotifier")
+    return import_string(backend)(**config.get("OPTIONS", {}))
+
+
+def publish_transaction_update(sender, response: ChargeResponse, **kwargs) -> None:
+    """`transaction_updated` receiver that forwards updates to the notifier."""
+    get_notifier().publish(response.tx_id, serialize_response(response))
@@ -1,56 +1,134 @@
+import hashlib
+import math
+import re
+import time
+from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import Optional, List, Tuple, Any, Dict
+from typing import Optional, List, Tuple, Any, Dict, Iterable, Callable
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signing import BadSignature, Signer
+from django.db import transaction, IntegrityError
+from django.db.models import Max, Q, QuerySet
 from django.utils import timezone
-from django.utils.translation import gettext_lazy
-
-from .gateway import bancard
-from .interface import BancardCard, PrivateChargeResponse, ChargeResponse
-from .models import Card, Transaction, Reversion
-from .signals import transaction_updated
+from django.utils.translation import gettext, gettext_lazy
 
+from .deadlines import remaining, with_timeout
+from .exceptions import TransientGatewayError, DeadlineExceeded, RateLimited
+from .gateway import bancard, gateways, get_gateway
+from .interface import (
+    BancardCard,
+    PrivateChargeResponse,
+    ChargeResponse,
+    BulkReversionEstimate,
+    BulkReversionResult,
+    TransactionPage,
+)
+from .lanes import LOW, default_lane
+from .metrics import metrics
+from .profiling import profiled
+from .models import (
+    Card,
+    Transaction,
+    Reversion,
+    OutboxEntry,
+    ProcessedCallback,
+    DEFAULT_MERCHANT,
+    is_card_expired,
+)
+from .outbox import enqueue, backoff_delay
+from .signals import send_transaction_updated, asend_transaction_updated
+from .utils import run_concurrently
 
 __all__ = [
     "get_default_card",
+    "get_default_cards",
     "set_default_card",
     "init_card_registration",
     "confirm_card_registration",
     "get_cards",
+    "get_cards_for_users",
     "get_card",
     "delete_card",
     "charge_card",
     "init_single_buy",
     "get_transaction_status",
+    "get_transaction_statuses",
+    "refresh_transaction_statuses",
+    "list_transactions",
     "reverse",
+    "reverse_bulk",
+    "estimate_reverse_bulk",
     "callback",
+    "acallback",
 ]
 
+# Card columns in `BancardCard` field order, used to build cards from
+# `values_list()` rows without instantiating `Card` models.
+CARD_FIELDS = ("id", "last4", "exp_year", "exp_month", "brand", "type", "is_default")
+
+# Transaction columns needed to build a `ChargeResponse`, see `_charge_response_from_row`.
+TX_RESPONSE_FIELDS = (
+    "payment_id",
+    "id",
+    "amount",
+    "status",
+    "response_description",
+    "created_at",
+    "authorization_code",
+    "risk_index",
+)
+
 
-def get_default_card(user_id: int) -> Optional[BancardCard]:
+@profiled
+def get_default_card(
+    user_id: int, merchant: str = DEFAULT_MERCHANT
+) -> Optional[BancardCard]:
     """Gets the default card for user with `user_id`.
 
     :param user_id: ID of user retrieving the card.
+    :param merchant: merchant the card is registered with.
     """
-    try:
-        card = Card.objects.get(user__pk=user_id, is_default=True)
-    except Card.DoesNotExist:
-        return
-    return BancardCard(**card.to_dict())
+    row = (
+        Card.objects.filter(user__pk=user_id, is_default=True, merchant=merchant)
+        .values_list(*CARD_FIELDS)
+        .first()
+    )
+    if row:
+        return BancardCard(*row)
+
+
+@profiled
+def get_default_cards(
+    user_ids: Iterable[int], merchant: str = DEFAULT_MERCHANT
+) -> Dict[int, BancardCard]:
+    """Gets the default cards of several users in a single query.
+
+    :param user_ids: IDs of users retrieving their default card.
+    :param merchant: merchant the cards are registered with.
+    :returns: dict of default cards keyed by user ID. Users without a default
+    card are left out.
+    """
+    rows = Card.objects.filter(
+        user__pk__in=user_ids, is_default=True, merchant=merchant
+    ).values_list("user_id", *CARD_FIELDS)
+    return {user_id: BancardCard(*card) for user_id, *card in rows}
 
 
-def set_default_card(user_id: int, card_id: int) -> bool:
-    """Sets a default card for user with `user_id`.
+@profiled
+def set_default_card(
+    user_id: int, card_id: int, merchant: str = DEFAULT_MERCHANT
+) -> bool:
+    """Sets the default card of user with `user_id` for a merchant.
 
     :param user_id: ID of user who owns the card.
     :param card_id: ID of card to set default.
+    :param merchant: merchant the card is registered with.
     """
-    other_default = Card.objects.filter(user__pk=user_id).exclude(pk=card_id).first()
-    if other_default:
-        other_default.is_default = False
-        other_default.save()
     try:
-        card = Card.objects.get(user__pk=user_id, pk=card_id)
+        card = Card.objects.get(user__pk=user_id, pk=card_id, merchant=merchant)
     except Card.DoesNotExist:
         return False
     card.is_default = True
@@ -58,8 +136,14 @@ def set_default_card(user_id: int, card_id: int) -> bool:
     return True
 
 
+@profiled
+@with_timeout
 def init_card_registration(
-    user_id: int, user_cellphone: str, user_email: str, redirect_url: str
+    user_id: int,
+    user_cellphone: str,
+    user_email: str,
+    redirect_url: str,
+    merchant: str = DEFAULT_MERCHANT,
 ) -> Optional[str]:
     """Retrieves a `process_id` to init card registration process.
 
@@ -67,28 +151,49 @@ def init_card_registration(
     :param user_cellphone: Cellphone of user registering the card
     :param user_email: Email of user registering the card
     :param redirect_url: URL to redirect the user after card registration.
+    :param merchant: merchant the card is registered with.
+    :raises DeadlineExceeded: if the `timeout` ran out before vPOS was asked.
     """
     try:
         user = get_user_model().objects.get(pk=user_id)
     except get_user_model().DoesNotExist:
         return
-    default_card = get_default_card(user_id)
-    card = Card.objects.create(user=user, is_default=not default_card)
-    return bancard.init_card_registration(
-        user_id, card.id, redirect_url, user_cellphone, user_email
+    gateway = get_gateway(merchant)
+    gateway.check_deadline("/cards/new")
+    default_card = get_default_card(user_id, merchant)
+    card = Card.objects.create(
+        user=user, is_default=not default_card, merchant=merchant
     )
+    try:
+        return gateway.init_card_registration(
+            user_id, card.id, redirect_url, user_cellphone, user_email
+        )
+    except DeadlineExceeded:
+        card.delete()
+        raise
 
 
-def confirm_card_registration(user_id: int) -> Optional[BancardCard]:
+@profiled
+@with_timeout
+def confirm_card_registration(
+    user_id: int, merchant: str = DEFAULT_MERCHANT
+) -> Optional[BancardCard]:
     """Confirms that a card has been registered by the user.
 
     :param user_id: ID of user who registered the card.
+    :param merchant: merchant the card is registered with.
+    :raises DeadlineExceeded: if the `timeout` ran out before vPOS answered.
     """
-    card = Card.objects.filter(user__pk=user_id, is_active=False).last()
+    card = Card.objects.filter(
+        user__pk=user_id, is_active=False, merchant=merchant
+    ).last()
     if not card:
         return
-    vpos_card = bancard.get_user_card(user_id, card.id)
+    gateway = get_gateway(merchant)
+    gateway.check_deadline("/users/{id}/cards")
+    vpos_card = gateway.get_user_card(user_id, card.id)
     if not vpos_card:
+        gateway.check_deadline()
         return
     card.last4 = vpos_card["last4"]
     card.exp_year = vpos_card["exp_year"]
@@ -100,44 +205,96 @@ def confirm_card_registration(user_id: int) -> Optional[BancardCard]:
     return BancardCard(**card.to_dict())
 
 
-def get_cards(user_id: int) -> List[BancardCard]:
+@profiled
+def get_cards(user_id: int, merchant: str = DEFAULT_MERCHANT) -> List[BancardCard]:
     """Gets all cards registered by a user.
 
     :param user_id: ID of user retrieving the cards.
+    :param merchant: merchant the cards are registered with.
+    """
+    cards = Card.objects.filter(user__id=user_id, is_active=True, merchant=merchant)
+    return [BancardCard(*row) for row in cards.values_list(*CARD_FIELDS)]
+
+
+@profiled
+def get_cards_for_users(
+    user_ids: Iterable[int], merchant: str = DEFAULT_MERCHANT
+) -> Dict[int, List[BancardCard]]:
+    """Gets all cards registered by several users in a single query.
+
+    :param user_ids: IDs of users retrieving their cards.
+    :param merchant: merchant the cards are registered with.
+    :returns: dict of card lists keyed by user ID. Every requested user is
+    present, with an empty list if they have no cards.
     """
-    cards = Card.objects.filter(user__id=user_id, is_active=True)
-    return [BancardCard(**card.to_dict()) for card in cards]
+    user_ids = list(user_ids)
+    cards = {user_id: [] for user_id in user_ids}
+    rows = (
+        Card.objects.filter(user__id__in=user_ids, is_active=True, merchant=merchant)
+        .order_by("id")
+        .values_list("user_id", *CARD_FIELDS)
+    )
+    for user_id, *card in rows:
+        cards[user_id].append(BancardCard(*card))
+    return cards
 
 
-def get_card(user_id: int, card_id: int) -> Optional[BancardCard]:
+@profiled
+def get_card(
+    user_id: int, card_id: int, merchant: str = DEFAULT_MERCHANT
+) -> Optional[BancardCard]:
     """Gets a card registered by user.
 
     :param user_id: ID of the user retrieving the card.
     :param card_id: ID of card to be retrieved.
+    :param merchant: merchant the card is registered with.
     """
-    try:
-        return BancardCard(**Card.objects.get(user__id=user_id, pk=card_id).to_dict())
-    except Card.DoesNotExist:
-        pass
+    row = (
+        Card.objects.filter(user__id=user_id, pk=card_id, merchant=merchant)
+        .values_list(*CARD_FIELDS)
+        .first()
+    )
+    if row:
+        return BancardCard(*row)
 
 
-def delete_card(user_id: int, card_id: int) -> bool:
+@profiled
+@with_timeout
+def delete_card(user_id: int, card_id: int, merchant: str = DEFAULT_MERCHANT) -> bool:
     """Deletes a card registered by a user.
 
     :param user_id: ID of user deleting the card.
     :param card_id: ID of card to be deleted.
+    :param merchant: merchant the card is registered with.
+    :raises DeadlineExceeded: if the `timeout` ran out before vPOS answered.
     """
     try:
-        card = Card.objects.get(user__id=user_id, pk=card_id)
+        card = Card.objects.get(user__id=user_id, pk=card_id, merchant=merchant)
     except Card.DoesNotExist:
         return False
-    deleted = bancard.delete_card(user_id, card_id)
+    gateway = get_gateway(merchant)
+    # The card is looked up before it is deleted.
+    gateway.check_deadline("/users/{id}/cards", "/users/{id}/cards")
+    deleted = gateway.delete_card(user_id, card_id)
     if deleted:
         card.delete()
         return True
+    gateway.check_deadline()
     return False
 
 
+# Fields written by `_update_transaction`, for targeted `save(update_fields=...)`.
+UPDATE_FIELDS = [
+    "status",
+    "response_description",
+    "authorization_code",
+    "risk_index",
+    "token",
+    "raw_response",
+    "updated_at",
+]
+
+
 def _update_transaction(tx: Transaction, gw_response: dict):
     """Updates the transaction with data sent from vPOS.
 
@@ -173,6 +330,22 @@ def _make_charge_response(tx: Transaction) -> ChargeResponse:
     )
 
 
+def _charge_response_from_row(row: tuple) -> ChargeResponse:
+    """Create a Charge response instance from a `TX_RESPONSE_FIELDS` values row.
+
+    :param row: tuple with transaction values in `TX_RESPONSE_FIELDS` order.
+    """
+    *public_data, authorization_code, risk_index = row
+    return ChargeResponse(
+        *public_data,
+        private_data=PrivateChargeResponse(
+            authorization_code=authorization_code, risk_index=risk_index
+        ),
+    )
+
+
+@profiled
+@with_timeout
 def charge_card(
     user_id: int,
     card_id: int,
@@ -181,6 +354,7 @@ def charge_card(
     description: str,
     installments: Optional[int] = None,
     customer_ip: Optional[str] = None,
+    merchant: str = DEFAULT_MERCHANT,
 ) -> Optional[ChargeResponse]:
     """Attempts to capture payment using a registered card.
 
@@ -191,33 +365,92 @@ def charge_card(
     :param description: description of the current capture transaction.
     :param installments: number of installments for payment (only valid for credit card).
     :param customer_ip: IP Address of visitor.
+    :param merchant: merchant charging the card, the card must be registered
+    with it.
+    :raises DeadlineExceeded: if the `timeout` ran out before the charge was
+    sent. A transaction already created is marked as failed.
     """
-    try:
-        card = Card.objects.get(user__id=user_id, pk=card_id)
-    except Card.DoesNotExist:
+    card = (
+        Card.objects.filter(user__id=user_id, pk=card_id, merchant=merchant)
+        .values_list("exp_year", "exp_month")
+        .first()
+    )
+    if not card:
         return
-    gw_card = bancard.get_user_card(user_id, card_id)
+    exp_year, exp_month = card
+    if is_card_expired(exp_year, exp_month):
+        # vPOS would decline it anyway, record the failure without asking.
+        tx = Transaction.objects.create(
+            user_id=user_id,
+            payment_id=payment_id,
+            amount=amount,
+            customer_ip_address=customer_ip,
+            card_id=card_id,
+            tx_description=description,
+            status=Transaction.FAIL,
+            response_description=gettext("Card expired."),
+            merchant=merchant,
+        )
+        return _make_charge_response(tx)
+    # Card tokens only work with the merchant the card was registered with.
+    gateway = get_gateway(merchant)
+    gateway.check_deadline("/users/{id}/cards", "/charge")
+    gw_card = gateway.get_user_card(user_id, card_id)
     if not gw_card:
+        # Tell a lookup that ran out of time from a missing card.
+        gateway.check_deadline()
         return
+    gateway.check_deadline("/charge")
     tx = Transaction.objects.create(
         user_id=user_id,
         payment_id=payment_id,
         amount=amount,
         customer_ip_address=customer_ip,
-        card=card,
+        card_id=card_id,
         tx_description=description,
+        merchant=merchant,
     )
-    response = bancard.charge_card(
-        user_id, card_id, tx, amount, description, installments
-    )
+    # The operation token is only stored after the charge request, together
+    # with its result, so each charge costs a single INSERT and UPDATE.
+    try:
+        response = gateway.charge_card(
+            user_id,
+            card_id,
+            tx,
+            amount,
+            description,
+            installments,
+            card_token=gw_card["token"],
+        )
+    except DeadlineExceeded:
+        # Nothing was sent, so the charge certainly didn't happen.
+        tx.status = Transaction.FAIL
+        tx.response_description = gettext("Deadline exceeded.")
+        tx.save(update_fields=["status", "response_description", "updated_at"])
+        raise
+    except RateLimited:
+        # Not sent either, there is no outcome to confirm later.
+        tx.status = Transaction.FAIL
+        tx.response_description = gettext("Too many requests, try again later.")
+        tx.save(update_fields=["status", "response_description", "updated_at"])
+        return _make_charge_response(tx)
+    except TransientGatewayError as e:
+        # The charge outcome is unknown, leave it pending until confirmed.
+        with transaction.atomic():
+            tx.save(update_fields=["token", "updated_at"])
+            enqueue(OutboxEntry.CONFIRMATION, tx.id, e)
+        return _make_charge_response(tx)
     if response:
         _update_transaction(tx, response)
+        tx.save(update_fields=UPDATE_FIELDS)
     else:
         tx.status = Transaction.FAIL
-    tx.save()
+        tx.save(update_fields=["status", "token", "updated_at"])
     return _make_charge_response(tx)
 
 
+@profiled
+@with_timeout
 def init_single_buy(
     payment_id: int,
     amount: Decimal,
@@ -228,53 +461,254 @@ def init_single_buy(
     additional_data: Optional[str] = "",
     user_id: Optional[str] = "",
     customer_ip: Optional[str] = "",
+    merchant: str = DEFAULT_MERCHANT,
 ) -> Optional[str]:
+    gateway = get_gateway(merchant)
+    gateway.check_deadline("/single_buy")
     tx = Transaction.objects.create(
         user_id=user_id,
         payment_id=payment_id,
         amount=amount,
         customer_ip_address=customer_ip,
         tx_description=description,
+        merchant=merchant,
     )
-    return bancard.init_single_buy(
-        tx.id, amount, description, return_url, cancel_url, zimple, additional_data
-    )
+    try:
+        return gateway.init_single_buy(
+            tx.id, amount, description, return_url, cancel_url, zimple, additional_data
+        )
+    except DeadlineExceeded:
+        tx.status = Transaction.FAIL
+        tx.response_description = gettext("Deadline exceeded.")
+        tx.save(update_fields=["status", "response_description", "updated_at"])
+        raise
 
 
+@profiled
+@with_timeout
 def get_transaction_status(
     payment_id: int, tx_id: Optional[int] = None
 ) -> Optional[ChargeResponse]:
     """Attempts to get a transaction status.
 
     If no `tx_id` is provided, the operation will check for the last transaction
-    with `pending` status related to `payment_id`.
+    with `pending` status related to `payment_id`. If the `timeout` doesn't
+    leave time to ask vPOS, the stored pending status is returned.
 
     :param payment_id: ID of payment on which to check status.
     :param tx_id: ID of transaction on which to check status.
     """
 
+    # `raw_response` is by far the widest column and is not part of the response.
+    transactions = Transaction.objects.defer("raw_response")
     if tx_id:
         try:
-            tx = Transaction.objects.get(id=tx_id)
+            tx = transactions.get(id=tx_id)
         except Transaction.DoesNotExist:
             return
     else:
-        tx = Transaction.objects.filter(
+        tx = transactions.filter(
             status=Transaction.PENDING, payment_id=payment_id
         ).last()
         if not tx:
             return
-    if tx.status in (Transaction.SUCCESS, Transaction.FAIL, Transaction.REVERSED):
+    gateway = get_gateway(tx.merchant)
+    if tx.status != Transaction.PENDING or not gateway.has_time_for(
+        "/single_buy/confirmations"
+    ):
+        return _make_charge_response(tx)
+    try:
+        gw_response = gateway.get_single_buy_confirmation(tx.id)
+    except DeadlineExceeded:
+        return _make_charge_response(tx)
+    except TransientGatewayError as e:
+        enqueue(OutboxEntry.CONFIRMATION, tx.id, e)
         return _make_charge_response(tx)
-    gw_response = bancard.get_single_buy_confirmation(tx.id)
     if gw_response:
         _update_transaction(tx, gw_response)
+        tx.save(update_fields=UPDATE_FIELDS)
     else:
         tx.status = Transaction.FAIL
-    tx.save()
+        tx.save(update_fields=["status", "updated_at"])
     return _make_charge_response(tx)
 
 
+@profiled
+def get_transaction_statuses(payment_ids: Iterable[int]) -> Dict[int, ChargeResponse]:
+    """Gets the status of the last transaction of several payments in a single
+    query.
+
+    Unlike `get_transaction_status`, statuses are read from the database only
+    and vPOS is never queried for pending transactions.
+
+    :param payment_ids: IDs of payments on which to check status.
+    :returns: dict of charge responses keyed by payment ID. Payments without
+    transactions are left out.
+    """
+    last_ids = (
+        Transaction.objects.filter(payment_id__in=payment_ids)
+        .values("payment_id")
+        .annotate(last_id=Max("id"))
+        .values("last_id")
+    )
+    rows = Transaction.objects.filter(id__in=last_ids).values_list(*TX_RESPONSE_FIELDS)
+    return {row[0]: _charge_response_from_row(row) for row in rows}
+
+
+# Max. number of transactions per `list_transactions` page.
+MAX_PAGE_SIZE = 100
+
+
+@profiled
+@with_timeout
+@default_lane(LOW)
+def refresh_transaction_statuses(
+    tx_ids: Iterable[int],
+    max_concurrency: int = 8,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Dict[int, ChargeResponse]:
+    """Like `get_transaction_status` for many transactions at once.
+
+    Pending transactions are confirmed with vPOS concurrently and updated in
+    bulk; a `transaction_updated` signal is sent for each of them. Lookups
+    failing transiently are queued in the outbox and their transactions left
+    pending, like those of merchants removed from the settings.
+
+    :param tx_ids: IDs of transactions on which to check status.
+    :param max_concurrency: max. number of simultaneous vPOS requests.
+    :param progress: called with the number of lookups done so far and the
+    total, possibly from worker threads.
+    :returns: current status of every transaction found, keyed by ID.
+    """
+    transactions = list(
+        Transaction.objects.filter(id__in=list(tx_ids)).defer("raw_response")
+    )
+    pending = [tx for tx in transactions if tx.status == Transaction.PENDING]
+
+    def confirm(tx: Transaction) -> Any:
+        try:
+            return get_gateway(tx.merchant).get_single_buy_confirmation(tx.id)
+        except (TransientGatewayError, DeadlineExceeded, ImproperlyConfigured) as e:
+            return e
+
+    results = run_concurrently(confirm, pending, max_concurrency, progress)
+    now = timezone.now()
+    confirmed, unconfirmed, failed = [], [], {}
+    for tx, gw_response in zip(pending, results):
+        if isinstance(gw_response, (DeadlineExceeded, ImproperlyConfigured)):
+            # Not sent, or the merchant was removed from the settings.
+            continue
+        if isinstance(gw_response, TransientGatewayError):
+            failed[tx.id] = gw_response
+            continue
+        if gw_response:
+            _update_transaction(tx, gw_response)
+            confirmed.append(tx)
+        else:
+            tx.status = Transaction.FAIL
+            unconfirmed.append(tx)
+        tx.updated_at = now
+    updated = confirmed + unconfirmed
+    with transaction.atomic():
+        Transaction.objects.bulk_update(confirmed, UPDATE_FIELDS)
+        # `raw_response` is deferred and only set on confirmed transactions,
+        # writing it would load it row by row.
+        Transaction.objects.bulk_update(unconfirmed, ["status", "updated_at"])
+        if failed:
+            # Like `enqueue`, pending entries are not duplicated.
+            failed_ids = set(failed) - set(
+                OutboxEntry.objects.filter(
+                    operation=OutboxEntry.CONFIRMATION,
+                    transaction_id__in=list(failed),
+                    status=OutboxEntry.PENDING,
+                ).values_list("transaction_id", flat=True)
+            )
+            # Entries enqueued meanwhile are skipped by the unique constraint.
+            OutboxEntry.objects.bulk_create(
+                [
+                    OutboxEntry(
+                        operation=OutboxEntry.CONFIRMATION,
+                        transaction_id=tx_id,
+                        next_attempt_at=now + backoff_delay(0),
+                        last_error=str(failed[tx_id])[:250],
+                    )
+                    for tx_id in failed_ids
+                ],
+                ignore_conflicts=True,
+            )
+    for tx in updated:
+        send_transaction_updated(
+            sender=refresh_transaction_statuses, response=_make_charge_response(tx)
+        )
+    return {tx.id: _make_charge_response(tx) for tx in transactions}
+
+
+# Cursors are signed, so callers can't forge them to read arbitrary ranges.
+_cursor_signer = Signer(salt="bancard.list-transactions")
+
+
+def _encode_cursor(created_at: datetime, tx_id: int) -> str:
+    return _cursor_signer.sign_object([created_at.isoformat(), tx_id])
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, tx_id = _cursor_signer.unsign_object(cursor)
+        return datetime.fromisoformat(created_at), int(tx_id)
+    except (BadSignature, ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+
+
+@profiled
+def list_transactions(
+    user_id: Optional[int] = None,
+    payment_id: Optional[int] = None,
+    status: Optional[str] = None,
+    after_cursor: Optional[str] = None,
+    limit: int = 20,
+) -> TransactionPage:
+    """Lists the transactions of a user or payment, newest first.
+
+    Pages are read with keyset pagination on `(created_at, id)`, so every
+    page costs a single index range scan however deep the caller pages.
+
+    :param user_id: ID of user whose transactions are listed.
+    :param payment_id: ID of payment whose transactions are listed.
+    :param status: only list transactions with this status.
+    :param after_cursor: `next_cursor` of the previous page.
+    :param limit: max. number of transactions per page, up to `MAX_PAGE_SIZE`.
+    :raises ValueError: if neither `user_id` nor `payment_id` are provided, or
+    the cursor is invalid.
+    """
+    if user_id is None and payment_id is None:
+        raise ValueError("Either user_id or payment_id must be provided.")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    transactions = Transaction.objects.all()
+    if user_id is not None:
+        transactions = transactions.filter(user_id=user_id)
+    if payment_id is not None:
+        transactions = transactions.filter(payment_id=payment_id)
+    if status:
+        transactions = transactions.filter(status=status)
+    if after_cursor:
+        created_at, tx_id = _decode_cursor(after_cursor)
+        transactions = transactions.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=tx_id)
+        )
+    rows = list(
+        transactions.order_by("-created_at", "-id").values_list(*TX_RESPONSE_FIELDS)[
+            : limit + 1
+        ]
+    )
+    items = [_charge_response_from_row(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = _encode_cursor(items[-1].tx_datetime, items[-1].tx_id)
+    return TransactionPage(items, next_cursor)
+
+
+@profiled
+@with_timeout
 def reverse(payment_id: int, tx_id: Optional[int] = None) -> bool:
     """Attempts to reverse a charge operation.
 
@@ -283,31 +717,68 @@ def reverse(payment_id: int, tx_id: Optional[int] = None) -> bool:
 
     :param payment_id: ID of payment on which to perform reversion.
     :param tx_id: ID of transaction on which to perform reversion.
+    :raises DeadlineExceeded: if the `timeout` ran out before the rollback was
+    sent. A reversion already created is marked as failed.
     """
+    transactions = Transaction.objects.only("id", "created_at", "merchant")
     if tx_id:
         try:
-            tx = Transaction.objects.get(id=tx_id)
+            tx = transactions.get(id=tx_id)
         except Transaction.DoesNotExist:
             return False
     else:
-        tx = Transaction.objects.filter(
+        tx = transactions.filter(
             status=Transaction.SUCCESS, payment_id=payment_id
         ).last()
         if not tx:
             return False
 
-    reversion = Reversion.objects.create(transaction=tx)
-
     # only transactions performed on same date can be rolled back.
     now = timezone.now()
     if now.date() > tx.created_at.date():
-        reversion.status = Reversion.FAIL
-        reversion.response_description = gettext_lazy(
-            "Only transactions performed on same date can be rolled back."
+        Reversion.objects.create(
+            transaction=tx,
+            status=Reversion.FAIL,
+            response_description=gettext_lazy(
+                "Only transactions performed on same date can be rolled back."
+            ),
         )
-        reversion.save()
         return False
-    is_success, vpos_response = bancard.rollback(tx.id)
+    gateway = get_gateway(tx.merchant)
+    gateway.check_deadline("/single_buy/rollback")
+    reversion = Reversion.objects.create(transaction=tx)
+    try:
+        is_success, vpos_response = gateway.rollback(tx.id)
+    except DeadlineExceeded:
+        reversion.status = Reversion.FAIL
+        reversion.response_description = gettext("Deadline exceeded.")
+        reversion.save(update_fields=["status", "response_description"])
+        raise
+    except TransientGatewayError as e:
+        # The reversion stays pending until the outbox worker retries it.
+        enqueue(OutboxEntry.ROLLBACK, tx.id, e, reversion.id)
+        return False
+    _update_reversion(reversion, is_success, vpos_response)
+    with transaction.atomic():
+        reversion.save(update_fields=REVERSION_UPDATE_FIELDS)
+        if is_success:
+            Transaction.objects.filter(id=tx.id).update(
+                status=Transaction.REVERSED, updated_at=timezone.now()
+            )
+    return is_success
+
+
+# Fields written by `_update_reversion`.
+REVERSION_UPDATE_FIELDS = ["status", "raw_response", "response_description"]
+
+
+def _update_reversion(reversion: Reversion, is_success: bool, vpos_response: dict):
+    """Updates the reversion with the rollback result sent from vPOS.
+
+    :param reversion: Reversion instance to be updated.
+    :param is_success: whether the rollback succeeded.
+    :param vpos_response: data from vPOS.
+    """
     reversion.status = Reversion.SUCCESS if is_success else Reversion.FAIL
     reversion.raw_response = vpos_response
     try:
@@ -316,29 +787,379 @@ def reverse(payment_id: int, tx_id: Optional[int] = None) -> bool:
         pass
     else:
         reversion.response_description = message.get("dsc", "")
-    tx.status = Transaction.REVERSED if is_success else tx.status
-    reversion.save()
-    tx.save()
-    return is_success
 
 
+def _next_midnight(now: datetime) -> datetime:
+    """Returns when charges performed on the date of `now` can no longer be
+    rolled back.
+    """
+    return datetime.combine(
+        now.date() + timedelta(days=1), datetime.min.time(), tzinfo=now.tzinfo
+    )
+
+
+def _estimate_reverse_bulk(
+    tx_ids: Optional[Iterable[int]],
+    filters: Optional[Dict[str, Any]],
+    max_concurrency: int,
+    expected_latency: Optional[float],
+    now: datetime,
+) -> Tuple[BulkReversionEstimate, Dict[int, str]]:
+    """Checks which transactions can be reversed, with a single query.
+
+    :returns: the estimate and the merchant of each transaction.
+    """
+    if tx_ids is None and not filters:
+        raise ValueError("Either tx_ids or filters must be provided.")
+    if tx_ids is not None:
+        transactions = Transaction.objects.filter(id__in=list(tx_ids))
+    else:
+        transactions = Transaction.objects.filter(**filters)
+
+    eligible, expired, ineligible = [], [], []
+    merchants = {}
+    for tx_id, status, created_at, merchant in transactions.values_list(
+        "id", "status", "created_at", "merchant"
+    ):
+        merchants[tx_id] = merchant
+        if status != Transaction.SUCCESS:
+            ineligible.append(tx_id)
+        elif now.date() > created_at.date():
+            expired.append(tx_id)
+        else:
+            eligible.append(tx_id)
+
+    if expected_latency is None:
+        expected_latency = bancard.get_latency("/single_buy/rollback", 50) or 1.0
+    waves = math.ceil(len(eligible) / max(1, max_concurrency))
+    seconds_to_deadline = (_next_midnight(now) - now).total_seconds()
+    timeout = remaining()
+    if timeout is not None:
+        seconds_to_deadline = min(seconds_to_deadline, timeout)
+    estimate = BulkReversionEstimate(
+        eligible=eligible,
+        expired=expired,
+        ineligible=ineligible,
+        estimated_seconds=waves * expected_latency,
+        seconds_to_deadline=seconds_to_deadline,
+    )
+    return estimate, merchants
+
+
+@with_timeout
+def estimate_reverse_bulk(
+    tx_ids: Optional[Iterable[int]] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    max_concurrency: int = 8,
+    expected_latency: Optional[float] = None,
+) -> BulkReversionEstimate:
+    """Tells what `reverse_bulk` would do with the same arguments, without
+    sending any rollback, so operators can check the estimate first.
+
+    :param tx_ids: IDs of transactions to reverse.
+    :param filters: `Transaction` lookups selecting the transactions to reverse,
+    used when no `tx_ids` are provided.
+    :param max_concurrency: max. number of simultaneous rollback requests.
+    :param expected_latency: expected duration in seconds of a single rollback
+    request. Defaults to the observed median, or 1 second before any rollback
+    was sent.
+    :raises ValueError: if neither `tx_ids` nor `filters` are provided.
+    """
+    estimate, _ = _estimate_reverse_bulk(
+        tx_ids, filters, max_concurrency, expected_latency, timezone.now()
+    )
+    return estimate
+
+
+@profiled
+@with_timeout
+@default_lane(LOW)
+def reverse_bulk(
+    tx_ids: Optional[Iterable[int]] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    max_concurrency: int = 8,
+    expected_latency: Optional[float] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    allow_overrun: bool = False,
+) -> BulkReversionResult:
+    """Attempts to reverse many successful charge operations at once.
+
+    Eligibility is checked in a single query, reversions are created with one
+    bulk insert, rollbacks are sent to vPOS concurrently and results are
+    written back in bulk. Like `reverse`, only transactions performed on the
+    current date can be rolled back; rollbacks that could not be sent before
+    midnight or the `timeout` are reported as failed. Rollbacks failing transiently are queued
+    in the outbox and reported as queued. Rollbacks go through the `low`
+    priority lane unless the caller picked one, see `bancard.lanes`.
+
+    Nothing is sent if the run is expected to take longer than the time left
+    before midnight or the `timeout`, see `estimate_reverse_bulk`.
+
+    :param tx_ids: IDs of transactions to reverse.
+    :param filters: `Transaction` lookups selecting the transactions to reverse,
+    used when no `tx_ids` are provided.
+    :param max_concurrency: max. number of simultaneous rollback requests.
+    :param expected_latency: expected duration in seconds of a single rollback
+    request, used to estimate how long the run will take. Defaults to the
+    observed median, or 1 second before any rollback was sent.
+    :param progress: called with the number of rollbacks sent so far and the
+    total, possibly from worker threads.
+    :param allow_overrun: start even if the run is expected to exceed the
+    deadline. Rollbacks that can't be sent in time are reported as failed.
+    :raises ValueError: if neither `tx_ids` nor `filters` are provided.
+    :raises DeadlineExceeded: if the run is expected to exceed the deadline
+    and `allow_overrun` is not set.
+    """
+    started = time.monotonic()
+    now = timezone.now()
+    deadline = _next_midnight(now)
+    estimate, merchants = _estimate_reverse_bulk(
+        tx_ids, filters, max_concurrency, expected_latency, now
+    )
+    if estimate.exceeds_deadline and not allow_overrun:
+        raise DeadlineExceeded(
+            f"Reversing {len(estimate.eligible)} transactions is expected to take "
+            f"{estimate.estimated_seconds:.0f}s, only "
+            f"{estimate.seconds_to_deadline:.0f}s are left."
+        )
+    eligible, expired = estimate.eligible, estimate.expired
+
+    reversions = Reversion.objects.bulk_create(
+        [Reversion(transaction_id=tx_id) for tx_id in eligible]
+        + [
+            Reversion(
+                transaction_id=tx_id,
+                status=Reversion.FAIL,
+                response_description=gettext_lazy(
+                    "Only transactions performed on same date can be rolled back."
+                ),
+            )
+            for tx_id in expired
+        ]
+    )[: len(eligible)]
+    if reversions and reversions[0].pk is None:
+        # Backends that cannot return primary keys from bulk inserts.
+        reversions = Reversion.objects.filter(
+            transaction_id__in=eligible, status=Reversion.PENDING
+        ).order_by("id")
+    reversions = {reversion.transaction_id: reversion for reversion in reversions}
+
+    def rollback(tx_id: int) -> Tuple[Optional[bool], Any]:
+        if timezone.now() >= deadline:
+            return False, {}
+        try:
+            return get_gateway(merchants[tx_id]).rollback(tx_id)
+        except DeadlineExceeded:
+            return False, {}
+        except TransientGatewayError as e:
+            return None, e
+
+    results = run_concurrently(rollback, eligible, max_concurrency, progress)
+    reversed_ids, failed_ids, queued = [], [], []
+    for tx_id, (is_success, vpos_response) in zip(eligible, results):
+        if is_success is None:
+            queued.append(
+                OutboxEntry(
+                    operation=OutboxEntry.ROLLBACK,
+                    transaction_id=tx_id,
+                    reversion=reversions.pop(tx_id),
+                    next_attempt_at=timezone.now() + backoff_delay(0),
+                    last_error=str(vpos_response)[:250],
+                )
+            )
+            continue
+        _update_reversion(reversions[tx_id], is_success, vpos_response)
+        (reversed_ids if is_success else failed_ids).append(tx_id)
+
+    with transaction.atomic():
+        OutboxEntry.objects.bulk_create(queued)
+        Reversion.objects.bulk_update(reversions.values(), REVERSION_UPDATE_FIELDS)
+        Transaction.objects.filter(id__in=reversed_ids).update(
+            status=Transaction.REVERSED, updated_at=timezone.now()
+        )
+    return BulkReversionResult(
+        reversed=reversed_ids,
+        failed=failed_ids + expired,
+        queued=[entry.transaction_id for entry in queued],
+        ineligible=estimate.ineligible,
+        estimated_seconds=estimate.estimated_seconds,
+        seconds_to_deadline=estimate.seconds_to_deadline,
+        elapsed_seconds=time.monotonic() - started,
+    )
+
+
+# Largest transaction ID, transactions have a `BigAutoField` primary key.
+MAX_TX_ID = 2**63 - 1
+
+# Callback operation fields that must be strings, see `_check_callback`.
+CALLBACK_STRING_FIELDS = ("token", "amount", "currency", "response_code")
+
+
+def _check_callback(data: Any) -> Optional[str]:
+    """Checks the structure of callback data without any DB access.
+
+    :param data: data sent from Bancard vPOS.
+    :returns: why the callback is rejected, or `None` if it may be processed.
+    """
+    operation = data.get("operation") if isinstance(data, dict) else None
+    if not isinstance(operation, dict):
+        return "malformed"
+    shop_process_id = operation.get("shop_process_id")
+    if isinstance(shop_process_id, str):
+        is_id = shop_process_id.isascii() and shop_process_id.isdigit()
+        # Longer strings are out of range, and slow to convert.
+        shop_process_id = (
+            int(shop_process_id) if is_id and len(shop_process_id) < 20 else None
+        )
+    if type(shop_process_id) is not int or not 0 < shop_process_id <= MAX_TX_ID:
+        return "malformed"
+    if not all(isinstance(operation.get(key), str) for key in CALLBACK_STRING_FIELDS):
+        return "malformed"
+    if not isinstance(operation.get("security_information"), dict):
+        return "malformed"
+    return None
+
+
+def _reject_callback(reason: str) -> Tuple[Dict[str, Any], int]:
+    metrics.increment(f"callbacks.rejected.{reason}")
+    return {"status": "fail"}, 400
+
+
+def _is_signed_confirmation(data: dict) -> bool:
+    """Checks whether a callback is a single buy confirmation signed with the
+    private key of a merchant, without any DB access.
+    """
+    return any(gateway.has_confirmation_token(data) for gateway in gateways.all())
+
+
+def _get_charge_transaction(data: dict) -> QuerySet:
+    """Returns the card charge a callback refers to. Unsigned tokens can only
+    be the one sent with a charge, so this lookup is their verification.
+    Tokens that can't have been sent with a charge match nothing, without
+    any DB access.
+    """
+    operation = data["operation"]
+    if not re.fullmatch(r"[0-9a-f]{32}", operation["token"]):
+        return Transaction.objects.none()
+    return Transaction.objects.defer("raw_response").filter(
+        id=operation["shop_process_id"], card__isnull=False, token=operation["token"]
+    )
+
+
+def _callback_fingerprint(data: dict) -> str:
+    """Identifies a callback by its shop process ID, token and response code,
+    which are the same on every redelivery.
+
+    :param data: data sent from Bancard vPOS, accepted by `_check_callback`.
+    """
+    operation = data["operation"]
+    key = "{shop_process_id}:{token}:{response_code}".format(**operation)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+@profiled
 def callback(data: dict) -> Tuple[Dict[str, Any], int]:
     """Handles data from bancard to the callback URL that was set in business configuration.
 
+    Malformed callbacks and single buy confirmations with an invalid
+    signature are rejected before any DB access, other tokens after looking up
+    the charge they were sent with. Redelivered callbacks are acknowledged
+    without updating the transaction or sending `transaction_updated` again.
+    Rejections are counted in the `callbacks.rejected.<reason>` metrics.
+
     :param data: data sent from Bancard vPOS.
     :returns: tuple with message and status for Bancard vPOS.
     """
-    response = bancard.callback(data)
-    if response:
+    reason = _check_callback(data)
+    if reason:
+        return _reject_callback(reason)
+    tx = None
+    if not _is_signed_confirmation(data):
+        tx = _get_charge_transaction(data).first()
+        if tx is None:
+            return _reject_callback("unknown_transaction")
+    fingerprint = _callback_fingerprint(data)
+    if ProcessedCallback.objects.filter(fingerprint=fingerprint).exists():
+        return {"status": "success"}, 200
+    if tx is None:
         try:
-            tx = Transaction.objects.get(id=response["tx_id"])
+            tx = Transaction.objects.defer("raw_response").get(
+                id=data["operation"]["shop_process_id"]
+            )
         except Transaction.DoesNotExist:
-            pass
-        else:
-            _update_transaction(tx, response)
-            tx.save()
-            transaction_updated.send(
-                sender=callback, response=_make_charge_response(tx)
+            return _reject_callback("unknown_transaction")
+    try:
+        gateway = get_gateway(tx.merchant)
+    except ImproperlyConfigured:
+        # The merchant was removed from the settings.
+        return _reject_callback("unknown_merchant")
+    # Verified again with the key of the merchant the transaction belongs to.
+    response = gateway.verify_callback(data, tx)
+    if not response:
+        return _reject_callback("invalid_token")
+    _update_transaction(tx, response)
+    try:
+        _save_callback(tx, fingerprint)
+    except IntegrityError:
+        # A concurrent delivery of the same callback was processed first.
+        return {"status": "success"}, 200
+    send_transaction_updated(sender=callback, response=_make_charge_response(tx))
+    return {"status": "success"}, 200
+
+
+def _save_callback(tx: Transaction, fingerprint: str) -> None:
+    """Records the callback fingerprint and saves the updated transaction
+    atomically.
+
+    :raises IntegrityError: if the callback was already processed.
+    """
+    with transaction.atomic():
+        ProcessedCallback.objects.create(fingerprint=fingerprint, transaction=tx)
+        tx.save(update_fields=UPDATE_FIELDS)
+
+
+@profiled
+async def acallback(data: dict) -> Tuple[Dict[str, Any], int]:
+    """Async version of `callback`, for ASGI deployments.
+
+    Reads go through the async ORM; the atomic write takes a single thread
+    hop since Django doesn't support transactions in async code yet.
+    `transaction_updated` is sent with `callback` as sender, like `callback`.
+
+    :param data: data sent from Bancard vPOS.
+    :returns: tuple with message and status for Bancard vPOS.
+    """
+    reason = _check_callback(data)
+    if reason:
+        return _reject_callback(reason)
+    tx = None
+    if not _is_signed_confirmation(data):
+        tx = await _get_charge_transaction(data).afirst()
+        if tx is None:
+            return _reject_callback("unknown_transaction")
+    fingerprint = _callback_fingerprint(data)
+    if await ProcessedCallback.objects.filter(fingerprint=fingerprint).aexists():
+        return {"status": "success"}, 200
+    if tx is None:
+        try:
+            tx = await Transaction.objects.defer("raw_response").aget(
+                id=data["operation"]["shop_process_id"]
             )
-            return {"status": "success"}, 200
-    return {"status": "fail"}, 400
+        except Transaction.DoesNotExist:
+            return _reject_callback("unknown_transaction")
+    try:
+        gateway = get_gateway(tx.merchant)
+    except ImproperlyConfigured:
+        # The merchant was removed from the settings.
+        return _reject_callback("unknown_merchant")
+    # Verified again with the key of the merchant the transaction belongs to.
+    response = gateway.verify_callback(data, tx)
+    if not response:
+        return _reject_callback("invalid_token")
+    _update_transaction(tx, response)
+    try:
+        await sync_to_async(_save_callback)(tx, fingerprint)
+    except IntegrityError:
+        return {"status": "success"}, 200
+    await asend_transaction_updated(sender=callback, response=_make_charge_response(tx))
+    return {"status": "success"}, 200
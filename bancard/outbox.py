@@ -0,0 +1,164 @@
+import logging
+import random
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .exceptions import DeadlineExceeded, TransientGatewayError
+from .gateway import get_gateway
+from .lanes import LOW, default_lane
+from .models import OutboxEntry, Transaction, Reversion
+from .signals import send_transaction_updated
+
+logger = logging.getLogger(__name__)
+
+
+def _get_config(name: str, default):
+    return getattr(settings, "BANCARD_OUTBOX", {}).get(name, default)
+
+
+def backoff_delay(attempts: int) -> timedelta:
+    """Returns the delay before the next attempt: exponential backoff capped
+    at `MAX_DELAY` with "equal jitter" (half fixed, half random).
+
+    :param attempts: number of attempts made so far.
+    """
+    base = _get_config("BASE_DELAY", 5)
+    delay = min(_get_config("MAX_DELAY", 3600), base * 2**attempts)
+    return timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+def enqueue(
+    operation: str,
+    tx_id: int,
+    error: Exception,
+    reversion_id: Optional[int] = None,
+) -> OutboxEntry:
+    """Records a gateway operation that failed transiently so the outbox
+    worker retries it. Pending entries are not duplicated.
+
+    :param operation: `OutboxEntry` operation.
+    :param tx_id: ID of transaction the operation belongs to.
+    :param error: the transient error.
+    :param reversion_id: ID of reversion the operation belongs to (rollbacks).
+    """
+    entry, _ = OutboxEntry.objects.get_or_create(
+        operation=operation,
+        transaction_id=tx_id,
+        reversion_id=reversion_id,
+        status=OutboxEntry.PENDING,
+        defaults={
+            "next_attempt_at": timezone.now() + backoff_delay(0),
+            "last_error": str(error)[:250],
+        },
+    )
+    return entry
+
+
+def _claim_due_entries(batch_size: int):
+    """Selects due entries and pushes their next attempt forward, so other
+    workers don't pick them up while they are being processed.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            OutboxEntry.objects.select_for_update(
+                skip_locked=connection.features.has_select_for_update_skip_locked
+            )
+            .filter(status=OutboxEntry.PENDING, next_attempt_at__lte=now)
+            .order_by("next_attempt_at")[:batch_size]
+        )
+        OutboxEntry.objects.filter(id__in=[entry.id for entry in entries]).update(
+            next_attempt_at=now + timedelta(seconds=_get_config("LEASE", 300))
+        )
+    return entries
+
+
+def _retry_confirmation(entry: OutboxEntry) -> None:
+    from .operations import _update_transaction, _make_charge_response, UPDATE_FIELDS
+
+    tx = entry.transaction
+    if tx.status != Transaction.PENDING:
+        # Already resolved, e.g. by a vPOS callback.
+        return
+    gw_response = get_gateway(tx.merchant).get_single_buy_confirmation(tx.id)
+    if gw_response:
+        _update_transaction(tx, gw_response)
+        tx.save(update_fields=UPDATE_FIELDS)
+    else:
+        tx.status = Transaction.FAIL
+        tx.save(update_fields=["status", "updated_at"])
+    send_transaction_updated(sender=process_outbox, response=_make_charge_response(tx))
+
+
+def _retry_rollback(entry: OutboxEntry) -> None:
+    from .operations import _update_reversion, REVERSION_UPDATE_FIELDS
+
+    reversion = entry.reversion
+    is_success, vpos_response = get_gateway(entry.transaction.merchant).rollback(
+        entry.transaction_id
+    )
+    _update_reversion(reversion, is_success, vpos_response)
+    with transaction.atomic():
+        reversion.save(update_fields=REVERSION_UPDATE_FIELDS)
+        if is_success:
+            Transaction.objects.filter(id=entry.transaction_id).update(
+                status=Transaction.REVERSED, updated_at=timezone.now()
+            )
+
+
+HANDLERS = {
+    OutboxEntry.CONFIRMATION: _retry_confirmation,
+    OutboxEntry.ROLLBACK: _retry_rollback,
+}
+
+
+@default_lane(LOW)
+def process_outbox(batch_size: int = 100) -> int:
+    """Retries due outbox entries.
+
+    Entries failing transiently again, or running out of time, are
+    rescheduled with exponential backoff and marked as failed after
+    `MAX_ATTEMPTS` attempts. Entries failing with any other error, e.g. a
+    4xx answer or a merchant removed from the settings, won't succeed later
+    and are marked as failed right away. Failed rollbacks also mark their
+    reversion as failed. Retries go through the `low` priority lane unless
+    the caller picked one.
+
+    :param batch_size: max. number of entries to process.
+    :returns: number of processed entries.
+    """
+    entries = _claim_due_entries(batch_size)
+    max_attempts = _get_config("MAX_ATTEMPTS", 10)
+    for entry in entries:
+        entry.attempts += 1
+        try:
+            HANDLERS[entry.operation](entry)
+        except Exception as e:
+            entry.last_error = str(e)[:250]
+            transient = isinstance(e, (TransientGatewayError, DeadlineExceeded))
+            if not transient:
+                logger.exception("Outbox entry %s failed.", entry.id)
+            if not transient or entry.attempts >= max_attempts:
+                entry.status = OutboxEntry.FAIL
+                if entry.reversion_id:
+                    Reversion.objects.filter(id=entry.reversion_id).update(
+                        status=Reversion.FAIL
+                    )
+            else:
+                entry.next_attempt_at = timezone.now() + backoff_delay(entry.attempts)
+        else:
+            entry.status = OutboxEntry.DONE
+        entry.save(
+            update_fields=[
+                "attempts",
+                "status",
+                "last_error",
+                "next_attempt_at",
+                "updated_at",
+            ]
+        )
+    return len(entries)
@@ -0,0 +1,248 @@
+"""Opt-in profiling of slow operations.
+
+Configured with the `BANCARD_PROFILING` setting::
+
+    BANCARD_PROFILING = {
+        "SAMPLE_RATE": 0.01,  # fraction of calls profiled
+        "THRESHOLD": 1.0,  # seconds, profiles of faster calls are discarded
+        "SINK": {
+            "BACKEND": "bancard.profiling.DirectorySink",
+            "OPTIONS": {"path": "/var/tmp/bancard-profiles", "max_bytes": 50 * 2**20},
+        },
+    }
+
+Sampled calls to operations in `bancard.operations` run under `cProfile` and
+record the time spent in DB queries and vPOS requests, including those made
+from worker threads. Calls slower than `THRESHOLD` are handed to the sink.
+Async operations are timed but not profiled, `cProfile` can't follow
+coroutines. Operations called by another profiled operation are part of its
+profile. Calls aren't profiled if the setting is missing.
+"""
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+from contextvars import ContextVar
+from functools import lru_cache, wraps
+from inspect import iscoroutinefunction
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import metrics
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional["CallProfile"]] = ContextVar(
+    "bancard_profile", default=None
+)
+
+
+class CallProfile:
+    """Time breakdown of a single operation call."""
+
+    def __init__(self, operation: str) -> None:
+        self.operation = operation
+        self.started_at = time.time()
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.gateway_seconds = 0.0
+        self.gateway_requests: List[Tuple[str, float]] = []
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def add_query(self, seconds: float) -> None:
+        with self._lock:
+            self.db_seconds += seconds
+            self.db_queries += 1
+
+    def add_request(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            self.gateway_seconds += seconds
+            self.gateway_requests.append((endpoint, seconds))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "operation": self.operation,
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+            "db_seconds": self.db_seconds,
+            "db_queries": self.db_queries,
+            "gateway_seconds": self.gateway_seconds,
+            "gateway_requests": self.gateway_requests,
+            "error": self.error,
+        }
+
+
+def record_request(endpoint: str, seconds: float) -> None:
+    """Adds a vPOS request to the profile of the current call, if any."""
+    call = _current.get()
+    if call:
+        call.add_request(endpoint, seconds)
+
+
+def time_query(execute, sql, params, many, context):
+    """Database execute wrapper adding queries to the profile of the current
+    call, if any. Installed on every connection when profiling is enabled.
+    """
+    call = _current.get()
+    if call is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        call.add_query(time.perf_counter() - start)
+
+
+def install_query_timer(sender, connection, **kwargs) -> None:
+    """`connection_created` receiver installing `time_query`."""
+    connection.execute_wrappers.append(time_query)
+
+
+class DirectorySink:
+    """Writes each profile to `path` as `<name>.prof` (`pstats` format, e.g.
+    for `snakeviz`) and `<name>.json` (time breakdown). The oldest files are
+    deleted once the directory holds more than `max_bytes`.
+
+    :param path: directory to write to. Defaults to `bancard-profiles` in the
+    system temporary directory.
+    :param max_bytes: max. total size of the files written.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 50 * 2**20):
+        self.path = path or os.path.join(tempfile.gettempdir(), "bancard-profiles")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def write(self, call: CallProfile, stats: Optional[pstats.Stats]) -> None:
+        name = "{}-{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(call.started_at)),
+            call.operation,
+            random.getrandbits(32),
+        )
+        with self._lock:
+            if stats:
+                stats.dump_stats(os.path.join(self.path, f"{name}.prof"))
+            with open(os.path.join(self.path, f"{name}.json"), "w") as f:
+                json.dump(call.to_dict(), f)
+            self.prune()
+
+    def prune(self) -> None:
+        """Deletes the oldest files until the directory fits `max_bytes`."""
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith((".prof", ".json")):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+class Profiler:
+    """Samples calls and keeps the profiles of slow ones, see the module
+    docstring for its configuration.
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.sample_rate = config.get("SAMPLE_RATE", 0.01)
+        self.threshold = config.get("THRESHOLD", 1.0)
+        sink = config.get("SINK", {})
+        self.sink = import_string(
+            sink.get("BACKEND", "bancard.profiling.DirectorySink")
+        )(**sink.get("OPTIONS", {}))
+
+    def should_sample(self) -> bool:
+        # Operations called from a profiled one are part of its profile.
+        return _current.get() is None and random.random() < self.sample_rate
+
+    def run(self, func: Callable[..., T], args, kwargs) -> T:
+        call = CallProfile(func.__name__)
+        token = _current.set(call)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this thread.
+            profile = None
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            call.error = repr(e)
+            raise
+        finally:
+            if profile:
+                profile.disable()
+            call.seconds = time.perf_counter() - start
+            _current.reset(token)
+            self.keep(call, profile)
+
+    async def arun(self, func: Callable[..., Any], args, kwargs) -> Any:
+        call = CallProfile(func.__name__)
+        token = _current.set(call)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            call.error = repr(e)
+            raise
+        finally:
+            call.seconds = time.perf_counter() - start
+            _current.reset(token)
+            self.keep(call, None)
+
+    def keep(self, call: CallProfile, profile: Optional[cProfile.Profile]) -> None:
+        """Hands the profile to the sink if the call was slow."""
+        metrics.increment(f"profiling.{call.operation}.sampled")
+        if call.seconds < self.threshold:
+            return
+        metrics.increment(f"profiling.{call.operation}.kept")
+        try:
+            self.sink.write(call, pstats.Stats(profile) if profile else None)
+        except Exception:
+            logger.exception("Could not write profile of %s.", call.operation)
+
+
+@lru_cache(maxsize=None)
+def get_profiler() -> Optional[Profiler]:
+    config = getattr(settings, "BANCARD_PROFILING", None)
+    return Profiler(config) if config else None
+
+
+def profiled(func: Callable[..., T]) -> Callable[..., T]:
+    """Profiles a sample of the calls to `func` when profiling is enabled."""
+    if iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            profiler = get_profiler()
+            if profiler is None or not profiler.should_sample():
+                return await func(*args, **kwargs)
+            return await profiler.arun(func, args, kwargs)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs) -> T:
+        profiler = get_profiler()
+        if profiler is None or not profiler.should_sample():
+            return func(*args, **kwargs)
+        return profiler.run(func, args, kwargs)
+
+    return wrapper
@@ -0,0 +1,255 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List
+
+from django.core.cache import caches
+
+from .metrics import metrics
+
+
+class _LocalStore:
+    """Bucket state kept in the current process."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._count = 0
+
+    def get_start(self) -> float:
+        return self._start
+
+    def incr(self, delta: int) -> int:
+        with self._lock:
+            self._count += delta
+            return self._count
+
+
+class _CacheStore:
+    """Bucket state kept in a Django cache, shared by every process using it.
+    Relies on the atomicity of `cache.add` and `cache.incr`.
+    """
+
+    def __init__(self, alias: str, key: str, ttl: Optional[int] = None) -> None:
+        self.cache = caches[alias]
+        self.start_key = f"{key}:start"
+        self.count_key = f"{key}:count"
+        self.ttl = ttl
+
+    def get_start(self) -> float:
+        self.cache.add(self.start_key, time.time(), self.ttl)
+        start = self.cache.get(self.start_key)
+        if start is None:
+            # Evicted between both calls.
+            start = time.time()
+            self.cache.set(self.start_key, start, self.ttl)
+        return start
+
+    def incr(self, delta: int) -> int:
+        self.cache.add(self.count_key, 0, self.ttl)
+        try:
+            if delta < 0:
+                return self.cache.decr(self.count_key, -delta)
+            return self.cache.incr(self.count_key, delta)
+        except ValueError:
+            # Evicted between both calls.
+            self.cache.set(self.count_key, max(delta, 0), self.ttl)
+            return max(delta, 0)
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second up to `burst` tokens.
+
+    It is implemented as a counter of issued tokens: the n-th token becomes
+    available `(n - burst) / rate` seconds after the bucket was created, so
+    taking a token is a single atomic increment and the state can be shared
+    through a cache.
+
+    :param name: bucket name, used for cache keys and metrics.
+    :param rate: tokens added per second.
+    :param burst: bucket size. Defaults to `rate` (one second worth of tokens).
+    :param cache_alias: Django cache holding the bucket state. The bucket is
+    local to the process if not set.
+    :param ttl: seconds the state is kept in the cache. Forever if not set.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: Optional[int] = None,
+        cache_alias: Optional[str] = None,
+        ttl: Optional[int] = None,
+    ) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        if cache_alias:
+            self.store = _CacheStore(cache_alias, f"bancard:ratelimit:{name}", ttl)
+        else:
+            self.store = _LocalStore()
+
+    def reserve(self, tokens: int = 1) -> float:
+        """Takes `tokens` and returns the seconds to wait before using them."""
+        now = time.time()
+        start = self.store.get_start()
+        issued = self.store.incr(tokens)
+        # Tokens not taken while idle don't accumulate beyond the burst size.
+        lag = int((now - start) * self.rate - (issued - tokens))
+        if lag > 0:
+            issued = self.store.incr(lag)
+        ready_at = start + (issued - self.burst) / self.rate
+        return max(0.0, ready_at - now)
+
+    def cancel(self, tokens: int = 1) -> None:
+        """Gives back tokens taken by a reservation that won't be used."""
+        self.store.incr(-tokens)
+
+    def acquire(
+        self, tokens: int = 1, blocking: bool = True, timeout: Optional[float] = None
+    ) -> bool:
+        """Takes `tokens` from the bucket.
+
+        :param tokens: number of tokens to take.
+        :param blocking: wait until tokens are available. Otherwise return
+        `False` right away if they aren't.
+        :param timeout: max. seconds to wait when blocking.
+        :returns: whether the tokens were taken.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0 and (not blocking or (timeout is not None and wait > timeout)):
+            self.cancel(tokens)
+            metrics.increment(f"ratelimit.{self.name}.rejected")
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        metrics.observe(f"ratelimit.{self.name}.wait_seconds", wait)
+        return True
+
+
+class RateLimiter:
+    """Rate limits requests to vPOS endpoints.
+
+    Configured with the `BANCARD_RATE_LIMIT` setting::
+
+        BANCARD_RATE_LIMIT = {
+            "CACHE": "default",  # None to keep buckets per process
+            "TIMEOUT": 5,  # max. seconds a blocking acquire waits
+            "ENDPOINTS": {
+                "*": {"rate": 20, "burst": 20},  # applies to every request
+                "/charge": {"rate": 5},
+                "/users/{id}/cards": {"rate": 10, "burst": 30},
+            },
+        }
+
+    Endpoints are matched with numeric path segments replaced by `{id}`.
+    Requests are not limited if the setting is missing.
+    """
+
+    def __init__(self, config: Dict[str, Any], namespace: str = "vpos") -> None:
+        self.timeout = config.get("TIMEOUT", 5)
+        self.buckets = {
+            endpoint: TokenBucket(
+                f"{namespace}:{endpoint}",
+                limits["rate"],
+                limits.get("burst"),
+                config.get("CACHE"),
+            )
+            for endpoint, limits in config.get("ENDPOINTS", {}).items()
+        }
+
+    @staticmethod
+    def get_endpoint(path: str) -> str:
+        return re.sub(r"/\d+", "/{id}", path)
+
+    def get_buckets(self, path: str) -> List[TokenBucket]:
+        endpoint = self.get_endpoint(path)
+        return [
+            self.buckets[name] for name in ("*", endpoint) if name in self.buckets
+        ]
+
+    def acquire(
+        self, path: str, blocking: bool = True, timeout: Optional[float] = None
+    ) -> bool:
+        """Takes a token for a request to `path` from every bucket applying to it.
+
+        :param path: vPOS API path of the request.
+        :param blocking: wait until tokens are available.
+        :param timeout: max. seconds to wait. Defaults to the configured timeout.
+        :returns: whether the request may be sent.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        taken = []
+        for bucket in self.get_buckets(path):
+            started = time.monotonic()
+            if not bucket.acquire(blocking=blocking, timeout=timeout):
+                for other in taken:
+                    other.cancel()
+                return False
+            timeout = max(0.0, timeout - (time.monotonic() - started))
+            taken.append(bucket)
+        return True
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Returns wait time and rejection metrics of the rate limit buckets."""
+        return metrics.snapshot("ratelimit.")
+
+
+class KeyedRateLimiter:
+    """One token bucket per key, e.g. per client IP address, created on demand.
+
+    Without a cache at most `max_keys` buckets are kept, dropping the least
+    recently used first. In a cache, bucket state expires once idle long
+    enough to have refilled. Rejections are counted in the
+    `ratelimit.<name>.rejected` metric, not per key.
+
+    :param name: limiter name, used for cache keys and metrics.
+    :param rate: tokens added per second to each bucket.
+    :param burst: bucket size. Defaults to `rate`.
+    :param cache_alias: Django cache holding the bucket state.
+    :param max_keys: max. number of buckets kept in the process.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: Optional[int] = None,
+        cache_alias: Optional[str] = None,
+        max_keys: int = 10000,
+    ) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.cache_alias = cache_alias
+        self.max_keys = max_keys
+        self.ttl = int(self.burst / rate) + 60
+        self._lock = threading.Lock()
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def get_bucket(self, key: str) -> TokenBucket:
+        if self.cache_alias:
+            return TokenBucket(
+                f"{self.name}:{key}", self.rate, self.burst, self.cache_alias, self.ttl
+            )
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or TokenBucket(
+                f"{self.name}:{key}", self.rate, self.burst
+            )
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return bucket
+
+    def allow(self, key: str) -> bool:
+        """Takes a token from the bucket of `key` without waiting.
+
+        :returns: whether a token was available.
+        """
+        bucket = self.get_bucket(key)
+        if bucket.reserve() > 0:
+            bucket.cancel()
+            metrics.increment(f"ratelimit.{self.name}.rejected")
+            return False
+        return True
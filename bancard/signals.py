@@ -1,4 +1,178 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
 import django.dispatch
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+
+from .metrics import metrics
+
 
+logger = logging.getLogger(__name__)
 
 transaction_updated = django.dispatch.Signal()
+
+
+@dataclass(frozen=True)
+class ReceiverResult:
+    """Outcome of a single receiver call, like the pairs of `send_robust`."""
+
+    receiver: Callable
+    response: Any
+    error: Optional[Exception]
+    duration: float
+
+
+class ThreadPoolBackend:
+    """Runs receivers on a bounded pool of worker threads."""
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="bancard-signals"
+        )
+
+    def submit(self, func: Callable, *args) -> None:
+        self.executor.submit(func, *args)
+
+
+@lru_cache(maxsize=None)
+def get_dispatch_backend():
+    """Returns the task backend configured in `BANCARD_SIGNAL_DISPATCH`.
+
+    Backends only need a `submit(func, *args)` method that eventually calls
+    `func(*args)`.
+    """
+    config = getattr(settings, "BANCARD_SIGNAL_DISPATCH", {})
+    backend = config.get("BACKEND", "bancard.signals.ThreadPoolBackend")
+    return import_string(backend)(**config.get("OPTIONS", {}))
+
+
+def _get_receiver_name(receiver: Callable) -> str:
+    return "{}.{}".format(
+        getattr(receiver, "__module__", ""),
+        getattr(receiver, "__qualname__", repr(receiver)),
+    )
+
+
+def _split_receivers(
+    signal: django.dispatch.Signal, sender
+) -> Tuple[List[Callable], List[Callable]]:
+    receivers = signal._live_receivers(sender)
+    if isinstance(receivers, tuple):
+        # Django >= 5.0 returns sync and async receivers separately.
+        return list(receivers[0]), list(receivers[1])
+    return list(receivers), []
+
+
+def _live_receivers(signal: django.dispatch.Signal, sender) -> List[Callable]:
+    sync_receivers, async_receivers = _split_receivers(signal, sender)
+    return sync_receivers + [async_to_sync(receiver) for receiver in async_receivers]
+
+
+def run_receiver(
+    receiver: Callable,
+    signal: django.dispatch.Signal,
+    sender,
+    named: Dict[str, Any],
+    close_connections: bool = False,
+) -> ReceiverResult:
+    """Calls a single receiver, timing it and isolating its exceptions.
+
+    :param close_connections: close stale DB connections around the call, for
+    receivers running outside the request/response cycle.
+    """
+    name = _get_receiver_name(receiver)
+    if close_connections:
+        close_old_connections()
+    start = time.perf_counter()
+    response, error = None, None
+    try:
+        response = receiver(signal=signal, sender=sender, **named)
+    except Exception as e:
+        logger.exception("Receiver %s of %s failed.", name, sender)
+        metrics.increment(f"signals.{name}.errors")
+        error = e
+    finally:
+        if close_connections:
+            close_old_connections()
+    duration = time.perf_counter() - start
+    metrics.observe(f"signals.{name}.seconds", duration)
+    return ReceiverResult(receiver, response, error, duration)
+
+
+def send_transaction_updated(sender, **named) -> List[ReceiverResult]:
+    """Sends `transaction_updated`, honouring `BANCARD_SIGNAL_DISPATCH["MODE"]`.
+
+    In "sync" mode (default) receivers run right away and a report with their
+    response or exception and duration is returned. In "deferred" mode
+    receivers are handed to the dispatch backend once the current DB
+    transaction commits, and an empty report is returned; per-receiver
+    timings and errors are still recorded in `bancard.metrics`.
+
+    In both modes a failing receiver doesn't stop the others.
+    """
+    signal = transaction_updated
+    if not signal.has_listeners(sender):
+        return []
+    config = getattr(settings, "BANCARD_SIGNAL_DISPATCH", {})
+    receivers = _live_receivers(signal, sender)
+    if config.get("MODE", "sync") != "deferred":
+        return [run_receiver(r, signal, sender, named) for r in receivers]
+
+    def dispatch():
+        backend = get_dispatch_backend()
+        for receiver in receivers:
+            backend.submit(run_receiver, receiver, signal, sender, named, True)
+
+    transaction.on_commit(dispatch)
+    return []
+
+
+async def arun_receiver(
+    receiver: Callable, signal: django.dispatch.Signal, sender, named: Dict[str, Any]
+) -> ReceiverResult:
+    """Awaits a single async receiver, like `run_receiver`."""
+    name = _get_receiver_name(receiver)
+    start = time.perf_counter()
+    response, error = None, None
+    try:
+        response = await receiver(signal=signal, sender=sender, **named)
+    except Exception as e:
+        logger.exception("Receiver %s of %s failed.", name, sender)
+        metrics.increment(f"signals.{name}.errors")
+        error = e
+    duration = time.perf_counter() - start
+    metrics.observe(f"signals.{name}.seconds", duration)
+    return ReceiverResult(receiver, response, error, duration)
+
+
+async def asend_transaction_updated(sender, **named) -> List[ReceiverResult]:
+    """Async version of `send_transaction_updated`.
+
+    In "sync" mode async receivers (Django >= 5.0) are awaited concurrently
+    with sync ones, which run together in a single thread. "deferred" mode
+    behaves like `send_transaction_updated`.
+    """
+    signal = transaction_updated
+    if not signal.has_listeners(sender):
+        return []
+    config = getattr(settings, "BANCARD_SIGNAL_DISPATCH", {})
+    if config.get("MODE", "sync") == "deferred":
+        return await sync_to_async(send_transaction_updated)(sender, **named)
+    sync_receivers, async_receivers = _split_receivers(signal, sender)
+
+    def run_sync_receivers() -> List[ReceiverResult]:
+        return [run_receiver(r, signal, sender, named) for r in sync_receivers]
+
+    results = await asyncio.gather(
+        sync_to_async(run_sync_receivers)(),
+        *(arun_receiver(r, signal, sender, named) for r in async_receivers),
+    )
+    return results[0] + list(results[1:])
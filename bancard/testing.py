@@ -0,0 +1,70 @@
+"""Helpers for projects testing their bancard integration."""
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+# Max. number of queries each public operation may run, transaction control
+# statements excluded. Operations working on many rows have a constant budget
+# regardless of the number of rows.
+QUERY_BUDGETS = {
+    "get_default_card": 1,
+    "get_default_cards": 1,
+    "get_cards": 1,
+    "get_cards_for_users": 1,
+    "get_card": 1,
+    "init_card_registration": 4,
+    "confirm_card_registration": 3,
+    "set_default_card": 3,
+    "delete_card": 3,
+    # card check, INSERT and UPDATE of the transaction, plus SELECT and INSERT
+    # of an outbox entry when the charge outcome is unknown
+    "charge_card": 5,
+    "init_single_buy": 1,
+    # SELECT and UPDATE of the transaction, or SELECT and INSERT of an outbox
+    # entry instead of the UPDATE when vPOS can't be reached
+    "get_transaction_status": 3,
+    "get_transaction_statuses": 1,
+    # SELECT transactions, bulk UPDATEs of confirmed and failed transactions,
+    # plus SELECT and INSERT of outbox entries when lookups are queued
+    "refresh_transaction_statuses": 5,
+    "list_transactions": 1,
+    # SELECT transaction, INSERT and UPDATE reversion, UPDATE transaction
+    "reverse": 4,
+    # plus one INSERT of outbox entries when rollbacks are queued
+    "reverse_bulk": 5,
+    # fingerprint check, SELECT transaction, INSERT fingerprint, UPDATE transaction
+    "callback": 4,
+}
+
+TRANSACTION_CONTROL = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK", "BEGIN", "COMMIT")
+
+
+@contextmanager
+def assert_query_budget(operation: str, using: str = DEFAULT_DB_ALIAS):
+    """Fails if the code inside the block runs more queries than allowed for
+    `operation` in `QUERY_BUDGETS`.
+
+    Usage::
+
+        with assert_query_budget("charge_card"):
+            operations.charge_card(...)
+
+    :param operation: name of the operation in `QUERY_BUDGETS`.
+    :param using: alias of the database to watch.
+    """
+    budget = QUERY_BUDGETS[operation]
+    with CaptureQueriesContext(connections[using]) as context:
+        yield context
+    queries = [
+        query["sql"]
+        for query in context.captured_queries
+        if not query["sql"].upper().startswith(TRANSACTION_CONTROL)
+    ]
+    if len(queries) > budget:
+        raise AssertionError(
+            "{} ran {} queries, over its budget of {}:\n{}".format(
+                operation, len(queries), budget, "\n".join(queries)
+            )
+        )
@@ -1,3 +1,1298 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signing import Signer
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import path, reverse
+from django.utils import timezone
+
+from . import (
+    admin as admin_module,
+    deadlines,
+    jobs,
+    operations,
+    outbox,
+    profiling,
+    ratelimit,
+)
+from .deadlines import deadline, remaining, with_timeout
+from .exceptions import DeadlineExceeded, RateLimited, TransientGatewayError
+from .gateway import BancardGateway, bancard, gateways
+from .audit import REDACTED, AuditLog
+from .hedging import Hedger
+from .lanes import LOW, lane
+from .management.commands import bancard_loadtest
+from .metrics import metrics
+from .models import (
+    AdminJob,
+    Card,
+    GatewayCall,
+    OutboxEntry,
+    ProcessedCallback,
+    Reversion,
+    Transaction,
+)
+from .notifiers import CacheNotifier
+from .profiling import DirectorySink, Profiler, profiled
+from .ratelimit import KeyedRateLimiter, RateLimiter, TokenBucket
+from .testing import assert_query_budget
+from .transports import (
+    FakeTransport,
+    RecordingExhausted,
+    Response,
+    RecordingTransport,
+    ReplayTransport,
+)
+from .utils import run_concurrently
+from .views import get_status_url
+
+
+def create_payment():
+    return apps.get_model(settings.BANCARD_PAYMENT_MODEL).objects.create()
+
+
+class FakeClock:
+    """Stands in for the `time` module, advancing only when slept on."""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+    monotonic = time
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class FakeTransportTestCase(TestCase):
+    """Runs operations against an in-memory vPOS."""
+
+    def setUp(self):
+        self.original_transport = bancard.transport
+        bancard.transport = self.vpos = FakeTransport(bancard)
+        self.user = get_user_model().objects.create(username="bancard")
+
+    def tearDown(self):
+        bancard.transport = self.original_transport
+
+    def register_card(self) -> Card:
+        operations.init_card_registration(
+            self.user.pk, "0981000000", "user@example.com", "https://example.com/"
+        )
+        operations.confirm_card_registration(self.user.pk)
+        return Card.objects.get(user=self.user, is_active=True)
+
+    def init_single_buy(self) -> Transaction:
+        operations.init_single_buy(
+            None, Decimal(1000), "Order", "https://example.com/", user_id=self.user.pk
+        )
+        return Transaction.objects.filter(user=self.user).latest("id")
+
+
+class BatchedLookupTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.users = [User.objects.create(username=f"user{i}") for i in range(20)]
+        for user in self.users[:10]:
+            Card.objects.create(user=user, is_active=True, is_default=True)
+            Card.objects.create(user=user, is_active=True)
+
+    def test_get_cards_for_users(self):
+        user_ids = [user.pk for user in self.users]
+        with self.assertNumQueries(1):
+            cards = operations.get_cards_for_users(user_ids)
+        self.assertEqual(set(cards), set(user_ids))
+        self.assertEqual(len(cards[user_ids[0]]), 2)
+        self.assertEqual(cards[user_ids[-1]], [])
+
+    def test_get_default_cards(self):
+        user_ids = [user.pk for user in self.users]
+        with self.assertNumQueries(1):
+            cards = operations.get_default_cards(user_ids)
+        self.assertEqual(set(cards), set(user_ids[:10]))
+        self.assertTrue(all(card.is_default for card in cards.values()))
+
+    def test_get_transaction_statuses(self):
+        payments = [create_payment() for _ in range(20)]
+        for payment in payments:
+            Transaction.objects.create(payment=payment, amount=1, status="fail")
+            Transaction.objects.create(payment=payment, amount=1)
+        with self.assertNumQueries(1):
+            statuses = operations.get_transaction_statuses(
+                [payment.pk for payment in payments]
+            )
+        self.assertEqual(len(statuses), 20)
+        self.assertTrue(
+            all(status.status == Transaction.PENDING for status in statuses.values())
+        )
+
+
+class QueryBudgetTests(FakeTransportTestCase):
+    def test_card_registration(self):
+        with assert_query_budget("init_card_registration"):
+            process_id = operations.init_card_registration(
+                self.user.pk, "0981000000", "user@example.com", "https://example.com/"
+            )
+        self.assertTrue(process_id)
+        with assert_query_budget("confirm_card_registration"):
+            card = operations.confirm_card_registration(self.user.pk)
+        self.assertEqual(card.last4, "0014")
+        with assert_query_budget("get_cards"):
+            self.assertEqual(operations.get_cards(self.user.pk), [card])
+        with assert_query_budget("set_default_card"):
+            self.assertTrue(operations.set_default_card(self.user.pk, card.id))
+        with assert_query_budget("delete_card"):
+            self.assertTrue(operations.delete_card(self.user.pk, card.id))
+        self.assertFalse(Card.objects.exists())
+
+    def test_charge_card(self):
+        card = self.register_card()
+        with assert_query_budget("charge_card"):
+            response = operations.charge_card(
+                self.user.pk, card.id, None, Decimal(1000), "Order"
+            )
+        self.assertEqual(response.status, Transaction.SUCCESS)
+        with assert_query_budget("reverse"):
+            self.assertTrue(operations.reverse(None, response.tx_id))
+
+    def test_charge_card_transient_error(self):
+        card = self.register_card()
+        self.vpos.fail_next("/charge", 503)
+        with assert_query_budget("charge_card"):
+            response = operations.charge_card(
+                self.user.pk, card.id, None, Decimal(1000), "Order"
+            )
+        self.assertEqual(response.status, Transaction.PENDING)
+        self.assertTrue(
+            OutboxEntry.objects.filter(
+                transaction_id=response.tx_id, operation=OutboxEntry.CONFIRMATION
+            ).exists()
+        )
+
+    def test_charge_card_rate_limited(self):
+        card = self.register_card()
+        with mock.patch.object(
+            bancard.rate_limiter,
+            "acquire",
+            side_effect=lambda path, **kwargs: path != "/charge",
+        ):
+            response = operations.charge_card(
+                self.user.pk, card.id, None, Decimal(1000), "Order"
+            )
+        # Never sent, so there is nothing to confirm.
+        self.assertEqual(response.status, Transaction.FAIL)
+        self.assertFalse(OutboxEntry.objects.exists())
+        self.assertNotIn("/charge", [path for _, path, _ in self.vpos.requests])
+
+    def test_single_buy(self):
+        with assert_query_budget("init_single_buy"):
+            process_id = operations.init_single_buy(
+                None, Decimal(1000), "Order", "https://example.com/"
+            )
+        self.assertTrue(process_id)
+        tx = Transaction.objects.get()
+        with assert_query_budget("get_transaction_status"):
+            response = operations.get_transaction_status(None, tx.id)
+        self.assertEqual(response.status, Transaction.FAIL)
+
+    def test_get_transaction_status_transient_error(self):
+        tx = self.init_single_buy()
+        self.vpos.fail_next("/single_buy/confirmations", 503)
+        with assert_query_budget("get_transaction_status"):
+            response = operations.get_transaction_status(None, tx.id)
+        self.assertEqual(response.status, Transaction.PENDING)
+        self.assertTrue(OutboxEntry.objects.filter(transaction=tx).exists())
+
+    def test_callback(self):
+        tx = self.init_single_buy()
+        payload = self.vpos.pay(tx.id)
+        with assert_query_budget("callback"):
+            self.assertEqual(operations.callback(payload)[1], 200)
+        tx.refresh_from_db()
+        self.assertEqual(tx.status, Transaction.SUCCESS)
+        # Redeliveries are acknowledged without updating the transaction.
+        with self.assertNumQueries(1):
+            self.assertEqual(operations.callback(payload)[1], 200)
+
+    def test_callback_forged(self):
+        tx = self.init_single_buy()
+        payload = self.vpos.pay(tx.id)
+        payload["operation"]["token"] = "forged"
+        with self.assertNumQueries(0):
+            self.assertEqual(operations.callback(payload)[1], 400)
+
+    def test_callback_without_response_code(self):
+        tx = self.init_single_buy()
+        payload = self.vpos.pay(tx.id)
+        del payload["operation"]["response_code"]
+        with self.assertNumQueries(0):
+            self.assertEqual(operations.callback(payload)[1], 400)
+        self.assertFalse(ProcessedCallback.objects.exists())
+
+    def test_bulk_operations(self):
+        txs = [self.init_single_buy() for _ in range(5)]
+        for tx in txs[:4]:
+            self.vpos.pay(tx.id)
+        # One lookup fails transiently and one is answered with an error.
+        self.vpos.fail_next("/single_buy/confirmations", 503)
+        self.vpos.fail_next("/single_buy/confirmations", 400)
+        with assert_query_budget("refresh_transaction_statuses"):
+            statuses = operations.refresh_transaction_statuses(
+                [tx.id for tx in txs], max_concurrency=1
+            )
+        self.assertEqual(
+            sorted(tx.status for tx in statuses.values()),
+            ["fail", "fail", "pending", "success", "success"],
+        )
+        self.assertEqual(OutboxEntry.objects.count(), 1)
+        with assert_query_budget("list_transactions"):
+            page = operations.list_transactions(user_id=self.user.pk)
+        self.assertEqual(len(page.items), 5)
+        self.vpos.fail_next("/single_buy/rollback", 503)
+        with assert_query_budget("reverse_bulk"):
+            result = operations.reverse_bulk([tx.id for tx in txs], max_concurrency=1)
+        self.assertEqual(len(result.ineligible), 3)
+        self.assertEqual((len(result.reversed), len(result.queued)), (1, 1))
+
+    def test_reverse_bulk_estimate(self):
+        txs = [
+            Transaction.objects.create(amount=1, status=Transaction.SUCCESS)
+            for _ in range(4)
+        ]
+        tx_ids = [tx.id for tx in txs]
+        with self.assertNumQueries(1):
+            estimate = operations.estimate_reverse_bulk(
+                tx_ids, max_concurrency=2, expected_latency=10, timeout=15
+            )
+        self.assertEqual(estimate.eligible, tx_ids)
+        self.assertEqual(estimate.estimated_seconds, 20)
+        self.assertTrue(estimate.exceeds_deadline)
+        # Runs expected to overrun the deadline are refused before sending.
+        with self.assertRaises(DeadlineExceeded):
+            operations.reverse_bulk(
+                tx_ids, max_concurrency=2, expected_latency=10, timeout=15
+            )
+        self.assertFalse(Reversion.objects.exists())
+        self.assertFalse(self.vpos.requests)
+
+
+class ListTransactionsTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username="bancard")
+        now = timezone.now()
+        # Several transactions share a creation time, so pages split ties.
+        for created_at in [now] * 4 + [now - timedelta(seconds=1)] * 3 + [now]:
+            Transaction.objects.create(user=self.user, amount=1, created_at=created_at)
+        Transaction.objects.create(amount=1, created_at=now)
+
+    def test_pages(self):
+        expected = list(
+            Transaction.objects.filter(user=self.user)
+            .order_by("-created_at", "-id")
+            .values_list("id", flat=True)
+        )
+        tx_ids, cursor, pages = [], None, 0
+        while True:
+            page = operations.list_transactions(
+                user_id=self.user.pk, after_cursor=cursor, limit=3
+            )
+            tx_ids += [item.tx_id for item in page.items]
+            pages += 1
+            cursor = page.next_cursor
+            if not cursor:
+                break
+        self.assertEqual(tx_ids, expected)
+        self.assertEqual(pages, 3)
+
+    def test_invalid_cursors(self):
+        cursor = operations.list_transactions(user_id=self.user.pk, limit=3).next_cursor
+        created_at, tx_id = Signer(salt="bancard.list-transactions").unsign_object(
+            cursor
+        )
+        payload, signature = cursor.rsplit(":", 1)
+        forged = base64.urlsafe_b64encode(
+            json.dumps([created_at, tx_id + 100]).encode()
+        ).decode()
+        for invalid in (
+            f"{forged}:{signature}",
+            f"{payload}:{signature[::-1]}",
+            Signer(salt="other").sign_object([created_at, tx_id]),
+            forged,
+            "garbage",
+            "a:b:c",
+        ):
+            with self.assertRaises(ValueError, msg=invalid):
+                operations.list_transactions(user_id=self.user.pk, after_cursor=invalid)
+
+
+class FakeTransportTests(FakeTransportTestCase):
+    def test_rejects_invalid_credentials(self):
+        operation = {
+            "token": "forged",
+            "shop_process_id": 1,
+            "amount": "1000.00",
+            "currency": "PYG",
+        }
+        response = self.vpos.send(
+            "POST", "/single_buy", {"public_key": "other", "operation": operation}
+        )
+        self.assertEqual(response.status_code, 401)
+        response = self.vpos.send(
+            "POST",
+            "/single_buy",
+            {"public_key": bancard.pub_key, "operation": operation},
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.vpos.single_buys)
+
+    def test_fail_next(self):
+        tx = self.init_single_buy()
+        self.vpos.pay(tx.id)
+        self.vpos.fail_next("/single_buy/confirmations", 503, times=2)
+        for _ in range(2):
+            response = operations.get_transaction_status(None, tx.id)
+            self.assertEqual(response.status, Transaction.PENDING)
+        response = operations.get_transaction_status(None, tx.id)
+        self.assertEqual(response.status, Transaction.SUCCESS)
+
+    def test_manual_registration(self):
+        self.vpos.auto_register = False
+        operations.init_card_registration(
+            self.user.pk, "0981000000", "user@example.com", "https://example.com/"
+        )
+        self.assertIsNone(operations.confirm_card_registration(self.user.pk))
+        card = Card.objects.get(user=self.user)
+        self.vpos.register_card(self.user.pk, card.id, expiration_date="01/20")
+        card = operations.confirm_card_registration(self.user.pk)
+        self.assertEqual((card.exp_month, card.exp_year), (1, 20))
+        response = operations.charge_card(
+            self.user.pk, card.id, None, Decimal(1000), "Order"
+        )
+        # Expired cards are declined without asking vPOS.
+        self.assertEqual(response.status, Transaction.FAIL)
+        self.assertNotIn("/charge", [path for _, path, _ in self.vpos.requests])
+
+    @override_settings(USE_TZ=False)
+    def test_expiry_without_time_zone_support(self):
+        card = self.register_card()
+        expired = Card.objects.create(
+            user=self.user, is_active=True, exp_year=20, exp_month=1
+        )
+        response = operations.charge_card(
+            self.user.pk, card.id, None, Decimal(1000), "Order"
+        )
+        self.assertEqual(response.status, Transaction.SUCCESS)
+        self.assertEqual(jobs.deactivate_expired_cards(), 1)
+        expired.refresh_from_db()
+        self.assertFalse(expired.is_active)
+
+
+class RecordingTransportTests(FakeTransportTestCase):
+    def setUp(self):
+        super().setUp()
+        fd, self.path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        bancard.transport = RecordingTransport(
+            bancard, self.path, backend="bancard.transports.FakeTransport"
+        )
+        self.vpos = bancard.transport.transport
+
+    def test_recordings_are_redacted(self):
+        card = self.register_card()
+        operations.charge_card(self.user.pk, card.id, None, Decimal(1000), "Order")
+        with open(self.path) as f:
+            recording = f.read()
+        secrets = [bancard.pub_key]
+        secrets += [c["alias_token"] for c in self.vpos.cards[self.user.pk].values()]
+        secrets += [t for t in Transaction.objects.values_list("token", flat=True)]
+        for secret in secrets:
+            self.assertNotIn(secret, recording)
+        self.assertIn(REDACTED, recording)
+
+    def test_replay(self):
+        self.register_card()
+        cards = bancard.get_user_cards(self.user.pk)
+        with open(self.path) as f:
+            recorded = sum(f'"/users/{self.user.pk}/cards"' in line for line in f)
+        bancard.transport = ReplayTransport(bancard, self.path, strict=True)
+        for _ in range(recorded):
+            self.assertEqual(
+                [{**card, "token": REDACTED} for card in cards],
+                bancard.get_user_cards(self.user.pk),
+            )
+        # Recorded responses are used up.
+        self.assertIsNone(bancard.get_user_cards(self.user.pk))
+        with self.assertRaises(RecordingExhausted):
+            bancard.transport.send("POST", f"/users/{self.user.pk}/cards", {})
+
+    def test_replay_by_endpoint(self):
+        self.register_card()
+        bancard.get_user_cards(self.user.pk)
+        bancard.transport = ReplayTransport(bancard, self.path, loop=True)
+        for user_id in (self.user.pk, self.user.pk + 1, self.user.pk + 2):
+            self.assertEqual(len(bancard.get_user_cards(user_id)), 1)
+        bancard.transport = ReplayTransport(bancard, self.path, strict=True)
+        # Strict replays don't answer requests that were not recorded.
+        self.assertIsNone(bancard.get_user_cards(self.user.pk + 1))
+
+
+class BlockingTransport:
+    """Transport answering every request once `release` is set."""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def send(self, method, path, data, timeout=None):
+        self.release.wait(5)
+        return Response(200, {"status": "success"})
+
+
+@override_settings(
+    BANCARD_LANES={
+        "low": {
+            "MAX_CONCURRENCY": 1,
+            "TIMEOUT": 0.05,
+            "RATE_LIMIT": {"ENDPOINTS": {"*": {"rate": 1, "burst": 5}}},
+        }
+    }
+)
+class LaneTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def make_gateway(self, merchant="default") -> BancardGateway:
+        config = {} if merchant == "default" else {"PUBLIC_KEY": "", "PRIVATE_KEY": ""}
+        gateway = BancardGateway(merchant, config)
+        gateway.transport = BlockingTransport()
+        return gateway
+
+    @lane(LOW)
+    def test_requests_without_a_slot_keep_their_rate_token(self):
+        gateway = self.make_gateway()
+        low = gateway.lanes[LOW]
+        thread = threading.Thread(
+            target=lane(LOW)(gateway.perform_request), args=("/single_buy", {})
+        )
+        thread.start()
+        while not low.in_flight:
+            time.sleep(0.001)
+        with self.assertRaises(RateLimited):
+            gateway.perform_request("/single_buy", {})
+        gateway.transport.release.set()
+        thread.join()
+        # Only the request that was sent took a token.
+        self.assertEqual(low.rate_limiter.buckets["*"].store.incr(0), 1)
+        counters = metrics.snapshot("lanes.")["counters"]
+        self.assertEqual(counters, {"lanes.low.rejected": 1})
+
+    def test_metrics_per_merchant(self):
+        for merchant, name in (("default", "lanes.low"), ("other", "lanes.other.low")):
+            low = self.make_gateway(merchant).lanes[LOW]
+            with low.slot():
+                with self.assertRaises(RateLimited):
+                    with low.slot():
+                        pass
+            counters = metrics.snapshot(name)["counters"]
+            self.assertEqual(counters[f"{name}.rejected"], 1)
+
+
+class HedgerTests(SimpleTestCase):
+    endpoint = "/users/{id}/cards"
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def make_hedger(self, **config) -> Hedger:
+        hedger = Hedger({"MIN_SAMPLES": 5, "BUDGET": 100, **config})
+        for _ in range(5):
+            metrics.observe(f"gateway.{self.endpoint}.seconds", 0.01)
+        return hedger
+
+    def counters(self):
+        return metrics.snapshot("hedging.")["counters"]
+
+    def test_no_hedging_without_samples(self):
+        hedger = Hedger({"MIN_SAMPLES": 5})
+        result = hedger.send(
+            self.endpoint, lambda: threading.current_thread(), lambda: True
+        )
+        self.assertIs(result, threading.current_thread())
+
+    def test_slow_request_is_hedged(self):
+        hedger = self.make_hedger()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        def send():
+            calls.append(None)
+            if len(calls) == 1:
+                release.wait(5)
+                return "primary"
+            return "hedge"
+
+        self.assertEqual(hedger.send(self.endpoint, send, lambda: True), "hedge")
+        counters = self.counters()
+        self.assertEqual(counters[f"hedging.{self.endpoint}.hedged"], 1)
+        self.assertEqual(counters[f"hedging.{self.endpoint}.hedge_wins"], 1)
+
+    def test_hedge_needs_admission(self):
+        hedger = self.make_hedger()
+
+        def send():
+            time.sleep(0.1)
+            return "primary"
+
+        self.assertEqual(hedger.send(self.endpoint, send, lambda: False), "primary")
+        self.assertNotIn(f"hedging.{self.endpoint}.hedged", self.counters())
+
+    def test_requests_are_not_limited_by_hedge_workers(self):
+        hedger = self.make_hedger(MAX_WORKERS=1, BUDGET=0)
+        # Only passes if all requests are in flight at the same time.
+        barrier = threading.Barrier(4, timeout=5)
+
+        def send():
+            barrier.wait()
+            return "ok"
+
+        results = run_concurrently(
+            lambda _: hedger.send(self.endpoint, send, lambda: True), range(4), 4
+        )
+        self.assertEqual(results, ["ok"] * 4)
+        self.assertNotIn(f"hedging.{self.endpoint}.hedged", self.counters())
+
+
+class RateLimitTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ratelimit, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        cache.clear()
+
+    def test_exhaustion_and_refill(self):
+        bucket = TokenBucket("test", rate=2, burst=2)
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertFalse(bucket.acquire(blocking=False))
+        self.clock.sleep(0.5)
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertFalse(bucket.acquire(blocking=False))
+        self.assertEqual(
+            metrics.snapshot("ratelimit.")["counters"]["ratelimit.test.rejected"], 2
+        )
+
+    def test_idle_tokens_are_capped_by_burst(self):
+        bucket = TokenBucket("test", rate=2, burst=2)
+        self.clock.sleep(60)
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertFalse(bucket.acquire(blocking=False))
+
+    def test_blocking_acquire(self):
+        bucket = TokenBucket("test", rate=2, burst=1)
+        bucket.acquire()
+        started = self.clock.now
+        self.assertTrue(bucket.acquire())
+        self.assertEqual(self.clock.now - started, 0.5)
+        # Tokens that would take longer than the timeout are given back.
+        self.assertFalse(bucket.acquire(timeout=0.1))
+        self.assertEqual(bucket.reserve(), 0.5)
+
+    def test_cache_store_is_shared(self):
+        buckets = [TokenBucket("shared", 1, 2, cache_alias="default") for _ in (1, 2)]
+        self.assertTrue(buckets[0].acquire(blocking=False))
+        self.assertTrue(buckets[1].acquire(blocking=False))
+        self.assertFalse(buckets[0].acquire(blocking=False))
+        self.clock.sleep(1)
+        self.assertTrue(buckets[1].acquire(blocking=False))
+
+    def test_cache_store_eviction(self):
+        bucket = TokenBucket("evicted", 1, 1, cache_alias="default")
+        self.assertTrue(bucket.acquire(blocking=False))
+        cache.clear()
+        self.assertTrue(bucket.acquire(blocking=False))
+
+    def test_rate_limiter_gives_back_taken_tokens(self):
+        limiter = RateLimiter(
+            {
+                "ENDPOINTS": {
+                    "*": {"rate": 10},
+                    "/users/{id}/cards": {"rate": 1},
+                }
+            }
+        )
+        self.assertTrue(limiter.acquire("/users/1/cards", blocking=False))
+        self.assertFalse(limiter.acquire("/users/2/cards", blocking=False))
+        # The token of the "*" bucket was given back.
+        self.assertEqual(limiter.buckets["*"].store.incr(0), 1)
+        self.assertTrue(limiter.acquire("/charge", blocking=False))
+
+    def test_keyed_rate_limiter(self):
+        limiter = KeyedRateLimiter("ip", rate=1, max_keys=2)
+        self.assertTrue(limiter.allow("a"))
+        self.assertFalse(limiter.allow("a"))
+        self.assertTrue(limiter.allow("b"))
+        self.assertTrue(limiter.allow("c"))
+        # The least recently used bucket was dropped.
+        self.assertEqual(list(limiter._buckets), ["b", "c"])
+        self.assertTrue(limiter.allow("a"))
+        self.clock.sleep(1)
+        self.assertTrue(limiter.allow("b"))
+
+    def test_keyed_rate_limiter_in_cache(self):
+        limiters = [KeyedRateLimiter("ip", 1, cache_alias="default") for _ in (1, 2)]
+        self.assertTrue(limiters[0].allow("a"))
+        self.assertFalse(limiters[1].allow("a"))
+        self.assertTrue(limiters[1].allow("b"))
+
+
+class DeadlineTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(deadlines, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_remaining(self):
+        self.assertIsNone(remaining())
+        with deadline(None):
+            self.assertIsNone(remaining())
+        with deadline(2):
+            self.assertEqual(remaining(), 2)
+            self.clock.sleep(1.5)
+            self.assertEqual(remaining(), 0.5)
+            self.clock.sleep(1)
+            self.assertEqual(remaining(), 0)
+        self.assertIsNone(remaining())
+
+    def test_nested_deadlines(self):
+        with deadline(2):
+            # Enclosing deadlines are never extended.
+            with deadline(5):
+                self.assertEqual(remaining(), 2)
+            with deadline(1):
+                self.assertEqual(remaining(), 1)
+            with deadline(None):
+                self.assertEqual(remaining(), 2)
+            self.assertEqual(remaining(), 2)
+
+    def test_with_timeout(self):
+        @with_timeout
+        def func(value):
+            return value, remaining()
+
+        self.assertEqual(func(1), (1, None))
+        self.assertEqual(func(1, timeout=3), (1, 3))
+        self.assertIsNone(remaining())
+
+    def test_worker_threads_share_the_deadline(self):
+        with deadline(2):
+            self.assertEqual(run_concurrently(lambda _: remaining(), [1, 2], 2), [2, 2])
+
+
+class GatewayDeadlineTests(FakeTransportTestCase):
+    def test_requests_use_the_time_left(self):
+        with mock.patch.object(self.vpos, "send", wraps=self.vpos.send) as send:
+            with deadline(2):
+                self.assertEqual(bancard.get_user_cards(self.user.pk), [])
+        timeout = send.call_args.args[3]
+        self.assertTrue(0 < timeout <= 2)
+
+    def test_nothing_is_sent_without_time_left(self):
+        with deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                bancard.perform_request(f"/users/{self.user.pk}/cards", {})
+        self.assertFalse(self.vpos.requests)
+
+
+class ListSink:
+    """Profiling sink keeping profiles in memory."""
+
+    profiles = []
+
+    def write(self, call, stats):
+        self.profiles.append((call, stats))
+
+
+@override_settings(
+    BANCARD_PROFILING={
+        "SAMPLE_RATE": 1,
+        "THRESHOLD": 0,
+        "SINK": {"BACKEND": "bancard.tests.ListSink"},
+    }
+)
+class ProfilingTests(FakeTransportTestCase):
+    def setUp(self):
+        super().setUp()
+        profiling.get_profiler.cache_clear()
+        self.addCleanup(profiling.get_profiler.cache_clear)
+        ListSink.profiles = []
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_operations_are_profiled(self):
+        card = self.register_card()
+        ListSink.profiles = []
+        with connection.execute_wrapper(profiling.time_query):
+            operations.charge_card(self.user.pk, card.id, None, Decimal(1000), "Order")
+        [(call, stats)] = ListSink.profiles
+        self.assertEqual(call.operation, "charge_card")
+        self.assertIsNone(call.error)
+        self.assertGreater(call.db_queries, 0)
+        self.assertTrue(call.gateway_requests)
+        self.assertLessEqual(call.db_seconds + call.gateway_seconds, call.seconds)
+        self.assertTrue(stats.total_calls)
+
+    def test_nested_calls_are_part_of_the_outer_profile(self):
+        @profiled
+        def inner():
+            return profiling.get_profiler().should_sample()
+
+        @profiled
+        def outer():
+            return inner()
+
+        self.assertFalse(outer())
+        self.assertEqual([call.operation for call, _ in ListSink.profiles], ["outer"])
+
+    def test_errors(self):
+        @profiled
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            fail()
+        [(call, _)] = ListSink.profiles
+        self.assertEqual(call.error, "ValueError('failed')")
+
+    def test_async_calls_are_timed(self):
+        @profiled
+        async def operation():
+            return 1
+
+        self.assertEqual(async_to_sync(operation)(), 1)
+        [(call, stats)] = ListSink.profiles
+        self.assertEqual(call.operation, "operation")
+        self.assertIsNone(stats)
+
+    def test_fast_calls_are_discarded(self):
+        profiler = Profiler(
+            {"THRESHOLD": 60, "SINK": {"BACKEND": "bancard.tests.ListSink"}}
+        )
+        self.assertEqual(profiler.run(lambda: 1, (), {}), 1)
+        self.assertFalse(ListSink.profiles)
+        counters = metrics.snapshot("profiling.")["counters"]
+        self.assertEqual(counters["profiling.<lambda>.sampled"], 1)
+        self.assertNotIn("profiling.<lambda>.kept", counters)
+
+    def test_directory_sink(self):
+        with tempfile.TemporaryDirectory() as path:
+            sink = DirectorySink(path, max_bytes=10**6)
+            call = profiling.CallProfile("charge_card")
+            sink.write(call, None)
+            [name] = os.listdir(path)
+            with open(os.path.join(path, name)) as f:
+                self.assertEqual(json.load(f)["operation"], "charge_card")
+            # The oldest files are deleted once over the size limit.
+            os.utime(os.path.join(path, name), (0, 0))
+            sink.max_bytes = os.path.getsize(os.path.join(path, name))
+            sink.write(profiling.CallProfile("reverse"), None)
+            [name] = os.listdir(path)
+            self.assertIn("reverse", name)
+
+
+class LoadTestScheduleTests(SimpleTestCase):
+    def test_weights_are_relative(self):
+        schedule = bancard_loadtest.Command.make_schedule(
+            {"callback": 60, "charge": 20, "status": 20}, 1000
+        )
+        self.assertEqual(len(schedule), 1000)
+        self.assertEqual(schedule.count("callback"), 600)
+        self.assertEqual(schedule.count("status"), 200)
+
+
+class NotifierTests(TestCase):
+    def test_await_update_uses_async_cache(self):
+        notifier = CacheNotifier(ttl=5)
+        notifier.publish(1, {"status": "success"})
+        # The sync cache API would block the event loop.
+        with mock.patch.object(CacheNotifier, "get", side_effect=AssertionError):
+            data = async_to_sync(notifier.await_update)(1, 1)
+        self.assertEqual(data, {"status": "success"})
+
+
+@override_settings(ROOT_URLCONF="bancard.urls")
+class TransactionStatusViewTests(FakeTransportTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.tx = self.init_single_buy()
+        self.url = reverse("bancard_transaction_status", args=[self.tx.id])
+
+    def test_requires_signature_or_owner(self):
+        self.assertEqual(self.client.get(self.url, {"timeout": 0}).status_code, 404)
+        response = self.client.get(get_status_url(self.tx.id) + "&timeout=0")
+        self.assertEqual(response.json()["status"], Transaction.FAIL)
+        other = get_status_url(self.tx.id + 1).split("?")[1]
+        self.assertEqual(self.client.get(f"{self.url}?{other}").status_code, 404)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.url, {"timeout": 0}).status_code, 200)
+
+    def test_throttles_vpos_checks(self):
+        url = get_status_url(self.tx.id) + "&timeout=0"
+        self.vpos.fail_next("/single_buy/confirmations", 503, times=3)
+        for _ in range(3):
+            response = self.client.get(url)
+            self.assertEqual(response.json()["status"], Transaction.PENDING)
+        requests = [p for _, p, _ in self.vpos.requests if "confirmations" in p]
+        self.assertEqual(len(requests), 1)
+
+
+class MultipleMerchantTests(FakeTransportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = BancardGateway(
+            "other", {"PUBLIC_KEY": "pub", "PRIVATE_KEY": "priv"}
+        )
+        self.other.transport = FakeTransport(self.other)
+        patcher = mock.patch.dict(gateways._gateways, {"other": self.other})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cards_are_scoped_to_their_merchant(self):
+        card = self.register_card()
+        self.assertEqual(operations.get_cards(self.user.pk, "other"), [])
+        self.assertIsNone(operations.get_default_card(self.user.pk, "other"))
+        self.assertIsNone(
+            operations.charge_card(
+                self.user.pk, card.id, None, Decimal(1000), "Order", merchant="other"
+            )
+        )
+        self.assertFalse(operations.delete_card(self.user.pk, card.id, "other"))
+        operations.init_card_registration(
+            self.user.pk, "0981000000", "user@example.com", "/", merchant="other"
+        )
+        other_card = operations.confirm_card_registration(self.user.pk, "other")
+        # Each merchant has its own default card.
+        self.assertTrue(other_card.is_default)
+        self.assertEqual(operations.get_default_card(self.user.pk).id, card.id)
+        response = operations.charge_card(
+            self.user.pk, other_card.id, None, Decimal(1000), "Order", merchant="other"
+        )
+        self.assertEqual(response.status, Transaction.SUCCESS)
+        self.assertEqual(Transaction.objects.get().merchant, "other")
+
+    def test_callback_of_removed_merchant(self):
+        tx = self.init_single_buy()
+        payload = self.vpos.pay(tx.id)
+        Transaction.objects.filter(id=tx.id).update(merchant="removed")
+        self.assertEqual(operations.callback(payload)[1], 400)
+        self.assertEqual(async_to_sync(operations.acallback)(payload)[1], 400)
+
+    def test_jobs_skip_removed_merchants(self):
+        card = self.register_card()
+        removed = Card.objects.create(
+            user=self.user, merchant="removed", is_active=True, exp_year=30
+        )
+        stats = jobs.sync_cards()
+        self.assertEqual((stats["users"], stats["failed_users"]), (1, 1))
+        self.assertTrue(Card.objects.get(id=removed.id).is_active)
+        self.assertTrue(Card.objects.get(id=card.id).is_active)
+        txs = [self.init_single_buy() for _ in range(2)]
+        self.vpos.pay(txs[0].id)
+        Transaction.objects.filter(id=txs[1].id).update(merchant="removed")
+        statuses = operations.refresh_transaction_statuses([tx.id for tx in txs])
+        self.assertEqual(
+            [statuses[tx.id].status for tx in txs],
+            [Transaction.SUCCESS, Transaction.PENDING],
+        )
+        self.assertFalse(OutboxEntry.objects.exists())
+
+    @override_settings(ROOT_URLCONF="bancard.urls")
+    def test_health_reports_each_merchant(self):
+        self.other.is_ready = False
+        self.other.last_error = "Connection refused."
+        with override_settings(BANCARD_MERCHANTS={"other": {}}):
+            response = self.client.get(reverse("bancard_health"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["merchants"]["other"], {"ready": False})
+        self.assertIn("default", response.json()["merchants"])
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        with override_settings(BANCARD_MERCHANTS={"other": {}}):
+            response = self.client.get(reverse("bancard_health"))
+        self.assertEqual(
+            response.json()["merchants"]["other"],
+            {"ready": False, "last_error": "Connection refused."},
+        )
+
+
+@override_settings(ROOT_URLCONF="bancard.urls")
+class HealthViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.object(BancardGateway, "probe", return_value=0.01)
+        self.probe = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse("bancard_health") + "?probe=1"
+
+    def test_probe_requires_staff(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.probe.called)
+        response = self.client.get(reverse("bancard_health"))
+        self.assertNotIn("last_error", response.json())
+
+    @override_settings(BANCARD_HEALTH={"PUBLIC": True})
+    def test_probes_are_cached(self):
+        for _ in range(3):
+            response = self.client.get(self.url)
+            self.assertEqual(response.json()["probe_seconds"], 0.01)
+        self.assertEqual(self.probe.call_count, 1)
+        self.assertIn("last_error", response.json())
+
+
+class JobTests(TestCase):
+    def test_reassign_default_cards_per_merchant(self):
+        user = get_user_model().objects.create(username="bancard")
+        Card.objects.create(user=user, is_active=True, is_default=True)
+        Card.objects.create(user=user, is_active=True)
+        other = Card.objects.create(user=user, is_active=True, merchant="other")
+        self.assertEqual(jobs.reassign_default_cards(iter([user.pk])), 1)
+        self.assertEqual(
+            list(Card.objects.filter(is_default=True, merchant="other")), [other]
+        )
+
+
+class ExpirePendingTransactionsTests(FakeTransportTestCase):
+    def make_pending(self, age: timedelta) -> Transaction:
+        tx = self.init_single_buy()
+        Transaction.objects.filter(id=tx.id).update(created_at=timezone.now() - age)
+        return tx
+
+    def confirmation_requests(self):
+        return [
+            data["operation"]["shop_process_id"]
+            for _, path, data in self.vpos.requests
+            if path == "/single_buy/confirmations"
+        ]
+
+    def test_expire_pending_transactions(self):
+        # Past the TTL and the verify window.
+        abandoned = self.make_pending(timedelta(days=3))
+        # Past the TTL, inside the verify window.
+        unknown, paid, unpaid, queued = [
+            self.make_pending(timedelta(days=1, minutes=10)) for _ in range(4)
+        ]
+        self.vpos.pay(paid.id)
+        OutboxEntry.objects.create(
+            operation=OutboxEntry.CONFIRMATION,
+            transaction=queued,
+            next_attempt_at=timezone.now(),
+        )
+        fresh = self.init_single_buy()
+        self.vpos.requests.clear()
+        # vPOS can't answer for the first one looked up.
+        self.vpos.fail_next("/single_buy/confirmations", 503)
+        stats = jobs.expire_pending_transactions(max_concurrency=1)
+        self.assertEqual(stats, {"expired": 2, "confirmed": 1, "skipped": 1})
+        statuses = dict(Transaction.objects.values_list("id", "status"))
+        self.assertEqual(statuses[abandoned.id], Transaction.EXPIRED)
+        self.assertEqual(statuses[paid.id], Transaction.SUCCESS)
+        self.assertEqual(statuses[unpaid.id], Transaction.EXPIRED)
+        for tx in (unknown, queued, fresh):
+            self.assertEqual(statuses[tx.id], Transaction.PENDING)
+        # Only transactions inside the verify window were looked up.
+        self.assertEqual(
+            sorted(set(self.confirmation_requests())), [unknown.id, paid.id, unpaid.id]
+        )
+
+
+class SyncCardsTests(FakeTransportTestCase):
+    def test_sync_cards(self):
+        confirmed = self.register_card()
+        Card.objects.filter(id=confirmed.id).update(brand="Outdated")
+        gone = Card.objects.create(
+            user=self.user, is_active=True, exp_year=30, exp_month=1
+        )
+        abandoned = Card.objects.create(user=self.user)
+        Card.objects.filter(id=abandoned.id).update(
+            created_at=timezone.now() - timedelta(days=2)
+        )
+        self.vpos.auto_register = False
+        operations.init_card_registration(
+            self.user.pk, "0981000000", "user@example.com", "https://example.com/"
+        )
+        pending = Card.objects.latest("id")
+        self.vpos.register_card(self.user.pk, pending.id)
+
+        stats = jobs.sync_cards()
+        self.assertEqual(
+            stats,
+            {
+                "users": 1,
+                "failed_users": 0,
+                "updated": 1,
+                "deactivated": 1,
+                "deleted": 1,
+            },
+        )
+        confirmed.refresh_from_db()
+        self.assertEqual(confirmed.brand, "Mastercard")
+        self.assertFalse(Card.objects.get(id=gone.id).is_active)
+        self.assertFalse(Card.objects.filter(id=abandoned.id).exists())
+        # Placeholders registered in vPOS are left to the confirmation.
+        self.assertFalse(Card.objects.get(id=pending.id).is_active)
+        self.assertEqual(
+            operations.confirm_card_registration(self.user.pk).id, pending.id
+        )
+
+    def test_users_that_cannot_be_fetched_are_skipped(self):
+        card = Card.objects.create(user=self.user, is_active=True, exp_year=30)
+        self.vpos.fail_next("/users/{id}/cards", 503)
+        self.assertEqual(jobs.sync_cards()["failed_users"], 1)
+        self.assertTrue(Card.objects.get(id=card.id).is_active)
+
+
+class OutboxTests(FakeTransportTestCase):
+    def enqueue_confirmation(self, tx: Transaction) -> OutboxEntry:
+        entry = outbox.enqueue(
+            OutboxEntry.CONFIRMATION, tx.id, TransientGatewayError("Timeout.")
+        )
+        OutboxEntry.objects.filter(id=entry.id).update(
+            next_attempt_at=timezone.now() - timedelta(seconds=1)
+        )
+        return entry
+
+    def test_retry(self):
+        tx = self.init_single_buy()
+        self.vpos.pay(tx.id)
+        entry = self.enqueue_confirmation(tx)
+        self.assertEqual(outbox.process_outbox(), 1)
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.attempts), (OutboxEntry.DONE, 1))
+        tx.refresh_from_db()
+        self.assertEqual(tx.status, Transaction.SUCCESS)
+        # Nothing else is due.
+        self.assertEqual(outbox.process_outbox(), 0)
+
+    @override_settings(BANCARD_OUTBOX={"MAX_ATTEMPTS": 2})
+    def test_backoff_and_max_attempts(self):
+        tx = self.init_single_buy()
+        entry = self.enqueue_confirmation(tx)
+        self.vpos.fail_next("/single_buy/confirmations", 503, times=2)
+        outbox.process_outbox()
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.attempts), (OutboxEntry.PENDING, 1))
+        self.assertGreater(entry.next_attempt_at, timezone.now())
+        self.assertIn("503", entry.last_error)
+        OutboxEntry.objects.filter(id=entry.id).update(next_attempt_at=timezone.now())
+        outbox.process_outbox()
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.attempts), (OutboxEntry.FAIL, 2))
+
+    def test_other_errors_fail_the_entry_only(self):
+        removed = self.init_single_buy()
+        Transaction.objects.filter(id=removed.id).update(merchant="removed")
+        broken = self.enqueue_confirmation(removed)
+        tx = self.init_single_buy()
+        self.vpos.pay(tx.id)
+        entry = self.enqueue_confirmation(tx)
+        with self.assertLogs("bancard.outbox", "ERROR"):
+            self.assertEqual(outbox.process_outbox(), 2)
+        broken.refresh_from_db()
+        self.assertEqual(broken.status, OutboxEntry.FAIL)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, OutboxEntry.DONE)
+
+    def test_pending_entries_are_unique(self):
+        tx = self.init_single_buy()
+        entry = self.enqueue_confirmation(tx)
+        self.assertEqual(self.enqueue_confirmation(tx), entry)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            OutboxEntry.objects.create(
+                operation=OutboxEntry.CONFIRMATION,
+                transaction=tx,
+                next_attempt_at=timezone.now(),
+            )
+        OutboxEntry.objects.filter(id=entry.id).update(status=OutboxEntry.DONE)
+        self.assertNotEqual(self.enqueue_confirmation(tx), entry)
+
+
+urlpatterns = [path("admin/", admin.site.urls)]
+
+
+def run_jobs_inline():
+    """Runs admin jobs in the test thread, without closing its connection."""
+
+    def thread(target, args, name):
+        return mock.Mock(start=lambda: target(*args))
+
+    return mock.patch.multiple(
+        "bancard.admin",
+        threading=mock.Mock(Thread=thread, current_thread=threading.current_thread),
+        connection=mock.DEFAULT,
+    )
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class TransactionAdminTests(FakeTransportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.url = reverse("admin:bancard_transaction_changelist")
+
+    def test_reverse_asks_for_confirmation(self):
+        card = self.register_card()
+        response = operations.charge_card(
+            self.user.pk, card.id, None, Decimal(1000), "Order"
+        )
+        data = {"action": "reverse_transactions", "_selected_action": [response.tx_id]}
+        page = self.client.post(self.url, data)
+        self.assertTemplateUsed(
+            page, "admin/bancard/transaction/reverse_confirmation.html"
+        )
+        self.assertEqual(page.context["estimate"].eligible, [response.tx_id])
+        self.assertFalse(Reversion.objects.exists())
+        with run_jobs_inline():
+            job = self.client.post(self.url, dict(data, post="yes"), follow=True)
+        self.assertContains(job, "Done")
+        self.assertEqual(AdminJob.objects.get().result["reversed"], 1)
+        self.assertEqual(Reversion.objects.get().status, Reversion.SUCCESS)
+
+    def test_missing_job(self):
+        url = reverse("admin:bancard_transaction_job", args=[uuid.uuid4()])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        # Progress of a job deleted meanwhile is dropped.
+        with mock.patch("bancard.admin.connection"):
+            admin_module._run_job(uuid.uuid4(), lambda tx_ids, progress: {}, [1])
+
+
+class AuditLogTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def record(self, log: AuditLog, tx_id: int) -> None:
+        data = {
+            "public_key": "public",
+            "operation": {"token": "secret", "shop_process_id": tx_id},
+        }
+        log.record("POST", "/single_buy", "/single_buy", data, 200, 0.1)
+
+    def test_flush(self):
+        log = AuditLog({"FLUSH": "request"})
+        for tx_id in (1, 2):
+            self.record(log, tx_id)
+        self.assertFalse(GatewayCall.objects.exists())
+        self.assertEqual(log.flush(), 2)
+        self.assertEqual(log.flush(), 0)
+        call = GatewayCall.objects.get(tx_id=1)
+        self.assertEqual(
+            call.request_data,
+            {
+                "public_key": REDACTED,
+                "operation": {"token": REDACTED, "shop_process_id": 1},
+            },
+        )
+        self.assertEqual(metrics.snapshot("audit.")["counters"]["audit.written"], 2)
+
+    def test_full_buffer_drops_calls(self):
+        for drop, kept in (("oldest", [2, 3]), ("newest", [1, 2])):
+            GatewayCall.objects.all().delete()
+            log = AuditLog({"FLUSH": "request", "BUFFER_SIZE": 2, "DROP": drop})
+            for tx_id in (1, 2, 3):
+                self.record(log, tx_id)
+            log.flush()
+            self.assertEqual(
+                sorted(GatewayCall.objects.values_list("tx_id", flat=True)), kept
+            )
+        self.assertEqual(metrics.snapshot("audit.")["counters"]["audit.dropped"], 2)
+
+    def test_prune(self):
+        now = timezone.now()
+        for days in (0, 100):
+            GatewayCall.objects.create(
+                method="POST",
+                path="/single_buy",
+                endpoint="/single_buy",
+                duration=0.1,
+                created_at=now - timedelta(days=days),
+            )
+        call_command("bancard_prune", stdout=io.StringIO())
+        self.assertEqual(
+            list(GatewayCall.objects.values_list("created_at", flat=True)), [now]
+        )
+
+
+class GatewayCallAdminTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create(
+            username="admin", is_staff=True, is_superuser=True
+        )
+        self.client.force_login(user)
+        self.url = reverse("admin:bancard_gatewaycall_changelist")
+        now = timezone.now()
+        calls = [
+            GatewayCall(endpoint="/charge", duration=duration, created_at=now)
+            for duration in range(1, 101)
+        ]
+        calls.append(GatewayCall(endpoint="/charge", duration=1000, created_at=now))
+        # Left out unless its date is picked.
+        calls.append(
+            GatewayCall(
+                endpoint="/charge", duration=5000, created_at=now - timedelta(days=2)
+            )
+        )
+        calls.append(GatewayCall(endpoint="/rollback", duration=2, created_at=now))
+        GatewayCall.objects.bulk_create(calls)
+
+    def test_latency_stats(self):
+        page = self.client.get(self.url)
+        charge, rollback = page.context["latency_stats"]
+        self.assertEqual((charge["endpoint"], charge["count"]), ("/charge", 101))
+        self.assertEqual(charge["percentiles"], [51, 96, 100])
+        self.assertEqual(charge["max"], 1000)
+        self.assertEqual(rollback["percentiles"], [2, 2, 2])
+
+    def test_latency_stats_of_picked_dates(self):
+        old = timezone.now() - timedelta(days=2)
+        page = self.client.get(self.url, {"created_at__year": old.year})
+        charge = page.context["latency_stats"][0]
+        self.assertEqual(charge["max"], 5000)
+        self.assertIsNone(page.context["latency_since"])
+
+    def test_latency_stats_queries(self):
+        model_admin = admin.site._registry[GatewayCall]
+        # One query for counts and one per endpoint for percentiles.
+        with self.assertNumQueries(3):
+            model_admin.get_latency_stats(GatewayCall.objects.all())
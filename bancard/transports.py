@@ -0,0 +1,518 @@
+"""Transports send requests to vPOS on behalf of `BancardGateway`.
+
+The transport is chosen with the `BANCARD_TRANSPORT` setting::
+
+    BANCARD_TRANSPORT = {
+        "BACKEND": "bancard.transports.HTTPTransport",
+        "OPTIONS": {"pool_size": 10, "timeout": 30},
+    }
+
+Transports are built with the gateway they belong to plus `OPTIONS`, and
+only need a `send(method, path, data, timeout=None)` method returning an
+object with `status_code`, `json()` and `raise_for_status()`, like a
+`requests.Response`.
+"""
+
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Iterable, Tuple
+
+import requests
+from django.utils.module_loading import import_string
+
+from .audit import REDACTED_FIELDS, redact
+
+
+class Response:
+    """Minimal `requests.Response` look-alike returned by in-memory transports."""
+
+    def __init__(self, status_code: int, data: dict) -> None:
+        self.status_code = status_code
+        self.data = data
+
+    def json(self) -> dict:
+        return self.data
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class BaseTransport:
+    def __init__(self, gateway) -> None:
+        self.gateway = gateway
+
+    def send(self, method: str, path: str, data: dict, timeout: Optional[float] = None):
+        """Sends a request to vPOS and returns its response.
+
+        :param method: HTTP method.
+        :param path: vPOS API path, relative to the gateway base URL.
+        :param data: JSON body.
+        :param timeout: max. seconds to wait for the response.
+        """
+        raise NotImplementedError
+
+    def warm_up(self, connections: int, timeout: float) -> None:
+        """Opens up to `connections` connections to vPOS for later requests."""
+
+    def probe(self, timeout: float) -> None:
+        """Checks that vPOS can be reached, without calling any operation.
+
+        :raises requests.RequestException: if it can't.
+        """
+
+
+class HTTPTransport(BaseTransport):
+    """Sends requests over HTTP, reusing connections from a pool.
+
+    :param pool_size: max. number of connections kept open to vPOS.
+    :param timeout: default seconds to wait for a response. No limit if not set.
+    """
+
+    def __init__(
+        self, gateway, pool_size: int = 10, timeout: Optional[float] = None
+    ) -> None:
+        super().__init__(gateway)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def send(self, method: str, path: str, data: dict, timeout: Optional[float] = None):
+        # The default timeout still applies to requests with a longer deadline.
+        if timeout is None or (self.timeout is not None and self.timeout < timeout):
+            timeout = self.timeout
+        return self.session.request(
+            method,
+            f"{self.gateway.base_url}{path}",
+            json=data,
+            timeout=timeout,
+        )
+
+    def warm_up(self, connections: int, timeout: float) -> None:
+        # Concurrent requests make the pool keep one connection each.
+        connections = min(connections, self.pool_size)
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(self.probe, timeout) for _ in range(connections)]
+        for future in futures:
+            future.result()
+
+    def probe(self, timeout: float) -> None:
+        # Any HTTP answer will do: HEAD requests don't reach vPOS operations.
+        self.session.head(self.gateway.base_url, timeout=timeout)
+
+
+def _md5(string: str) -> str:
+    return hashlib.md5(string.encode()).hexdigest()
+
+
+class FakeTransport(BaseTransport):
+    """In-memory vPOS, for tests and load tests without network access.
+
+    It checks operation tokens like vPOS does and keeps registered cards,
+    single buys, confirmations and rollbacks. Card registrations complete
+    right away unless `auto_register` is off, in which case tests complete
+    them with `register_card`. Single buys are paid with `pay`, which returns
+    the signed callback vPOS would send.
+
+    :param latency: seconds every request takes. Requests sent with a shorter
+    timeout raise `requests.ReadTimeout`.
+    :param auto_register: complete card registrations as soon as they start.
+    """
+
+    ROUTES = {
+        ("POST", "/cards/new"): "new_card",
+        ("POST", "/users/{id}/cards"): "get_cards",
+        ("DELETE", "/users/{id}/cards"): "delete_card",
+        ("POST", "/charge"): "charge",
+        ("POST", "/single_buy"): "single_buy",
+        ("POST", "/single_buy/confirmations"): "get_confirmation",
+        ("POST", "/single_buy/rollback"): "rollback",
+    }
+
+    def __init__(
+        self, gateway, latency: float = 0.0, auto_register: bool = True
+    ) -> None:
+        super().__init__(gateway)
+        self.latency = latency
+        self.auto_register = auto_register
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.cards: Dict[int, Dict[int, Dict[str, Any]]] = defaultdict(dict)
+        self.single_buys: Dict[int, Dict[str, Any]] = {}
+        self.confirmations: Dict[int, Dict[str, Any]] = {}
+        self.rollbacks = set()
+        self.faults: Dict[str, deque] = defaultdict(deque)
+        self.requests = []
+
+    @property
+    def priv_key(self) -> str:
+        return self.gateway.priv_key
+
+    def fail_next(self, path: str, status_code: int = 503, times: int = 1) -> None:
+        """Makes the next `times` requests to `path` answer with `status_code`.
+
+        :param path: vPOS API path, with numeric segments as `{id}`.
+        """
+        with self.lock:
+            self.faults[path].extend([status_code] * times)
+
+    def register_card(
+        self,
+        user_id: int,
+        card_id: int,
+        number: str = "5418630110000014",
+        expiration_date: str = "12/99",
+        brand: str = "Mastercard",
+        card_type: str = "credit",
+    ) -> str:
+        """Registers a card as if the user completed the vPOS form.
+
+        :returns: the alias token of the card.
+        """
+        with self.lock:
+            alias_token = _md5(f"alias{user_id}:{card_id}:{next(self.ids)}")
+            self.cards[int(user_id)][int(card_id)] = {
+                "card_id": int(card_id),
+                "card_masked_number": f"{number[:6]}******{number[-4:]}",
+                "expiration_date": expiration_date,
+                "card_brand": brand,
+                "card_type": card_type,
+                "alias_token": alias_token,
+            }
+            return alias_token
+
+    def pay(self, shop_process_id: int, success: bool = True) -> dict:
+        """Completes a single buy as if the user paid in the vPOS form.
+
+        :returns: the callback payload vPOS would send.
+        """
+        with self.lock:
+            single_buy = self.single_buys[int(shop_process_id)]
+            return self.callback_payload(
+                shop_process_id, single_buy["amount"], single_buy["currency"], success
+            )
+
+    def callback_payload(
+        self,
+        shop_process_id: int,
+        amount: str,
+        currency: str = "PYG",
+        success: bool = True,
+    ) -> dict:
+        """Confirms a transaction and returns the signed callback payload vPOS
+        would send for it.
+
+        :param amount: amount formatted like vPOS does, e.g. "1000.00".
+        """
+        with self.lock:
+            operation = self._confirm(shop_process_id, amount, currency, success)
+        operation["token"] = _md5(
+            f"{self.priv_key}{shop_process_id}confirm{amount}{currency}"
+        )
+        return {"operation": operation}
+
+    def _confirm(
+        self, shop_process_id, amount: str, currency: str, success: bool
+    ) -> Dict[str, Any]:
+        confirmation = {
+            "token": "",
+            "shop_process_id": int(shop_process_id),
+            "response": "S" if success else "N",
+            "response_details": "Procesamiento correcto",
+            "amount": amount,
+            "currency": currency,
+            "authorization_number": "123456" if success else "",
+            "ticket_number": str(next(self.ids)).zfill(15),
+            "response_code": "00" if success else "05",
+            "response_description": (
+                "Transaccion aprobada" if success else "Tarjeta rechazada"
+            ),
+            "extended_response_description": None,
+            "security_information": {
+                "customer_ip": "127.0.0.1",
+                "card_source": "L",
+                "card_country": "PARAGUAY",
+                "version": "0.3",
+                "risk_index": "0",
+            },
+        }
+        self.confirmations[int(shop_process_id)] = confirmation
+        return dict(confirmation)
+
+    @staticmethod
+    def _error(key: str, status_code: int = 400) -> Response:
+        return Response(
+            status_code,
+            {"status": "error", "messages": [{"key": key, "level": "error"}]},
+        )
+
+    def send(
+        self, method: str, path: str, data: dict, timeout: Optional[float] = None
+    ) -> Response:
+        if self.latency and timeout is not None and timeout < self.latency:
+            time.sleep(timeout)
+            # Like a real timeout, the request is still processed but the
+            # answer is lost.
+            self._handle(method, path, data)
+            raise requests.ReadTimeout(f"Fake vPOS timed out on {path}.")
+        if self.latency:
+            time.sleep(self.latency)
+        return self._handle(method, path, data)
+
+    def _handle(self, method: str, path: str, data: dict) -> Response:
+        endpoint = re.sub(r"/\d+", "/{id}", path)
+        with self.lock:
+            self.requests.append((method, path, data))
+            if self.faults[endpoint]:
+                return Response(self.faults[endpoint].popleft(), {})
+            if data.get("public_key") != self.gateway.pub_key:
+                return self._error("InvalidPublicKeyError", 401)
+            handler = self.ROUTES.get((method, endpoint))
+            if not handler:
+                return self._error("NotFound", 404)
+            match = re.search(r"/(\d+)", path)
+            args = (int(match.group(1)),) if match else ()
+            return getattr(self, handler)(data["operation"], *args)
+
+    def new_card(self, operation: dict) -> Response:
+        user_id, card_id = operation["user_id"], operation["card_id"]
+        if operation["token"] != _md5(
+            f"{self.priv_key}{card_id}{user_id}request_new_card"
+        ):
+            return self._error("InvalidTokenError", 403)
+        if self.auto_register:
+            self.register_card(user_id, card_id)
+        return Response(
+            200, {"status": "success", "process_id": f"card-{next(self.ids)}"}
+        )
+
+    def get_cards(self, operation: dict, user_id: int) -> Response:
+        if operation["token"] != _md5(f"{self.priv_key}{user_id}request_user_cards"):
+            return self._error("InvalidTokenError", 403)
+        return Response(
+            200,
+            {"status": "success", "cards": list(self.cards[user_id].values())},
+        )
+
+    def delete_card(self, operation: dict, user_id: int) -> Response:
+        alias_token = operation["alias_token"]
+        if operation["token"] != _md5(
+            f"{self.priv_key}delete_card{user_id}{alias_token}"
+        ):
+            return self._error("InvalidTokenError", 403)
+        for card_id, card in list(self.cards[user_id].items()):
+            if card["alias_token"] == alias_token:
+                del self.cards[user_id][card_id]
+                return Response(200, {"status": "success"})
+        return self._error("CardNotFoundError", 404)
+
+    def charge(self, operation: dict) -> Response:
+        shop_process_id = operation["shop_process_id"]
+        if operation["token"] != _md5(
+            f"{self.priv_key}{shop_process_id}charge{operation['amount']}"
+            f"{operation['currency']}{operation['alias_token']}"
+        ):
+            return self._error("InvalidTokenError", 403)
+        known = any(
+            card["alias_token"] == operation["alias_token"]
+            for cards in self.cards.values()
+            for card in cards.values()
+        )
+        confirmation = self._confirm(
+            shop_process_id, operation["amount"], operation["currency"], known
+        )
+        confirmation["token"] = operation["token"]
+        self.confirmations[int(shop_process_id)]["token"] = operation["token"]
+        return Response(200, {"status": "success", "operation": confirmation})
+
+    def single_buy(self, operation: dict) -> Response:
+        shop_process_id = operation["shop_process_id"]
+        if operation["token"] != _md5(
+            f"{self.priv_key}{shop_process_id}{operation['amount']}"
+            f"{operation['currency']}"
+        ):
+            return self._error("InvalidTokenError", 403)
+        self.single_buys[int(shop_process_id)] = operation
+        return Response(
+            200, {"status": "success", "process_id": f"buy-{next(self.ids)}"}
+        )
+
+    def get_confirmation(self, operation: dict) -> Response:
+        shop_process_id = operation["shop_process_id"]
+        if operation["token"] != _md5(
+            f"{self.priv_key}{shop_process_id}get_confirmation"
+        ):
+            return self._error("InvalidTokenError", 403)
+        confirmation = self.confirmations.get(int(shop_process_id))
+        if not confirmation:
+            return Response(
+                200,
+                {
+                    "status": "error",
+                    "messages": [{"key": "PaymentNotFoundError", "level": "error"}],
+                },
+            )
+        return Response(200, {"status": "success", "confirmation": confirmation})
+
+    def rollback(self, operation: dict) -> Response:
+        shop_process_id = int(operation["shop_process_id"])
+        if operation["token"] != _md5(f"{self.priv_key}{shop_process_id}rollback0.00"):
+            return self._error("InvalidTokenError", 403)
+        if (
+            shop_process_id not in self.confirmations
+            or shop_process_id in self.rollbacks
+        ):
+            return Response(
+                200,
+                {
+                    "status": "error",
+                    "messages": [{"key": "TransactionNotFound", "level": "error"}],
+                },
+            )
+        self.rollbacks.add(shop_process_id)
+        return Response(200, {"status": "success"})
+
+
+def _strip_keys(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key != "public_key"}
+
+
+class RecordingTransport(BaseTransport):
+    """Sends requests through another transport and appends every exchange to
+    a JSON lines file, for `ReplayTransport`. Public keys are left out and
+    requests and responses are redacted like the audit log, see
+    `bancard.audit.REDACTED_FIELDS`.
+
+    :param path: file to append exchanges to.
+    :param backend: import path of the transport to record.
+    :param options: options of the recorded transport.
+    :param redact: fields redacted besides `REDACTED_FIELDS`.
+    """
+
+    def __init__(
+        self,
+        gateway,
+        path: str,
+        backend: str = "bancard.transports.HTTPTransport",
+        options: Optional[Dict[str, Any]] = None,
+        redact: Iterable[str] = (),
+    ) -> None:
+        super().__init__(gateway)
+        self.path = path
+        self.transport = import_string(backend)(gateway, **(options or {}))
+        self.redacted_fields = set(REDACTED_FIELDS) | set(redact)
+        self.lock = threading.Lock()
+
+    def send(self, method: str, path: str, data: dict, timeout: Optional[float] = None):
+        start = time.perf_counter()
+        res = self.transport.send(method, path, data, timeout)
+        elapsed = time.perf_counter() - start
+        try:
+            body = res.json()
+        except ValueError:
+            body = None
+        line = json.dumps(
+            {
+                "method": method,
+                "path": path,
+                "request": redact(_strip_keys(data), self.redacted_fields),
+                "status_code": res.status_code,
+                "response": redact(body, self.redacted_fields),
+                "elapsed": elapsed,
+            },
+            default=str,
+        )
+        with self.lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+        return res
+
+    def warm_up(self, connections: int, timeout: float) -> None:
+        self.transport.warm_up(connections, timeout)
+
+    def probe(self, timeout: float) -> None:
+        self.transport.probe(timeout)
+
+
+class RecordingExhausted(requests.RequestException):
+    """`ReplayTransport` has no recorded response left for a request."""
+
+
+class ReplayTransport(BaseTransport):
+    """Answers with responses recorded by `RecordingTransport`, without any
+    network I/O.
+
+    :param path: recording file.
+    :param strict: only answer requests identical to a recorded one, apart
+    from redacted fields. Otherwise recorded responses of each endpoint are
+    returned in order.
+    :param realtime: take as long as the recorded request took.
+    :param loop: start over when the responses of an endpoint run out.
+    :param redact: fields redacted when recording, besides `REDACTED_FIELDS`.
+    :raises RecordingExhausted: on requests with no recorded response left.
+    """
+
+    def __init__(
+        self,
+        gateway,
+        path: str,
+        strict: bool = False,
+        realtime: bool = False,
+        loop: bool = False,
+        redact: Iterable[str] = (),
+    ) -> None:
+        super().__init__(gateway)
+        self.redacted_fields = set(REDACTED_FIELDS) | set(redact)
+        self.strict = strict
+        self.realtime = realtime
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.exchanges: Dict[Tuple, deque] = defaultdict(deque)
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    exchange = json.loads(line)
+                    self.exchanges[
+                        self._get_key(
+                            exchange["method"], exchange["path"], exchange["request"]
+                        )
+                    ].append(exchange)
+
+    def _get_key(self, method: str, path: str, data: dict) -> Tuple:
+        if self.strict:
+            data = redact(_strip_keys(data), self.redacted_fields)
+            return method, path, json.dumps(data, sort_keys=True)
+        return method, re.sub(r"/\d+", "/{id}", path)
+
+    def send(
+        self, method: str, path: str, data: dict, timeout: Optional[float] = None
+    ) -> Response:
+        key = self._get_key(method, path, json.loads(json.dumps(data, default=str)))
+        with self.lock:
+            exchanges = self.exchanges.get(key)
+            if not exchanges:
+                raise RecordingExhausted(
+                    f"No recorded response left for {method} {path}."
+                )
+            exchange = exchanges.popleft()
+            if self.loop:
+                exchanges.append(exchange)
+        if self.realtime:
+            time.sleep(exchange["elapsed"])
+        return Response(exchange["status_code"], exchange["response"])
+
+
+def get_transport(gateway, config: Dict[str, Any]) -> BaseTransport:
+    """Builds the transport configured in `config` (`BANCARD_TRANSPORT`)."""
+    backend = config.get("BACKEND", "bancard.transports.HTTPTransport")
+    return import_string(backend)(gateway, **config.get("OPTIONS", {}))
@@ -1,7 +1,19 @@
 from django.urls import path
 
-from .views import callback_view
+from .views import (
+    callback_view,
+    async_callback_view,
+    transaction_status_view,
+    health_view,
+)
 
 urlpatterns = [
     path("callback/", callback_view, name="bancard_callback"),
+    path("async/callback/", async_callback_view, name="bancard_async_callback"),
+    path(
+        "transactions/<int:tx_id>/status/",
+        transaction_status_view,
+        name="bancard_transaction_status",
+    ),
+    path("health/", health_view, name="bancard_health"),
 ]
@@ -1,5 +1,13 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, TypeVar
+
 from django.http import HttpRequest
 
+T = TypeVar("T")
+R = TypeVar("R")
+
 
 def get_visitor_ip_address(request: HttpRequest) -> str:
     """
@@ -14,3 +22,43 @@ def get_visitor_ip_address(request: HttpRequest) -> str:
     else:
         ip = request.META.get("REMOTE_ADDR")
     return ip
+
+
+def run_concurrently(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    max_concurrency: int,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> List[R]:
+    """
+    Calls `func` on every item using a bounded thread pool.
+
+    Each call runs in a copy of the caller's context, so context variables
+    set by the caller are visible inside `func`.
+
+    :param func: function to call for each item.
+    :param items: items to process.
+    :param max_concurrency: max. number of simultaneous calls.
+    :param progress: called with the number of finished and total calls after
+    each call, possibly from a worker thread.
+    :returns: results in the same order as `items`.
+    """
+    items = list(items)
+    if not items:
+        return []
+    context = contextvars.copy_context()
+    done = 0
+    lock = threading.Lock()
+
+    def report(future) -> None:
+        nonlocal done
+        with lock:
+            done += 1
+            progress(done, len(items))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = [executor.submit(context.copy().run, func, item) for item in items]
+        if progress:
+            for future in futures:
+                future.add_done_callback(report)
+        return [future.result() for future in futures]
@@ -1,19 +1,228 @@
 import json
+from functools import lru_cache
+from typing import Optional, Tuple, Any
 
-from django.http import JsonResponse
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signing import Signer
+from django.http import JsonResponse, HttpRequest
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 
-from .operations import callback
+from .gateway import bancard, gateways
+from .metrics import metrics
+from .models import Transaction
+from .notifiers import get_notifier, serialize_response
+from .operations import (
+    callback,
+    acallback,
+    get_transaction_status,
+    _make_charge_response,
+)
+from .ratelimit import KeyedRateLimiter
+from .utils import get_visitor_ip_address
+
+
+def _reject(reason: str, error: str, status: int) -> JsonResponse:
+    metrics.increment(f"callbacks.rejected.{reason}")
+    return JsonResponse({"error": error}, status=status)
+
+
+@lru_cache(maxsize=None)
+def _get_callback_limiter() -> Optional[KeyedRateLimiter]:
+    config = getattr(settings, "BANCARD_CALLBACK_LIMITS", {})
+    if not config.get("RATE"):
+        return
+    return KeyedRateLimiter(
+        "callback", config["RATE"], config.get("BURST"), config.get("CACHE")
+    )
+
+
+def _read_callback(request: HttpRequest) -> Tuple[Any, Optional[JsonResponse]]:
+    """Rate limits callbacks per client IP, caps their size and decodes them,
+    before any DB access.
+
+    :returns: the decoded data, or the response rejecting the request.
+    """
+    limiter = _get_callback_limiter()
+    if limiter and not limiter.allow(get_visitor_ip_address(request)):
+        return None, _reject("rate_limited", "Too many requests.", 429)
+    max_size = getattr(settings, "BANCARD_CALLBACK_LIMITS", {}).get(
+        "MAX_BODY_SIZE", 16384
+    )
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if length > max_size or len(request.body) > max_size:
+        return None, _reject("too_large", "Request body too large.", 413)
+    try:
+        return json.loads(str(request.body, "utf-8")), None
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None, _reject("invalid_json", "Invalid JSON data.", 400)
 
 
 @csrf_exempt
 def callback_view(request):
     if request.method == "POST":
-        try:
-            data = json.loads(str(request.body, "utf-8"))
-        except json.JSONDecodeError:
-            return JsonResponse({"error": "Invalid JSON data."}, status=400)
+        data, rejection = _read_callback(request)
+        if rejection:
+            return rejection
         response, status = callback(data)
         return JsonResponse(response, status=status)
     else:
         return JsonResponse({"error": "Method not allowed."}, status=405)
+
+
+async def async_callback_view(request):
+    """Async version of `callback_view`, for ASGI deployments."""
+    if request.method == "POST":
+        data, rejection = _read_callback(request)
+        if rejection:
+            return rejection
+        response, status = await acallback(data)
+        return JsonResponse(response, status=status)
+    else:
+        return JsonResponse({"error": "Method not allowed."}, status=405)
+
+
+# `csrf_exempt` only keeps views async on Django >= 5.0.
+async_callback_view.csrf_exempt = True
+
+
+_status_signer = Signer(salt="bancard.transaction-status")
+
+
+def get_status_url(tx_id: int) -> str:
+    """Returns the URL of `transaction_status_view` for a transaction, signed
+    so that whoever gets it can see the transaction status.
+
+    :param tx_id: ID of the transaction.
+    """
+    url = reverse("bancard_transaction_status", args=[tx_id])
+    return f"{url}?{urlencode({'signature': _status_signer.signature(str(tx_id))})}"
+
+
+def _get_visible_transaction(request: HttpRequest, tx_id: int) -> Optional[Transaction]:
+    """Gets a transaction if the request is allowed to see it.
+
+    Transactions are visible with the signature of `get_status_url`, to
+    staff and to the user they are attached to.
+    """
+    signature = request.GET.get("signature", "")
+    if not constant_time_compare(signature, _status_signer.signature(str(tx_id))):
+        user = getattr(request, "user", None)
+        if not (user and user.is_authenticated):
+            return
+        if not user.is_staff:
+            return Transaction.objects.filter(id=tx_id, user_id=user.pk).first()
+    return Transaction.objects.filter(id=tx_id).first()
+
+
+async def _may_refresh(tx_id: int) -> bool:
+    """Allows a single vPOS confirmation check per transaction every
+    `BANCARD_STATUS_REFRESH_INTERVAL` seconds, whichever client asks.
+    """
+    interval = getattr(settings, "BANCARD_STATUS_REFRESH_INTERVAL", 10)
+    return await cache.aadd(f"bancard:status-refresh:{tx_id}", True, interval)
+
+
+def _get_wait_timeout(request: HttpRequest) -> float:
+    max_timeout = getattr(settings, "BANCARD_STATUS_WAIT_TIMEOUT", 25)
+    try:
+        timeout = float(request.GET.get("timeout", max_timeout))
+    except ValueError:
+        timeout = max_timeout
+    return max(0.0, min(timeout, max_timeout))
+
+
+async def transaction_status_view(request, tx_id: int):
+    """Long-poll endpoint that returns the transaction status as soon as vPOS
+    confirms it, instead of having clients poll `get_transaction_status`.
+
+    Waits up to `?timeout=` seconds (capped by `BANCARD_STATUS_WAIT_TIMEOUT`)
+    for a `transaction_updated` signal and falls back to a single vPOS
+    confirmation check when no update arrives, unless one was made recently.
+    See `_get_visible_transaction` for who may see a transaction.
+    """
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed."}, status=405)
+    tx = await sync_to_async(_get_visible_transaction)(request, tx_id)
+    if not tx:
+        return JsonResponse({"error": "Transaction not found."}, status=404)
+    if tx.status != Transaction.PENDING:
+        return JsonResponse(serialize_response(_make_charge_response(tx)))
+    data = await get_notifier().await_update(tx.id, _get_wait_timeout(request))
+    if data is None and await _may_refresh(tx.id):
+        response = await sync_to_async(get_transaction_status)(tx.payment_id, tx.id)
+        if not response:
+            return JsonResponse({"error": "Transaction not found."}, status=404)
+        data = serialize_response(response)
+    elif data is None:
+        tx = await Transaction.objects.defer("raw_response").aget(id=tx.id)
+        data = serialize_response(_make_charge_response(tx))
+    return JsonResponse(data)
+
+
+def _get_health_config() -> dict:
+    return {"PUBLIC": False, "PROBE_TTL": 10, **getattr(settings, "BANCARD_HEALTH", {})}
+
+
+def _probe(gateway, ttl: float) -> Optional[float]:
+    """Probes vPOS with the transport of `gateway`, at most once every `ttl`
+    seconds per merchant, whoever asks.
+    """
+    key = f"bancard:health-probe:{gateway.merchant}"
+    result = cache.get(key)
+    if result is None:
+        result = {"seconds": gateway.probe()}
+        cache.set(key, result, ttl)
+    return result["seconds"]
+
+
+def health_view(request):
+    """Reports whether the gateway is ready plus recent vPOS response times
+    and errors, without calling any vPOS operation. Answers 503 while
+    connections warm up, so load balancers only route to ready workers.
+
+    Readiness is reported for every configured merchant under `merchants`,
+    the top-level values being those of the default merchant. Answers 503
+    unless every merchant is ready.
+
+    With `?probe=1` it also checks that vPOS can be reached with the
+    transport of each merchant, answering 503 if it can't. Probe results
+    are cached for `PROBE_TTL` seconds. Probes and the last vPOS errors are
+    only available to staff, unless the `BANCARD_HEALTH` setting makes them
+    `PUBLIC`.
+    """
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed."}, status=405)
+    config = _get_health_config()
+    user = getattr(request, "user", None)
+    privileged = config["PUBLIC"] or bool(user and user.is_staff)
+    probe = bool(request.GET.get("probe"))
+    if probe and not privileged:
+        return JsonResponse({"error": "Probing is only allowed to staff."}, status=403)
+    health = bancard.get_health()
+    if not privileged:
+        del health["last_error"]
+    merchants = health["merchants"] = {}
+    for gateway in gateways.all():
+        merchants[gateway.merchant] = {"ready": gateway.is_ready}
+        if privileged:
+            merchants[gateway.merchant]["last_error"] = gateway.last_error
+        if probe:
+            merchants[gateway.merchant]["probe_seconds"] = _probe(
+                gateway, config["PROBE_TTL"]
+            )
+    if probe:
+        health["probe_seconds"] = merchants[bancard.merchant]["probe_seconds"]
+    healthy = all(
+        merchant["ready"] and merchant.get("probe_seconds", 0) is not None
+        for merchant in merchants.values()
+    )
+    return JsonResponse(health, status=200 if healthy else 503)